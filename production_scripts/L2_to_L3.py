@@ -6,13 +6,23 @@ Created on Fri Jun 21 14:03:13 2024
 """
 
 import harmonise
+import memtrack
+import iopipe
 import numpy as np
-import pandas as pd
 import glob
 import os
+import json
+import argparse
 import datetime as dt
-import xarray as xr
 import logging
+import multiprocessing
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, as_completed
+# xarray, pandas, dask and quicklook are imported where they are used, so
+# that importing this module (e.g. in every worker process) is cheap
 
 
 logger = logging.getLogger(__name__)
@@ -23,154 +33,928 @@ l2_versions = {
     "WLS70": "1.22",
     "w400s": "1.32",
 }
-logging.basicConfig(
-    filename=f"C:/Users/wmorris2/Desktop/L2_to_L3_logs/{dt.datetime.utcnow().strftime('%Y%m%d%H%M%S')}.log",
-    filemode='a',
-    format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
-    datefmt='%H:%M:%S',
-    level=logging.INFO)
-
-logging.info(f"L2_to_L3.py program version {__version__}")
-
+log_dir = "C:/Users/wmorris2/Desktop/L2_to_L3_logs/"
 product_name = "paris_dwl_L3"
 time_aggs = [60*10, 60*60] # seconds
 input_dir = harmonise.L2_BASEDIR
-deployments = harmonise.get_deployments()
-deployments_df = pd.json_normalize(deployments, sep="_")
-station_codes = np.unique(deployments_df.station_code)
-stations = harmonise.get_stations()
-stations_df = pd.json_normalize(stations, sep="_").rename(
-    columns={"station_code": "station"}).set_index("station")
 paper_doi = "(paper in prep)"
 metadata_doi = "(metadata documentation in prep)"
 data_doi = "10.5281/zenodo.14761504"
 start_datetime_full = "2022-12-07T00:00:00"
 end_datetime_full = "2022-12-08T00:00:00"
 file_freq = "24h"
-datetime_range = pd.date_range(
-    start_datetime_full, end_datetime_full, freq=file_freq)
+# bytes per time block (of all profiles on the 1 m altitude grid) of the
+# lazy (dask) L3 graph
+LAZY_CHUNK_SIZE = memtrack.parse_size("64M")
+# peak memory of one dask worker in blocks (z_resample reindexes,
+# interpolates and selects, each a copy) when sizing blocks from a budget
+LAZY_CHUNKS_PER_WORKER = 3
+# bytes of L2 time slices kept between the L3 files of a run (L2SliceCache)
+L2_SLICE_CACHE_SIZE = memtrack.parse_size("256M")
+
+
+# the deployment and station metadata are read on first use, not at import,
+# so that importing this module (e.g. in every worker process) does no I/O
+@lru_cache(maxsize=None)
+def deployment_calendar():
+    return harmonise.DeploymentCalendar.from_json()
+
+
+@lru_cache(maxsize=None)
+def get_stations():
+    return harmonise.get_stations()
+
+
+@lru_cache(maxsize=None)
+def stations_table():
+    import pandas as pd
+    return pd.json_normalize(get_stations(), sep="_").rename(
+        columns={"station_code": "station"}).set_index("station")
+
+
+_LAZY_ATTRS = {
+    "calendar": deployment_calendar,
+    "station_codes": lambda: deployment_calendar().station_codes,
+    "stations": get_stations,
+    "stations_df": stations_table,
+}
+
+
+def __getattr__(name):
+    # the former module level metadata, e.g. L2_to_L3.calendar
+    if name in _LAZY_ATTRS:
+        return _LAZY_ATTRS[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def get_station_deployment(station_code, start_datetime, end_datetime):
+    start_datetime_dt = dt.datetime.fromisoformat(start_datetime)
+    end_datetime_dt = dt.datetime.fromisoformat(end_datetime)
+    if station_code in deployment_calendar().concurrent(
+            start_datetime_dt, end_datetime_dt):
+        logging.warning(
+            f"Concurrent station deployments for {station_code} "
+            f"{start_datetime} - {end_datetime}")
+    for d in deployment_calendar().resolve(start_datetime_dt,
+                                           end_datetime_dt):
+        if d.station_code == station_code:
+            return d
+
+
+def find_l2_files(d, start_datetime, end_datetime, time_agg):
+    import pandas as pd
+    filenames = []
+    # be certain that we load all the aggregation period data
+    date_from = dt.datetime.fromisoformat(
+        start_datetime) - dt.timedelta(seconds=time_agg)
+    date_to = dt.datetime.fromisoformat(end_datetime)
+    l2_version = l2_versions[d.instrument_type]
+
+    for date in pd.date_range(date_from, date_to):
+        date_string = date.strftime("%Y%m%d")
+        glob_str = f"*{l2_version}_{date_string}*{d.instrument_serial}*.nc"
+        files_glob = os.path.join(
+            input_dir, d.instrument_serial, glob_str)
+        filenames.extend(glob.glob(files_glob))
+
+    return sorted(filenames)
+
+
+def l3_filename(start_datetime, end_datetime, time_agg):
+    nc_file = "{product_name}V{version}_{start_time}_{end_time}_{time_agg}s.nc".format(
+        product_name=product_name,
+        start_time=dt.datetime.fromisoformat(
+            start_datetime).strftime("%Y%m%d%H%M"),
+        end_time=dt.datetime.fromisoformat(
+            end_datetime).strftime("%Y%m%d%H%M"),
+        time_agg=time_agg,
+        version=__version__)
+    return os.path.join(harmonise.L3_BASEDIR, nc_file)
+
+
+def l3_dependencies(start_datetime, end_datetime, time_agg, checksum=False,
+                    l2_data_dependencies=None):
+    """
+    Everything an L3 file depends on: the L2 files (and the deployments they
+    were read through) of each station, plus the L3 version and the
+    definitions that shape the output.
+
+    The L2 files are globbed from start_datetime - time_agg, so a file
+    reprocessed for day D also appears in the dependencies of day D + 1 and
+    both days are picked up by a rebuild.
+
+    Parameters
+    ----------
+    l2_data_dependencies : dict, optional
+        {instrument_serial: dependencies} of the L2 passed as l2_data (made
+        in memory, e.g. the RAW files of pipeline.py), recorded instead of
+        the L2 files of those instruments, which may be stale or missing
+
+    Returns
+    -------
+    dict that is JSON serialisable and stable between runs
+    """
+    l2_data_dependencies = l2_data_dependencies or {}
+    inputs = {}
+    for station_code in deployment_calendar().station_codes:
+        d = get_station_deployment(station_code, start_datetime, end_datetime)
+        if d is None:
+            continue
+        station_inputs = {
+            "instrument_serial": d.instrument_serial,
+            "instrument_type": d.instrument_type,
+            "above_sea_level_m": d.above_sea_level_m,
+            "l2_version": l2_versions[d.instrument_type],
+        }
+        if d.instrument_serial in l2_data_dependencies:
+            station_inputs["l2_data"] = \
+                l2_data_dependencies[d.instrument_serial]
+            inputs[station_code] = station_inputs
+            continue
+        filenames = find_l2_files(d, start_datetime, end_datetime, time_agg)
+        if not filenames:
+            continue
+        station_inputs["files"] = [harmonise.file_fingerprint(
+            f, basedir=input_dir, checksum=checksum) for f in filenames]
+        inputs[station_code] = station_inputs
+
+    definitions = {
+        "processing_version_L3": str(__version__),
+        "processing_version_L2": l2_versions,
+        "min_altitude": harmonise.MIN_ALTITUDE,
+        "max_altitude": harmonise.MAX_ALTITUDE,
+        "res_altitude": harmonise.RES_ALTITUDE,
+        "z_chunk_levels": harmonise.Z_CHUNK_LEVELS,
+        "time_agg": time_agg,
+        "stations": get_stations(),
+    }
+
+    # round trip through json so that e.g. numpy ints compare equal to
+    # what is read back from the file attributes
+    return json.loads(json.dumps(
+        {"definitions": definitions, "inputs": inputs},
+        sort_keys=True, default=str))
+
+
+def read_l3_dependencies(nc_file_full):
+    import xarray as xr
+    if not os.path.exists(nc_file_full):
+        return None
+    try:
+        with xr.open_dataset(nc_file_full) as dat:
+            dependencies = dat.attrs.get("processing_dependencies")
+    except Exception as e:
+        logging.warning(f"Could not read dependencies from {nc_file_full}: {e}")
+        return None
+    if dependencies is None:
+        return None
+
+    return json.loads(dependencies)
+
+
+def needs_rebuild(start_datetime, end_datetime, time_agg, checksum=False,
+                  dependencies=None):
+    if dependencies is None:
+        dependencies = l3_dependencies(
+            start_datetime, end_datetime, time_agg, checksum=checksum)
+    nc_file_full = l3_filename(start_datetime, end_datetime, time_agg)
+    previous_dependencies = read_l3_dependencies(nc_file_full)
+    if previous_dependencies is None:
+        return bool(dependencies["inputs"])
+    if previous_dependencies == dependencies:
+        return False
+    changed = [
+        station for station in set(previous_dependencies["inputs"]) |
+        set(dependencies["inputs"])
+        if previous_dependencies["inputs"].get(station) !=
+        dependencies["inputs"].get(station)
+    ]
+    logging.info(f"{nc_file_full} out of date. Changed inputs: {changed}")
+    return True
+
+
+def harmonise_station_altitude(dat, d, trim=True):
+    """
+    L2 data of one station deployment d on the harmonised altitude grid, with
+    trim only on the levels up to its valid top (see harmonise.z_resample).
+    """
+    dat = harmonise.sea_level_adjust(
+        dat, d.above_sea_level_m)
+    dat = harmonise.z_resample(
+        dat, harmonise.MIN_ALTITUDE, harmonise.MAX_ALTITUDE,
+        harmonise.RES_ALTITUDE, trim=trim)
+
+    return dat
+
+
+def harmonise_station_time(dat, d, time_agg):
+    """
+    Altitude harmonised data of deployment d on the L3 time grid. Only the
+    levels up to the valid top are computed, the levels above are missing
+    (see full_levels).
+    """
+    dat = harmonise.time_resample(dat, time_agg)
+    dat = valid_levels(dat)
+    ws, wd = harmonise.vector_to_ws_wd_xr(dat.u, dat.v)
+    dat = full_levels(dat.assign(ws=ws, wd=wd))
+    # inappropriate if multiple system IDs in one file interval
+    # regardless, an exception for that is raised earlier
+    dat = harmonise.add_system_id_var(dat, d.instrument_serial)
+    dat = dat.expand_dims(dim="station").assign_coords(
+        station=("station", [d.station_code]))
+
+    return dat
+
+
+def valid_levels(dat):
+    """
+    The levels of one station on the L3 grid up to its valid top
+    (harmonise.valid_top). Above it there are no samples, only 0 % flags,
+    and the L3 is missing. A station without data at any level (a NaN top)
+    has no valid levels.
+    """
+    top = harmonise.valid_top(dat).item()
+    if np.isnan(top):
+        return dat.isel(altitude=slice(0, 0))
+
+    return dat.isel(altitude=np.flatnonzero(dat.altitude.values <= top))
+
+
+def full_levels(dat, altitude=None):
+    """
+    valid_levels of one station back on the full L3 altitude grid (or
+    altitude). The levels added are missing, except for the flag_*
+    percentages (L3_fun "pc"), which are 0 % there as time_resample gives for
+    levels without samples.
+    """
+    if altitude is None:
+        altitude = harmonise.z_levels(
+            harmonise.MIN_ALTITUDE, harmonise.MAX_ALTITUDE,
+            harmonise.RES_ALTITUDE)
+    pc_vars = {
+        vardef.name: dat[vardef.name].dtype
+        for vardef in harmonise.vardim_registry.aggregated(level=3)
+        if vardef.L3_fun == "pc" and vardef.name in dat.data_vars}
+    dat = dat.reindex(altitude=altitude,
+                      fill_value={name: 0 for name in pc_vars})
+
+    # reindexing from no levels gives integer zeros
+    return dat.assign({name: dat[name].astype(dtype)
+                       for name, dtype in pc_vars.items()})
+
+
+def add_valid_top(dat):
+    """The highest level with data of each station as altitude_valid_top."""
+    dat["altitude_valid_top"] = harmonise.valid_top(
+        dat, keep_dims=["station"])
+    dat["altitude_valid_top"].attrs = dict(
+        harmonise.vardim_registry.get("altitude_valid_top", 3).attrs)
+
+    return dat
+
+
+def harmonise_station(dat, d, time_agg):
+    """L2 data of one station deployment d on the harmonised L3 grid."""
+    dat = harmonise_station_altitude(dat, d)
+    return harmonise_station_time(dat, d, time_agg)
+
+
+def assemble_l3(dat_list, time_agg):
+    """Combine harmonised stations into the L3 dataset (without global attrs)."""
+    import xarray as xr
+    dat_out = xr.merge(dat_list)
+    # add meta data for station dimension (var(station))
+    dat_out = dat_out.merge(xr.Dataset.from_dataframe(stations_table()))
+    dat_out = add_valid_top(dat_out)
+    dat_out = harmonise.apply_attrs(dat_out, level=3)
+    dat_out.time.attrs["comment"] = dat_out.time.attrs["comment"].format(
+        time_window_s=time_agg)
+
+    return dat_out
+
+
+def l3_attrs(start_datetime, end_datetime, time_agg, dependencies):
+    """The L3 global attributes, dependencies from l3_dependencies."""
+    return {
+        "title": "Harmonised boundary layer wind profile dataset from six ground-based doppler wind lidars in a transectacross Paris, France",
+        "creator_name": "William Morrison (william.morrison@meteo.uni-freiburg.de, williamtjmorrison@gmail.com)",
+        "creator_institution": "Environmental Meteorology, Institute of Earth and Environmental Sciences, Faculty of Environment and Natural Resources, University of Freiburg, Freiburg, 79085, Germany",
+        "principal_investigator": "Andreas Christen (andreas.christen@meteo.uni-freiburg.de)",
+        "paper_doi": f"{paper_doi}",
+        "metadata_doi": f"{metadata_doi}",
+        "data_doi": f"{data_doi}",
+        "processing_level": "L3",
+        "processing_level_description": f"Level 3 (L3): Raw observed data files are converted to L1. QAQC applied at L2. Individual files combined and harmonised at L3.",
+        "processing_name": "L2_to_L3.py",
+        "processing_version_L3": str(__version__),
+        "processing_version_L2": str(l2_versions),
+        "processing_url": "https://github.com/willmorrison1/paris-harmonised-dwl, https://github.com/Urban-Meteorology-Reading/paris-harmonised-dwl",
+        "processing_time_utc": dt.datetime.now(tz=dt.timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+        "processing_dependencies": json.dumps(dependencies, sort_keys=True),
+        "start_time_utc": start_datetime,
+        "end_time_utc": end_datetime,
+        "aggregation_time_s": time_agg,
+    }
+
+
+def write_l3(dat_out, start_datetime, end_datetime, time_agg):
+    nc_file_full = l3_filename(start_datetime, end_datetime, time_agg)
+    logging.info(nc_file_full)
+    # the levels above the valid top of each station are not stored
+    harmonise.to_netcdf_trimmed(
+        dat_out, nc_file_full,
+        encoding=harmonise.encode_nc_compression(dat_out, level=3))
+
+    return nc_file_full
+
+
+def _read_l2_block(filename, start_index, end_index):
+    import xarray as xr
+    with xr.open_dataset(filename) as src:
+        return src.isel(time=slice(start_index, end_index)).load()
+
+
+@lru_cache(maxsize=256)
+def _l2_time_index(filename, mtime):
+    import xarray as xr
+    with xr.open_dataset(filename) as src:
+        return src.indexes["time"], str(src.attrs['production_version'])
+
+
+def l2_time_index(filename):
+    """The time index and production version of an L2 file (only the time
+    variable is read, once per file version)."""
+    return _l2_time_index(filename, os.path.getmtime(filename))
+
+
+class L2SliceCache:
+    """
+    The time slices of L2 files read last, so that the L3 files of the other
+    aggregations of a day, and of the next day (the look-back into the
+    previous day's file), reuse them instead of reading the files again. At
+    most max_bytes are kept, least recently used files dropped first.
+    """
+
+    def __init__(self, max_bytes=L2_SLICE_CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self._slices = OrderedDict()  # filename: (mtime, start, end, dat)
+        self._lock = threading.Lock()
+
+    def get(self, filename, start_index, end_index):
+        """Rows start_index:end_index of an L2 file, loaded."""
+        mtime = os.path.getmtime(filename)
+        with self._lock:
+            cached = self._slices.get(filename)
+            if cached is not None and cached[0] == mtime and \
+                    cached[1] <= start_index and end_index <= cached[2]:
+                self._slices.move_to_end(filename)
+                return cached[3].isel(time=slice(
+                    start_index - cached[1], end_index - cached[1]))
+        dat = _read_l2_block(filename, start_index, end_index)
+        with self._lock:
+            self._slices.pop(filename, None)
+            if dat.nbytes <= self.max_bytes:
+                self._slices[filename] = (mtime, start_index, end_index, dat)
+            while sum(cached[3].nbytes for cached in
+                      self._slices.values()) > self.max_bytes:
+                self._slices.popitem(last=False)
 
-for i in range(0, len(datetime_range)-1):
+        return dat
+
+    def clear(self):
+        with self._lock:
+            self._slices.clear()
+
+
+l2_slice_cache = L2SliceCache()
+
+
+def read_l2(d, start_datetime, end_datetime, time_agg):
+    """
+    The L2 of deployment d between start_datetime and end_datetime (both
+    included), loaded. Only those rows are read from each L2 file (e.g. the
+    last minutes of the previous day's file), through l2_slice_cache. None if
+    there are no files or no data in the interval.
+    """
+    import xarray as xr
+    start_datetime_dt = dt.datetime.fromisoformat(start_datetime)
+    end_datetime_dt = dt.datetime.fromisoformat(end_datetime)
+    l2_version = l2_versions[d.instrument_type]
+    slices = []
+    for filename in find_l2_files(d, start_datetime, end_datetime, time_agg):
+        times, production_version = l2_time_index(filename)
+        if not production_version == str(l2_version):
+            raise ValueError("Product version mismatch")
+        start_index = times.searchsorted(start_datetime_dt, side="left")
+        end_index = times.searchsorted(end_datetime_dt, side="right")
+        if start_index < end_index:
+            slices.append(
+                l2_slice_cache.get(filename, start_index, end_index))
+    if not slices:
+        return None
+    if len(slices) == 1:
+        return slices[0]
+    return xr.concat(slices, dim="time")
+
+
+def station_l2(d, start_datetime, end_datetime, time_agg, l2_data=None):
+    """
+    L2 data of deployment d between start_datetime and end_datetime, from
+    l2_data if it has the instrument, otherwise from the L2 files. None if
+    there is no data.
+    """
+    l2_data = l2_data or {}
+    start_datetime_dt = dt.datetime.fromisoformat(start_datetime)
+    end_datetime_dt = dt.datetime.fromisoformat(end_datetime)
+    station_code = d.station_code
+
+    l2_version = l2_versions[d.instrument_type]
+    if d.instrument_serial in l2_data:
+        dat = l2_data[d.instrument_serial]
+    else:
+        dat = read_l2(d, start_datetime, end_datetime, time_agg)
+
+    if dat is None:
+        logging.info(
+            f"{station_code}({d.instrument_serial}) "
+            f"{start_datetime_dt.strftime('%Y%m%d %H')}->"
+            f"{end_datetime_dt.strftime('%Y%m%d %H')} no files found"
+        )
+        return None
+    if not str(dat.attrs['production_version']) == str(l2_version):
+        raise ValueError("Product version mismatch")
+    dat = dat.sel(time=slice(start_datetime_dt, end_datetime_dt))
+    if len(dat.time) == 0:
+        logging.info(
+            f"{station_code}({d.instrument_serial}) "
+            f"{start_datetime.strip(' 00:00:00')} -> "
+            f"{end_datetime.strip(' 00:00:00')} no files found"
+        )
+        return None
+
+    return dat
+
+
+def l2_to_l3(start_datetime, end_datetime, time_agg, checksum=False,
+             l2_data=None, dependencies=None):
+    """
+    Write the L3 file of one time interval and aggregation.
+
+    Parameters
+    ----------
+    l2_data : dict
+        {instrument_serial: L2 xr.Dataset} to use instead of the L2 files of
+        those instruments, e.g. produced in memory by pipeline.py. Other
+        instruments are read from their L2 files.
+    dependencies : dict
+        l3_dependencies of the interval if already known, so that the L2 files
+        are not fingerprinted again.
+
+    Returns
+    -------
+    the L3 filename, None if nothing was written
+    """
+    dat_out = build_l3(
+        l3_inputs(start_datetime, end_datetime, time_agg, l2_data=l2_data),
+        start_datetime, end_datetime, time_agg, checksum=checksum,
+        dependencies=dependencies)
+    if dat_out is None:
+        return
+
+    return write_l3(dat_out, start_datetime, end_datetime, time_agg)
+
+
+def l3_inputs(start_datetime, end_datetime, time_agg, l2_data=None):
+    """
+    The harmonised L2 of every station with data in the interval, loaded
+    (the read stage of l2_to_l3).
+    """
+    dat_list = []
+    for station_code in deployment_calendar().station_codes:
+        d = get_station_deployment(station_code, start_datetime, end_datetime)
+
+        if d is None:
+            logging.debug(
+                f"No deployment for {station_code} "
+                f"{start_datetime} - {end_datetime}"
+            )
+            continue
+
+        dat = station_l2(d, start_datetime, end_datetime, time_agg,
+                         l2_data=l2_data)
+        if dat is None:
+            continue
+        dat = harmonise_station(dat, d, time_agg)
+        dat_list.append(dat.load())
+
+    return dat_list
+
+
+def build_l3(dat_list, start_datetime, end_datetime, time_agg,
+             checksum=False, dependencies=None):
+    """The L3 dataset from l3_inputs, None if there are none."""
+    if not dat_list:
+        return None
+    if dependencies is None:
+        dependencies = l3_dependencies(
+            start_datetime, end_datetime, time_agg, checksum=checksum)
+    dat_out = assemble_l3(dat_list, time_agg)
+    dat_out.attrs = l3_attrs(
+        start_datetime, end_datetime, time_agg, dependencies)
+
+    return dat_out
+
+
+def lazy_block_steps(dat, chunk_size):
+    """
+    Time steps per block of the lazy L3 graph so that the profiles of dat on
+    the 1 m altitude grid of z_resample fit in chunk_size bytes.
+    """
+    n_levels = harmonise.MAX_ALTITUDE - harmonise.MIN_ALTITUDE
+    n_profile_vars = max(1, sum(
+        "height" in dat[var].dims for var in dat.data_vars))
+    return max(1, int(chunk_size // (8 * n_levels * n_profile_vars)))
+
+
+def l2_blocks(d, start_datetime, end_datetime, time_agg,
+              chunk_size=LAZY_CHUNK_SIZE, l2_data=None):
+    """
+    The data of station_l2 as delayed time blocks (see lazy_block_steps), in
+    time order. L2 files are only read when a block is computed.
+    """
+    import dask
+    import xarray as xr
+    l2_data = l2_data or {}
+    start_datetime_dt = dt.datetime.fromisoformat(start_datetime)
+    end_datetime_dt = dt.datetime.fromisoformat(end_datetime)
+    l2_version = l2_versions[d.instrument_type]
+
+    if d.instrument_serial in l2_data:
+        dat = station_l2(d, start_datetime, end_datetime, time_agg,
+                         l2_data=l2_data)
+        if dat is None:
+            return []
+        block_steps = lazy_block_steps(dat, chunk_size)
+        return [dask.delayed(dat.isel(time=slice(i, i + block_steps)))
+                for i in range(0, dat.sizes["time"], block_steps)]
+
+    blocks = []
+    for filename in find_l2_files(d, start_datetime, end_datetime, time_agg):
+        times, production_version = l2_time_index(filename)
+        if not production_version == str(l2_version):
+            raise ValueError("Product version mismatch")
+        with xr.open_dataset(filename) as src:
+            block_steps = lazy_block_steps(src, chunk_size)
+        start_index = times.searchsorted(start_datetime_dt, side="left")
+        end_index = times.searchsorted(end_datetime_dt, side="right")
+        blocks.extend(
+            dask.delayed(_read_l2_block)(
+                filename, i, min(i + block_steps, end_index))
+            for i in range(start_index, end_index, block_steps))
+    if not blocks:
+        logging.info(
+            f"{d.station_code}({d.instrument_serial}) "
+            f"{start_datetime_dt.strftime('%Y%m%d %H')}->"
+            f"{end_datetime_dt.strftime('%Y%m%d %H')} no files found"
+        )
+
+    return blocks
+
+
+@contextmanager
+def dask_scheduler(scheduler="threads", n_workers=None):
+    """
+    The dask scheduler for l2_to_l3_lazy: threads, processes, synchronous,
+    or distributed for a LocalCluster (needs dask.distributed).
+    """
+    if scheduler == "distributed":
+        from dask.distributed import Client, LocalCluster
+        with LocalCluster(n_workers=n_workers) as cluster, \
+                Client(cluster) as client:
+            logging.info(f"dask dashboard {client.dashboard_link}")
+            yield
+    else:
+        import dask
+        with dask.config.set(scheduler=scheduler, num_workers=n_workers):
+            yield
+
+
+def l2_to_l3_lazy(start_datetime, end_datetime, time_aggs=time_aggs,
+                  checksum=False, l2_data=None, chunk_size=LAZY_CHUNK_SIZE,
+                  dependencies=None):
+    """
+    Write the L3 files of all time_aggs of one time interval from a single
+    dask graph over all stations, computed on the current dask scheduler
+    (see dask_scheduler). The output is that of l2_to_l3.
+
+    The L2 of each station is read and put on the altitude grid in time
+    blocks (z_resample works profile by profile) that bound the memory, then
+    put on the time grid of each aggregation, once the blocks are combined.
+    dependencies is {time_agg: l3_dependencies} of those already known.
+
+    Returns
+    -------
+    list of the L3 filenames written
+    """
+    import dask
+    import xarray as xr
+    look_back = max(time_aggs)
+    stations_altitude = []
+    for station_code in deployment_calendar().station_codes:
+        d = get_station_deployment(station_code, start_datetime, end_datetime)
+        if d is None:
+            continue
+        blocks = l2_blocks(d, start_datetime, end_datetime, look_back,
+                           chunk_size=chunk_size, l2_data=l2_data)
+        if not blocks:
+            continue
+        blocks = [dask.delayed(harmonise_station_altitude)(block, d)
+                  for block in blocks]
+        stations_altitude.append(
+            (d, dask.delayed(xr.concat)(blocks, dim="time")))
+    if not stations_altitude:
+        return []
+
+    dat_outs = [
+        dask.delayed(assemble_l3)(
+            [dask.delayed(harmonise_station_time)(dat, d, time_agg)
+             for d, dat in stations_altitude], time_agg)
+        for time_agg in time_aggs]
+    dat_outs = dask.compute(*dat_outs)
+
+    dependencies = dependencies or {}
+    written = []
+    for time_agg, dat_out in zip(time_aggs, dat_outs):
+        if time_agg not in dependencies:
+            dependencies[time_agg] = l3_dependencies(
+                start_datetime, end_datetime, time_agg, checksum=checksum)
+        dat_out.attrs = l3_attrs(
+            start_datetime, end_datetime, time_agg, dependencies[time_agg])
+        written.append(write_l3(dat_out, start_datetime, end_datetime,
+                                time_agg))
+
+    return written
+
+
+def setup_logging(log_file):
+    logging.basicConfig(
+        filename=log_file,
+        filemode='a',
+        format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
+        datefmt='%H:%M:%S',
+        level=logging.INFO)
+
+
+def process_unit(start_datetime, end_datetime, time_agg, rebuild=False,
+                 checksum=False, tracker=None, l2_data=None,
+                 l2_data_dependencies=None):
+    """
+    One L3 file, skipped if up to date when rebuilding. Errors are logged, not
+    raised, so that one bad day does not stop the others. l2_data_dependencies
+    are those of l2_data, see l3_dependencies.
+
+    Returns
+    -------
+    the L3 filename if it was written, else None
+    """
+    if tracker is None:
+        tracker = memtrack.MemoryTracker(enabled=False)
     try:
-        for time_agg in time_aggs:
-
-            start_datetime = str(datetime_range[i])
-            end_datetime = str(datetime_range[i+1])
-            start_datetime_dt = dt.datetime.fromisoformat(start_datetime)
-            end_datetime_dt = dt.datetime.fromisoformat(end_datetime)
-            dat_list = []
-            for station_code in station_codes:
-                # find the deployment with matching station code and dates
-                d = deployments_df[
-                    (deployments_df.station_code == station_code) &
-                    (start_datetime <= deployments_df.end_datetime) &
-                    (end_datetime >= deployments_df.start_datetime)
-                ]
-
-                if d.shape[0] > 1:
-                    logging.warning(
-                        "Concurrent station deployments")
-                    # raise ValueError(
-                    #     "Figure out how to handle concurrent station deployments")
-                    d = d[1:2]
-
-                if d.shape[0] == 0:
-                    logging.debug(
-                        f"No deployment for {station_code} "
-                        f"{start_datetime} - {end_datetime}"
-                    )
-                    continue
-
-                filenames = []
-                # be certain that we load all the aggregation period data
-                date_from = dt.datetime.fromisoformat(
-                    start_datetime) - dt.timedelta(seconds=time_agg)
-                date_to = dt.datetime.fromisoformat(end_datetime)
-                l2_version = l2_versions[d.instrument_type.item()]
-
-                for date in pd.date_range(date_from, date_to):
-                    date_string = date.strftime("%Y%m%d")
-                    glob_str = f"*{l2_version}_{date_string}*{d.instrument_serial.item()}*.nc"
-                    files_glob = os.path.join(
-                        input_dir, d.instrument_serial.item(), glob_str)
-                    filenames.extend(glob.glob(files_glob))
-
-                if len(filenames) == 0:
-                    logging.info(
-                        f"{station_code}({d.instrument_serial.item()}) "
-                        f"{start_datetime_dt.strftime('%Y%m%d %H')}->"
-                        f"{end_datetime_dt.strftime('%Y%m%d %H')} no files found"
-                    )
-                    continue
-                dat = xr.open_mfdataset(filenames)
-                if not str(dat.attrs['production_version']) == str(l2_version):
-                    raise ValueError("Product version mismatch")
-                dat = dat.sel(time=slice(start_datetime_dt, end_datetime_dt))
-                if len(dat.time) == 0:
-                    logging.info(
-                        f"{station_code}({d.instrument_serial.item()}) "
-                        f"{start_datetime.strip(' 00:00:00')} -> "
-                        f"{end_datetime.strip(' 00:00:00')} no files found"
-                    )
-                    continue
-                dat = harmonise.sea_level_adjust(
-                    dat, d.above_sea_level_m.item())
-                dat = harmonise.z_resample(
-                    dat, harmonise.MIN_ALTITUDE, harmonise.MAX_ALTITUDE,
-                    harmonise.RES_ALTITUDE)
-                dat = harmonise.time_resample(dat, time_agg)
-                ws, wd = harmonise.vector_to_ws_wd(dat.u.values, dat.v.values)
-                dat = dat.assign(ws=(["time", "altitude"], ws),
-                                 wd=(["time", "altitude"], wd))
-                # inappropriate if multiple system IDs in one file interval
-                # regardless, an exception for that is raised earlier
-                dat = harmonise.add_system_id_var(dat, d.instrument_serial.item())
-                dat = dat.expand_dims(dim="station").assign_coords(
-                    station=("station", [station_code]))
-                dat_list.append(dat.load())
-            if not dat_list:
-                continue
-
-            dat_out = xr.merge(dat_list)
-            # add meta data for station dimension (var(station))
-            dat_out = dat_out.merge(xr.Dataset.from_dataframe(stations_df))
-            dat_out = harmonise.apply_attrs(dat_out, level=3)
-            dat_out.time.attrs["comment"] = dat_out.time.attrs["comment"].format(
-                time_window_s=time_agg)
-
-            attrs = {
-                "title": "Harmonised boundary layer wind profile dataset from six ground-based doppler wind lidars in a transectacross Paris, France",
-                "creator_name": "William Morrison (william.morrison@meteo.uni-freiburg.de, williamtjmorrison@gmail.com)",
-                "creator_institution": "Environmental Meteorology, Institute of Earth and Environmental Sciences, Faculty of Environment and Natural Resources, University of Freiburg, Freiburg, 79085, Germany",
-                "principal_investigator": "Andreas Christen (andreas.christen@meteo.uni-freiburg.de)",
-                "paper_doi": f"{paper_doi}",
-                "metadata_doi": f"{metadata_doi}",
-                "data_doi": f"{data_doi}",
-                "processing_level": "L3",
-                "processing_level_description": f"Level 3 (L3): Raw observed data files are converted to L1. QAQC applied at L2. Individual files combined and harmonised at L3.",
-                "processing_name": "L2_to_L3.py",
-                "processing_version_L3": str(__version__),
-                "processing_version_L2": str(l2_versions),
-                "processing_url": "https://github.com/willmorrison1/paris-harmonised-dwl, https://github.com/Urban-Meteorology-Reading/paris-harmonised-dwl",
-                "processing_time_utc": dt.datetime.now(tz=dt.timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
-                "start_time_utc": start_datetime,
-                "end_time_utc": end_datetime,
-                "aggregation_time_s": time_agg,
-            }
-
-            dat_out.attrs = attrs
-
-            nc_file = "{product_name}V{version}_{start_time}_{end_time}_{time_agg}s.nc".format(
-                product_name=product_name,
-                start_time=start_datetime_dt.strftime("%Y%m%d%H%M"),
-                end_time=end_datetime_dt.strftime("%Y%m%d%H%M"),
-                time_agg=time_agg,
-                version=__version__)
-            nc_file_full = os.path.join(harmonise.L3_BASEDIR, nc_file)
-            logging.info(nc_file_full)
-            dat_out.to_netcdf(path=nc_file_full,
-                              encoding=harmonise.encode_nc_compression(dat_out))
+        dependencies = l3_dependencies(
+            start_datetime, end_datetime, time_agg, checksum=checksum,
+            l2_data_dependencies=l2_data_dependencies)
+        if rebuild and not needs_rebuild(
+                start_datetime, end_datetime, time_agg,
+                dependencies=dependencies):
+            logging.debug(
+                f"{start_datetime} - {end_datetime} {time_agg}s up to date")
+            return None
+        with tracker.track("l2_to_l3", f"{start_datetime} {time_agg}s"):
+            return l2_to_l3(start_datetime, end_datetime, time_agg,
+                            l2_data=l2_data, dependencies=dependencies)
+    except Exception as e:
+        logging.error(f"{e} error for {start_datetime} - {end_datetime}")
+        return None
+
 
+def process_interval_lazy(start_datetime, end_datetime, rebuild=False,
+                          checksum=False, tracker=None, l2_data=None,
+                          chunk_size=LAZY_CHUNK_SIZE,
+                          l2_data_dependencies=None):
+    """
+    process_unit for all aggregations of one interval at once with
+    l2_to_l3_lazy. Run it within dask_scheduler.
+
+    Returns
+    -------
+    list of the L3 filenames written
+    """
+    if tracker is None:
+        tracker = memtrack.MemoryTracker(enabled=False)
+    try:
+        dependencies = {
+            time_agg: l3_dependencies(
+                start_datetime, end_datetime, time_agg, checksum=checksum,
+                l2_data_dependencies=l2_data_dependencies)
+            for time_agg in time_aggs}
+        interval_time_aggs = [
+            time_agg for time_agg in time_aggs
+            if not rebuild or needs_rebuild(
+                start_datetime, end_datetime, time_agg,
+                dependencies=dependencies[time_agg])]
+        if not interval_time_aggs:
+            logging.debug(f"{start_datetime} - {end_datetime} up to date")
+            return []
+        with tracker.track("l2_to_l3_lazy", start_datetime):
+            return l2_to_l3_lazy(
+                start_datetime, end_datetime, interval_time_aggs,
+                checksum=checksum, l2_data=l2_data, chunk_size=chunk_size,
+                dependencies=dependencies)
     except Exception as e:
         logging.error(f"{e} error for {start_datetime} - {end_datetime}")
-        continue
+        return []
+
+
+def _process_unit_worker(unit, rebuild, checksum, track_memory,
+                         trace_allocations):
+    tracker = memtrack.MemoryTracker(
+        enabled=track_memory, trace_allocations=trace_allocations)
+    nc_file = process_unit(*unit, rebuild=rebuild, checksum=checksum,
+                           tracker=tracker)
+    return nc_file, tracker.records
+
+
+def process_units_pipelined(units, rebuild=False, checksum=False,
+                            tracker=None, read_ahead=1, writers=1):
+    """
+    process_unit for each unit in sequence, the L2 of the next units read
+    ahead and the L3 files written behind (see iopipe.pipelined).
+
+    Yields
+    ------
+    the L3 filename of each unit if it was written, else None
+    """
+    if tracker is None:
+        tracker = memtrack.MemoryTracker(enabled=False)
+
+    def read_unit(unit):
+        dependencies = l3_dependencies(*unit, checksum=checksum)
+        if rebuild and not needs_rebuild(*unit, dependencies=dependencies):
+            logging.debug(f"{unit[0]} - {unit[1]} {unit[2]}s up to date")
+            return None
+        dat_list = l3_inputs(*unit)
+        if not dat_list:
+            return None
+        return dat_list, dependencies
+
+    def compute_unit(unit, data):
+        dat_list, dependencies = data
+        with tracker.track("l2_to_l3", f"{unit[0]} {unit[2]}s"):
+            return build_l3(dat_list, *unit, dependencies=dependencies)
+
+    for unit, nc_file in iopipe.pipelined(
+            units, read_unit, lambda unit, dat_out: write_l3(dat_out, *unit),
+            compute_unit, read_ahead=read_ahead, writers=writers,
+            describe=lambda unit: f"{unit[0]} - {unit[1]}"):
+        yield nc_file
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Produce L3 from L2 files.")
+    parser.add_argument("-s", "--startdate",
+                        help="Start datetime in ISO format",
+                        default=start_datetime_full)
+    parser.add_argument("-e", "--enddate",
+                        help="End datetime in ISO format",
+                        default=end_datetime_full)
+    parser.add_argument("--rebuild", action="store_true",
+                        help="Only regenerate the L3 files whose L2 inputs, "
+                        "version or definitions have changed")
+    parser.add_argument("--checksum", action="store_true",
+                        help="Track L2 inputs by sha256 instead of mtime")
+    parser.add_argument("-w", "--workers", type=int,
+                        help="Number of L3 files to process in parallel. "
+                        "Default 1, or as many as fit in --memory-budget. "
+                        "With --lazy the number of dask workers")
+    parser.add_argument("--lazy", action="store_true",
+                        help="Compute all stations and aggregations of a day "
+                        "as one dask graph")
+    parser.add_argument("--scheduler", default="threads",
+                        choices=["threads", "processes", "synchronous",
+                                 "distributed"],
+                        help="dask scheduler for --lazy. distributed starts "
+                        "a LocalCluster")
+    parser.add_argument("--chunk-size", type=memtrack.parse_size,
+                        help="Bytes per dask block for --lazy, default "
+                        f"{memtrack.format_size(LAZY_CHUNK_SIZE)} or "
+                        "--memory-budget shared between the workers")
+    parser.add_argument("--memory-budget", type=memtrack.memory_budget,
+                        help="Memory for all workers together, e.g. 16G, or "
+                        "auto for the memory available now. The first file "
+                        "is processed alone to measure its peak memory and "
+                        "the worker count chosen from that")
+    parser.add_argument("--track-memory", action="store_true",
+                        help="Log the peak memory of every L3 file")
+    parser.add_argument("--trace-allocations", action="store_true",
+                        help="Also log the largest allocations (slow)")
+    parser.add_argument("--memory-log",
+                        help="Append the memory records to this JSON lines "
+                        "file")
+    parser.add_argument("--read-ahead", type=int, default=1,
+                        help="Without workers, L3 files whose L2 is read "
+                        "ahead of the one processed, 0 to read in sequence")
+    parser.add_argument("--writers", type=int, default=1,
+                        help="Without workers, threads writing L3 files "
+                        "behind the processing, 0 to write in sequence")
+    parser.add_argument("--quicklook", action="store_true",
+                        help="Update the quicklook pyramid with every L3 "
+                        "file written")
+    args = parser.parse_args()
+
+    log_file = os.path.join(
+        log_dir, f"{dt.datetime.utcnow().strftime('%Y%m%d%H%M%S')}.log")
+    setup_logging(log_file)
+
+    logging.info(f"L2_to_L3.py program version {__version__}")
+    logging.info(f"Command line arguments {args}")
+
+    import pandas as pd
+    datetime_range = pd.date_range(
+        args.startdate, args.enddate, freq=file_freq)
+    units = [(str(datetime_range[i]), str(datetime_range[i+1]), time_agg)
+             for i in range(0, len(datetime_range)-1)
+             for time_agg in time_aggs]
+
+    track_memory = args.track_memory or args.trace_allocations
+    tracker = memtrack.MemoryTracker(
+        enabled=track_memory or args.memory_budget is not None,
+        trace_allocations=args.trace_allocations, log_file=args.memory_log)
+    unit_kwargs = {"rebuild": args.rebuild, "checksum": args.checksum}
+
+    def written_files(nc_files):
+        # quicklooks are updated here only, never from two workers at once
+        nc_files = [nc_file for nc_file in nc_files if nc_file is not None]
+        if args.quicklook and nc_files:
+            import quicklook
+            quicklook.update(nc_files)
+
+    if args.lazy:
+        chunk_size = args.chunk_size or LAZY_CHUNK_SIZE
+        if args.chunk_size is None and args.memory_budget is not None:
+            n_dask_workers = args.workers or os.cpu_count() or 1
+            chunk_size = max(
+                args.memory_budget - (memtrack.current_rss() or 0), 0) // (
+                n_dask_workers * LAZY_CHUNKS_PER_WORKER)
+        logging.info(f"dask blocks of {memtrack.format_size(chunk_size)}")
+        with dask_scheduler(args.scheduler, args.workers):
+            for i in range(0, len(datetime_range)-1):
+                written_files(process_interval_lazy(
+                    str(datetime_range[i]), str(datetime_range[i+1]),
+                    tracker=tracker, chunk_size=chunk_size, **unit_kwargs))
+        if tracker.records:
+            logging.info(f"Memory summary {tracker.summary()}")
+        return
+
+    n_workers = args.workers or 1
+    if args.memory_budget is not None:
+        # measure a real unit here before packing the rest into the budget
+        written = None
+        while units and written is None:
+            written = process_unit(*units.pop(0), tracker=tracker,
+                                   **unit_kwargs)
+            written_files([written])
+        n_workers = memtrack.worker_count(
+            args.memory_budget - (memtrack.current_rss() or 0),
+            tracker.peak("l2_to_l3"), max_workers=args.workers)
+        logging.info(
+            f"{n_workers} workers for a memory budget of "
+            f"{memtrack.format_size(args.memory_budget)} and "
+            f"{memtrack.format_size(tracker.peak('l2_to_l3'))} per L3 file")
+
+    if n_workers <= 1 or len(units) <= 1:
+        for nc_file in process_units_pipelined(
+                units, tracker=tracker, read_ahead=args.read_ahead,
+                writers=args.writers, **unit_kwargs):
+            written_files([nc_file])
+    else:
+        # spawn (the only option on Windows): forked workers can deadlock on
+        # the dask and HDF5 locks held by this process
+        with ProcessPoolExecutor(
+                max_workers=n_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=setup_logging,
+                initargs=(log_file,)) as pool:
+            futures = [pool.submit(
+                _process_unit_worker, unit, args.rebuild, args.checksum,
+                track_memory, args.trace_allocations) for unit in units]
+            for future in as_completed(futures):
+                nc_file, records = future.result()
+                tracker.extend(records)
+                written_files([nc_file])
+
+    if tracker.records:
+        logging.info(f"Memory summary {tracker.summary()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+"""
+Data availability of the campaign at every processing level, from file
+names and NetCDF time coordinates only. RAW coverage comes from the
+timestamps in the StreamLine file names, L1 and L2 from the time coordinate
+of each file (no data variable is read) and L3 from the time coordinate of
+the finest aggregation.
+
+Coverage is counted in time bins and cross-referenced with the deployment
+windows: a day of a deployment is covered to the fraction of its deployed
+bins that have data, and runs of deployed bins without data are reported as
+missing intervals (flagged if meta/filemeta.known_missing_data explains
+them). The time bins of every NetCDF file are cached by file fingerprint,
+so repeated scans only open new or changed files.
+"""
+
+import os
+import re
+import glob
+import json
+import logging
+import argparse
+import datetime as dt
+import numpy as np
+import pandas as pd
+import netCDF4
+import xarray as xr
+import harmonise
+import L2_to_L3
+from meta import filemeta
+
+LEVELS = ["RAW", "L1", "L2", "L3"]
+# coverage resolution: RAW files (a scan every few minutes, hourly stare
+# files) are counted per hour, NetCDF time stamps per 10 min
+BIN_SECONDS = {"RAW": 3600, "L1": 600, "L2": 600, "L3": 600}
+# missing intervals shorter than this are not reported
+MIN_GAP_S = 3600
+# next to the L3 index (see l3query.py)
+CACHE_FILE = os.path.join(harmonise.L3_BASEDIR, "availability-cache.json")
+L3_STATION = "all"
+
+STRFTIME_REGEX = {"%Y": r"(?P<Y>\d{4})", "%y": r"(?P<y>\d{2})",
+                  "%m": r"(?P<m>\d{2})", "%d": r"(?P<d>\d{2})",
+                  "%H": r"(?P<H>\d{2})", "%M": r"(?P<M>\d{2})",
+                  "%S": r"(?P<S>\d{2})"}
+
+
+def pattern_regex(datetime_pattern):
+    """
+    Compiled regex for a strftime file name pattern (as in the deployments
+    raw_files), much faster than strptime over a whole archive.
+    """
+    parts = re.split(r"(%[YymdHMS])", datetime_pattern)
+    return re.compile("".join(
+        STRFTIME_REGEX.get(part, re.escape(part)) for part in parts) + "$")
+
+
+def file_name_times(file_names, datetime_pattern):
+    """datetime64[s] of the file names matching datetime_pattern."""
+    regex = pattern_regex(datetime_pattern)
+    times = []
+    for file_name in file_names:
+        match = regex.match(file_name)
+        if match is None:
+            continue
+        fields = match.groupdict()
+        year = int(fields["Y"]) if "Y" in fields else \
+            2000 + int(fields.get("y", 0))
+        times.append(dt.datetime(
+            year, int(fields.get("m", 1)), int(fields.get("d", 1)),
+            int(fields.get("H", 0)), int(fields.get("M", 0)),
+            int(fields.get("S", 0))))
+
+    return np.array(times, dtype="datetime64[s]")
+
+
+def time_bins(times, bin_seconds):
+    """Sorted unique bin numbers (since the epoch) of datetime64 times."""
+    seconds = times.astype("datetime64[s]").astype(np.int64)
+    return np.unique(seconds // bin_seconds)
+
+
+def netcdf_times(filename):
+    """The decoded time coordinate of a NetCDF file, nothing else is read."""
+    with netCDF4.Dataset(filename) as nc:
+        time = nc.variables["time"]
+        values = time[:]
+        values = np.ma.getdata(values)[~np.ma.getmaskarray(values)]
+        return xr.coding.times.decode_cf_datetime(
+            values, time.units, getattr(time, "calendar", "standard"))
+
+
+class BinCache:
+    """Time bins of NetCDF files by path, valid while the fingerprint is."""
+
+    def __init__(self, cache_file=CACHE_FILE):
+        self.cache_file = cache_file
+        self.changed = False
+        self.n_read = 0
+        try:
+            with open(cache_file) as f:
+                self.files = json.load(f)
+        except (OSError, ValueError):
+            self.files = {}
+
+    def bins(self, filename, bin_seconds):
+        fingerprint = harmonise.file_fingerprint(filename)
+        key = f"{filename}|{bin_seconds}"
+        entry = self.files.get(key)
+        if entry is not None and entry["fingerprint"] == fingerprint:
+            return np.array(entry["bins"], dtype=np.int64)
+        try:
+            bins = time_bins(netcdf_times(filename), bin_seconds)
+        except (OSError, KeyError, ValueError) as e:
+            logging.warning(f"Could not read the time of {filename}: {e}")
+            bins = np.array([], dtype=np.int64)
+        self.files[key] = {"fingerprint": fingerprint,
+                           "bins": bins.tolist()}
+        self.changed = True
+        self.n_read += 1
+
+        return bins
+
+    def save(self):
+        if not self.changed:
+            return
+        tmp_file = self.cache_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self.files, f)
+        os.replace(tmp_file, self.cache_file)
+
+
+def level_files(level, serial=None, instrument_type=None):
+    """
+    The files of a level: of one instrument serial for L1 and L2 (of the L2
+    version L2_to_L3 reads), the finest aggregation of the current L3.
+    """
+    if level == "L1":
+        return glob.glob(os.path.join(harmonise.L1_BASEDIR, serial, "*.nc"))
+    if level == "L2":
+        return glob.glob(os.path.join(
+            harmonise.L2_BASEDIR, serial,
+            f"*_V{L2_to_L3.l2_versions[instrument_type]}_*.nc"))
+    if level == "L3":
+        return glob.glob(os.path.join(
+            harmonise.L3_BASEDIR,
+            f"{L2_to_L3.product_name}V{L2_to_L3.__version__}_*_"
+            f"{min(L2_to_L3.time_aggs)}s.nc"))
+    raise ValueError(f"No files for level {level}")
+
+
+def raw_bins(deployments, bin_seconds):
+    """{serial: bins} of the StreamLine wind scan files in the archive."""
+    bins = {}
+    listings = {}
+    for d in deployments:
+        if d.instrument_type != "StreamLine":
+            continue
+        raw_dir = os.path.join(harmonise.RAW_BASEDIR, d.instrument_serial)
+        if raw_dir not in listings:
+            listings[raw_dir] = os.listdir(raw_dir) \
+                if os.path.isdir(raw_dir) else []
+        for raw_file in d.raw_files:
+            if raw_file["type"] != "wind":
+                continue
+            times = file_name_times(
+                listings[raw_dir], raw_file["datetime_pattern"].format(
+                    instrument_serial=d.instrument_serial))
+            bins[d.instrument_serial] = np.union1d(
+                bins.get(d.instrument_serial, np.array([], np.int64)),
+                time_bins(times, bin_seconds))
+
+    return bins
+
+
+def netcdf_bins(level, instrument_types, cache):
+    """{serial: bins} of the files of level, instrument_types by serial."""
+    bins = {}
+    for serial, instrument_type in instrument_types.items():
+        files = level_files(level, serial, instrument_type)
+        if files:
+            bins[serial] = np.unique(np.concatenate([
+                cache.bins(f, BIN_SECONDS[level]) for f in files]))
+
+    return bins
+
+
+def runs(bins):
+    """[(first, last + 1)] of the consecutive runs in sorted bins."""
+    if not len(bins):
+        return []
+    breaks = np.flatnonzero(np.diff(bins) != 1)
+    starts = np.concatenate([[bins[0]], bins[breaks + 1]])
+    ends = np.concatenate([bins[breaks], [bins[-1]]]) + 1
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
+def to_bin(t, bin_seconds, ceil=False):
+    seconds = int(pd.Timestamp(t).timestamp())
+    return -(-seconds // bin_seconds) if ceil else seconds // bin_seconds
+
+
+def from_bin(b, bin_seconds):
+    return pd.Timestamp(b * bin_seconds, unit="s")
+
+
+def known_missing(station_code, start, end):
+    """Whether known_missing_data covers part of [start, end) at station."""
+    for missing in filemeta.known_missing_data:
+        if missing["station_code"] == station_code and \
+                pd.Timestamp(missing["from"]) < end and \
+                pd.Timestamp(missing["to"]) > start:
+            return True
+    return False
+
+
+def coverage(level, windows, bins, bin_seconds, start, end, min_gap_s):
+    """
+    Daily coverage rows and missing intervals of one level.
+
+    Parameters
+    ----------
+    windows : list of (station_code, serial, start, end)
+        the expected data, e.g. deployment windows
+    bins : dict
+        {serial: occupied bins}
+    """
+    rows, gaps = [], []
+    for station_code, serial, w_start, w_end in windows:
+        w_start, w_end = max(w_start, start), min(w_end, end)
+        if w_start >= w_end:
+            continue
+        have = bins.get(serial, np.array([], np.int64))
+        first = to_bin(w_start, bin_seconds, ceil=True)
+        last = to_bin(w_end, bin_seconds, ceil=True)
+        expected = np.arange(first, last)
+        covered = np.isin(expected, have)
+        for day in pd.date_range(w_start.normalize(), w_end, freq="D",
+                                 inclusive="left"):
+            in_day = (expected >= to_bin(day, bin_seconds)) & \
+                (expected < to_bin(day + pd.Timedelta(days=1), bin_seconds))
+            if not in_day.any():
+                continue
+            rows.append({
+                "level": level, "station": station_code, "serial": serial,
+                "date": day.date(),
+                "coverage": round(100 * covered[in_day].mean(), 1)})
+        for gap_start, gap_end in runs(expected[~covered]):
+            if (gap_end - gap_start) * bin_seconds < min_gap_s:
+                continue
+            gap = {"level": level, "station": station_code,
+                   "serial": serial,
+                   "from": from_bin(gap_start, bin_seconds),
+                   "to": from_bin(gap_end, bin_seconds)}
+            gap["known"] = known_missing(station_code, gap["from"],
+                                         gap["to"])
+            gaps.append(gap)
+
+    return rows, gaps
+
+
+def scan(start_datetime, end_datetime, levels=LEVELS, cache_file=CACHE_FILE,
+         min_gap_s=MIN_GAP_S):
+    """
+    Availability of the campaign between start and end.
+
+    Returns
+    -------
+    coverage : pd.DataFrame
+        level, station, serial, date, coverage (% of the deployed time)
+    gaps : pd.DataFrame
+        level, station, serial, from, to, known
+    """
+    start, end = pd.Timestamp(start_datetime), pd.Timestamp(end_datetime)
+    calendar = harmonise.DeploymentCalendar.from_json()
+    deployments = calendar.active(start.to_pydatetime(), end.to_pydatetime())
+    windows = [(d.station_code, d.instrument_serial,
+                pd.Timestamp(d.start_datetime), pd.Timestamp(d.end_datetime))
+               for d in deployments]
+    instrument_types = {d.instrument_serial: d.instrument_type
+                        for d in deployments}
+    cache = BinCache(cache_file)
+
+    rows, gaps = [], []
+    for level in levels:
+        bin_seconds = BIN_SECONDS[level]
+        if level == "RAW":
+            level_windows = [w for w, d in zip(windows, deployments)
+                             if d.instrument_type == "StreamLine"]
+            bins = raw_bins(deployments, bin_seconds)
+        elif level == "L3":
+            # the L3 time coordinate is shared by all stations
+            level_windows = [(L3_STATION, L3_STATION, start, end)]
+            files = level_files("L3")
+            bins = {L3_STATION: np.unique(np.concatenate(
+                [cache.bins(f, bin_seconds) for f in files] +
+                [np.array([], np.int64)]))}
+        else:
+            level_windows = windows
+            bins = netcdf_bins(level, instrument_types, cache)
+        level_rows, level_gaps = coverage(
+            level, level_windows, bins, bin_seconds, start, end, min_gap_s)
+        rows.extend(level_rows)
+        gaps.extend(level_gaps)
+    cache.save()
+    logging.info(f"Read the time of {cache.n_read} files, "
+                 f"{len(cache.files) - cache.n_read} from the cache")
+
+    rows = pd.DataFrame(rows, columns=["level", "station", "serial", "date",
+                                       "coverage"])
+    gaps = pd.DataFrame(gaps, columns=["level", "station", "serial", "from",
+                                       "to", "known"])
+
+    return rows, gaps
+
+
+def availability_matrix(rows):
+    """Coverage (%) by (level, station, serial) and date."""
+    if rows.empty:
+        return pd.DataFrame()
+    rows = rows.groupby(["level", "station", "serial", "date"]).coverage.max()
+    matrix = rows.unstack("date")
+    return matrix.reindex(LEVELS, level="level").dropna(how="all")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Report data availability and gaps at every level.")
+    parser.add_argument("-s", "--startdate", required=True,
+                        help="Start datetime in ISO format")
+    parser.add_argument("-e", "--enddate", required=True,
+                        help="End datetime (exclusive) in ISO format")
+    parser.add_argument("--levels", nargs="+", default=LEVELS,
+                        choices=LEVELS)
+    parser.add_argument("--min-gap", type=float, default=MIN_GAP_S / 3600,
+                        help="Shortest missing interval reported, hours")
+    parser.add_argument("--cache", default=CACHE_FILE,
+                        help="Cache of the file time coordinates")
+    parser.add_argument("-o", "--output-dir", default=".",
+                        help="Directory for availability_matrix.csv and "
+                        "availability_gaps.csv")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    rows, gaps = scan(args.startdate, args.enddate, levels=args.levels,
+                      cache_file=args.cache, min_gap_s=args.min_gap * 3600)
+    matrix = availability_matrix(rows)
+    os.makedirs(args.output_dir, exist_ok=True)
+    matrix.to_csv(os.path.join(args.output_dir, "availability_matrix.csv"))
+    gaps.to_csv(os.path.join(args.output_dir, "availability_gaps.csv"),
+                index=False)
+    for level in args.levels:
+        level_gaps = gaps[gaps.level == level]
+        logging.info(
+            f"{level}: {(rows.level == level).sum()} deployed days, "
+            f"{len(level_gaps)} missing intervals "
+            f"({int(level_gaps.known.sum())} known)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark hplparse.read against haloreader's read on .hpl scan files and
+check that both give the same Halo: every variable (data, dtype and
+attributes) and the metadata of the merged files. Files haloreader can not
+merge (a change of pulses per ray) are read with hplparse only. Real RAW
+files are given as paths or globs, without them a day of synthetic scans
+(synthetic_campaign) is written to a temporary directory. Reports the best
+wall time of --repeat reads of all files with each parser. Exits non-zero if
+the Halos differ.
+
+python benchmarks/bench_hplparse.py "D:/.../StreamLine/30/VAD_30_20230601_*.hpl"
+python benchmarks/bench_hplparse.py --scans 288 --gates 400 --rays 24
+"""
+import argparse
+import glob
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from haloreader.exceptions import MergeError
+from haloreader.read import read
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+import hplparse  # noqa: E402
+import synthetic_campaign  # noqa: E402
+
+SERIAL = "901"
+DAY = "2023-01-01"
+SEED = 1
+
+
+def write_scans(scans, gates, rays, cadence, directory):
+    """Write a day of synthetic .hpl scans to directory."""
+    files = []
+    for start in pd.date_range(DAY, periods=scans, freq=f"{cadence}s"):
+        start = start + pd.Timedelta(seconds=2.37)
+        file_name = os.path.join(directory, start.strftime(
+            synthetic_campaign.HPL_FILE.format(serial=SERIAL)))
+        with open(file_name, "w", newline="") as f:
+            f.write(synthetic_campaign._hpl_scan(
+                SERIAL, start, gates, rays, SEED))
+        files.append(file_name)
+    return files
+
+
+def haloreader_read(files):
+    try:
+        from haloreader.read import Product
+    except ImportError:
+        return read([Path(file) for file in files])
+    return read([Path(file) for file in files], product=Product.WIND)
+
+
+def best_time(fun, repeat):
+    """Best wall time of repeat calls of fun and its result."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fun()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def _same(a, b):
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        return isinstance(a, np.ndarray) and isinstance(b, np.ndarray) and \
+            a.dtype == b.dtype and np.array_equal(a, b, equal_nan=True)
+    return a == b
+
+
+def differences(reference, halo):
+    """Fields of the Halos (metadata.<field> for metadata) that differ."""
+    differ = []
+    pairs = [(field, getattr(reference, field), getattr(halo, field))
+             for field in reference.__dataclass_fields__
+             if field != "metadata"]
+    pairs += [(f"metadata.{field}", getattr(reference.metadata, field),
+               getattr(halo.metadata, field))
+              for field in reference.metadata.__dataclass_fields__]
+    for name, a, b in pairs:
+        if a is None or b is None or not hasattr(a, "__dataclass_fields__"):
+            same = _same(a, b)
+        else:
+            same = type(a) is type(b) and all(
+                _same(getattr(a, attr), getattr(b, attr))
+                for attr in a.__dataclass_fields__)
+        if not same:
+            differ.append(name)
+    return differ
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split("\n\n")[0])
+    parser.add_argument("files", nargs="*",
+                        help=".hpl files or globs, default synthetic scans")
+    parser.add_argument("--scans", type=int, default=288)
+    parser.add_argument("--gates", type=int, default=100)
+    parser.add_argument("--rays", type=int, default=12)
+    parser.add_argument("--cadence", type=int, default=300,
+                        help="Seconds between synthetic scans")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.files:
+            files = sorted(file for pattern in args.files
+                           for file in glob.glob(pattern))
+        else:
+            files = write_scans(args.scans, args.gates, args.rays,
+                                args.cadence, directory)
+        if not files:
+            sys.exit("No .hpl files")
+        size = sum(os.path.getsize(file) for file in files)
+        try:
+            haloreader_s, reference = best_time(
+                lambda: haloreader_read(files), args.repeat)
+        except MergeError as err:
+            # e.g. files of different pulses per ray
+            hplparse_s, halo = best_time(lambda: hplparse.read(
+                files, npulses_per_ray=True), args.repeat)
+            print(f"{len(files)} files: haloreader {err!r}, hplparse "
+                  f"{hplparse_s:.3f} s for {len(halo.time.data)} rays of "
+                  f"{sorted(set(np.ravel(halo.metadata.npulses.data)))} "
+                  f"pulses")
+            return
+        hplparse_s, halo = best_time(
+            lambda: hplparse.read(files), args.repeat)
+
+    print(f"{len(files)} files, {size / 1e6:.1f} MB: haloreader "
+          f"{haloreader_s:.3f} s, hplparse {hplparse_s:.3f} s "
+          f"({haloreader_s / hplparse_s:.1f}x), "
+          f"{size / 1e6 / hplparse_s:.0f} MB/s")
+    if reference is None or halo is None:
+        print(f"  haloreader {reference is not None}, hplparse "
+              f"{halo is not None} read the files")
+        sys.exit(0 if reference is None and halo is None else 1)
+    differ = differences(reference, halo)
+    print(f"  {halo.doppler_velocity.data.shape[0]} rays x "
+          f"{halo.doppler_velocity.data.shape[1]} gates, "
+          + (f"differ in {differ}" if differ else "identical Halos"))
+    sys.exit(1 if differ else 0)
+
+
+if __name__ == "__main__":
+    main()
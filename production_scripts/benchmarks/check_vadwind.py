@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+Validate the stacked VAD retrieval of vadwind against a scan by scan
+np.linalg.lstsq fit (the form of haloreader's compute_wind), against the
+wind field the synthetic scans were generated from and, where the haloreader
+with compute_wind is installed, against its to_xarray output. Synthetic .hpl
+scans (synthetic_campaign) are parsed with haloreader, so the whole chain
+from the RAW files is exercised. Also times the stacked retrieval against
+the scan by scan loop. Exits non-zero if the stacked and scan by scan fits
+differ beyond --atol.
+
+With --write-reference, writes the reference of the scans to
+tests/data/vad_reference.nc for tests/test_vadwind.py instead: to_xarray(
+halo.compute_wind(...)) where compute_wind is installed, else the scan by
+scan fit (the reference_source attribute says which).
+
+python benchmarks/check_vadwind.py
+python benchmarks/check_vadwind.py --scans 288 --gates 200 --rays 24
+python benchmarks/check_vadwind.py --write-reference --scans 12 --gates 40 \
+    --rays 12
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from haloreader.read import read
+from haloreader.halo import Halo
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+REFERENCE_FILE = os.path.join(os.path.dirname(BENCHMARK_DIR), "tests",
+                              "data", "vad_reference.nc")
+
+import synthetic_campaign  # noqa: E402
+import vadwind  # noqa: E402
+
+SERIAL = "901"
+DAY = "2023-01-01"
+SEED = 1
+# as streamLine_RAW_to_L1
+MIN_VALID_INTENSITY = 1.005
+EXPECTED_SCAN_ELEVATION = 75
+FIELDS = ["zonal_wind", "meridional_wind", "wind_rmse", "nrays_valid",
+          "wind_mean_intensity"]
+
+
+def read_scans(scans, gates, rays, cadence, directory):
+    """Write synthetic .hpl scans to directory and parse them with read."""
+    files = []
+    for start in pd.date_range(DAY, periods=scans, freq=f"{cadence}s"):
+        start = start + pd.Timedelta(seconds=2.37)
+        file_name = os.path.join(directory, start.strftime(
+            synthetic_campaign.HPL_FILE.format(serial=SERIAL)))
+        with open(file_name, "w", newline="") as f:
+            f.write(synthetic_campaign._hpl_scan(
+                SERIAL, start, gates, rays, SEED))
+        files.append(file_name)
+    try:
+        from haloreader.read import Product
+    except ImportError:
+        return read([open(file, "rb") for file in files])
+    return read([file for file in files], product=Product.WIND)
+
+
+def loop_wind(halo):
+    """
+    The fields of vadwind.retrieve_wind, one lstsq per scan and gate, and the
+    time of the first ray of each scan. The synthetic files each hold one
+    scan of nrays rays.
+    """
+    nrays = int(np.ravel(halo.metadata.nrays.data)[0])
+    scan = np.arange(len(halo.time.data)) // nrays
+    azimuth = np.deg2rad(halo.azimuth.data)
+    elevation = np.asarray(halo.elevation.data, dtype=np.float64)
+    doppler = np.asarray(halo.doppler_velocity.data, dtype=np.float64)
+    intensity = np.asarray(halo.intensity_raw.data, dtype=np.float64)
+    scans = np.unique(scan[scan >= 0])
+    out = {name: np.full((len(scans), doppler.shape[1]), np.nan)
+           for name in FIELDS}
+    out["time"] = pd.to_datetime(np.asarray(
+        halo.time.data, dtype=np.float64)[::nrays], unit="s")
+    for k, s in enumerate(scans):
+        rays = np.flatnonzero((scan == s) & (np.abs(
+            elevation - EXPECTED_SCAN_ELEVATION) <=
+            vadwind.ELEVATION_TOLERANCE))
+        el = np.deg2rad(elevation[rays])
+        a = np.column_stack([np.sin(azimuth[rays]) * np.cos(el),
+                             np.cos(azimuth[rays]) * np.cos(el), np.sin(el)])
+        for g in range(doppler.shape[1]):
+            valid = intensity[rays, g] > MIN_VALID_INTENSITY
+            out["nrays_valid"][k, g] = valid.sum()
+            if not valid.any():
+                continue
+            out["wind_mean_intensity"][k, g] = intensity[rays[valid], g].mean()
+            if valid.sum() < vadwind.MIN_VALID_RAYS:
+                continue
+            x, _, rank, _ = np.linalg.lstsq(
+                a[valid], doppler[rays[valid], g], rcond=None)
+            if rank < 3:
+                continue
+            out["zonal_wind"][k, g], out["meridional_wind"][k, g] = x[:2]
+            out["wind_rmse"][k, g] = np.sqrt(np.mean(
+                (doppler[rays[valid], g] - a[valid] @ x) ** 2))
+    return out
+
+
+def reference_dataset(halo, args):
+    """
+    The reference of tests/test_vadwind.py: FIELDS and time of to_xarray(
+    halo.compute_wind(...)), or of the scan by scan fit without compute_wind.
+    """
+    if hasattr(Halo, "compute_wind"):
+        from streamLine_RAW_to_L1 import to_xarray
+        dat = to_xarray(halo.compute_wind(
+            halobg=None, min_valid_intensity=MIN_VALID_INTENSITY,
+            elevation_expected_value=EXPECTED_SCAN_ELEVATION))[FIELDS]
+        source = "haloreader compute_wind"
+    else:
+        loop = loop_wind(halo)
+        dat = xr.Dataset(
+            {name: (["time", "range"], loop[name]) for name in FIELDS},
+            coords={"time": loop["time"], "range": np.asarray(
+                halo.range.data, dtype=np.float64)})
+        source = "scan by scan lstsq (check_vadwind.loop_wind)"
+    dat.attrs = {"reference_source": source, "scans": args.scans,
+                 "gates": args.gates, "rays": args.rays,
+                 "cadence": args.cadence}
+    return dat
+
+
+def max_diff(a, b):
+    """max |a - b| where both are finite and the count of NaN mismatches."""
+    a, b = np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64)
+    both = np.isfinite(a) & np.isfinite(b)
+    diff = float(np.max(np.abs(a[both] - b[both]), initial=0))
+    return diff, int(np.sum(np.isfinite(a) != np.isfinite(b)))
+
+
+def truth_errors(dat):
+    """RMS error of u and v against the generating wind field, in signal."""
+    seconds = (dat.time.values - np.datetime64(DAY)) / np.timedelta64(1, "s")
+    u, v, _, signal_top = synthetic_campaign.wind_field(
+        DAY, seconds, dat.height.values, SEED)
+    in_signal = dat.height.values[None, :] < signal_top[:, None]
+    fitted = in_signal & np.isfinite(dat.zonal_wind.values)
+    return {
+        "u": float(np.sqrt(np.mean(
+            (dat.zonal_wind.values - u)[fitted] ** 2))),
+        "v": float(np.sqrt(np.mean(
+            (dat.meridional_wind.values - v)[fitted] ** 2))),
+        "fitted_in_signal": float(fitted.sum() / in_signal.sum()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split("\n\n")[0])
+    parser.add_argument("--scans", type=int, default=48)
+    parser.add_argument("--gates", type=int, default=100)
+    parser.add_argument("--rays", type=int, default=24)
+    parser.add_argument("--cadence", type=int, default=300,
+                        help="Seconds between scans")
+    parser.add_argument("--atol", type=float, default=1e-8,
+                        help="Largest difference to the scan by scan fit")
+    parser.add_argument("--write-reference", action="store_true",
+                        help=f"Write the reference to {REFERENCE_FILE}")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        halo = read_scans(args.scans, args.gates, args.rays, args.cadence,
+                          directory)
+
+    if args.write_reference:
+        dat = reference_dataset(halo, args)
+        os.makedirs(os.path.dirname(REFERENCE_FILE), exist_ok=True)
+        dat.to_netcdf(REFERENCE_FILE)
+        print(f"{dat.attrs['reference_source']} reference of "
+              f"{dat.sizes['time']} scans x {dat.sizes['range']} gates "
+              f"written to {REFERENCE_FILE}")
+        return
+
+    start = time.perf_counter()
+    dat = vadwind.halo_wind(halo, MIN_VALID_INTENSITY,
+                            EXPECTED_SCAN_ELEVATION)
+    stacked_s = time.perf_counter() - start
+    start = time.perf_counter()
+    loop = loop_wind(halo)
+    loop_s = time.perf_counter() - start
+    print(f"{dat.sizes['time']} scans x {dat.sizes['range']} gates: "
+          f"stacked {stacked_s:.3f} s, scan by scan {loop_s:.3f} s "
+          f"({loop_s / stacked_s:.0f}x)")
+
+    ok = True
+    for name in FIELDS:
+        diff, nan_mismatch = max_diff(dat[name].values, loop[name])
+        ok &= diff <= args.atol and nan_mismatch == 0
+        print(f"  {name:20s} max abs diff to scan by scan {diff:.3g}, "
+              f"{nan_mismatch} NaN mismatches")
+    time_ok = np.array_equal(dat.time.values, loop["time"].values)
+    ok &= time_ok
+    print(f"  time                 {'equal' if time_ok else 'differs'} to "
+          f"the first ray of each scan")
+    errors = truth_errors(dat)
+    print(f"  rms error to the synthetic wind field u {errors['u']:.3f}, "
+          f"v {errors['v']:.3f} m s-1, "
+          f"{errors['fitted_in_signal']:.0%} of the gates in signal fitted")
+
+    if not hasattr(Halo, "compute_wind"):
+        print("  haloreader without compute_wind, comparison skipped")
+    else:
+        from streamLine_RAW_to_L1 import to_xarray
+        reference = to_xarray(halo.compute_wind(
+            halobg=None, min_valid_intensity=MIN_VALID_INTENSITY,
+            elevation_expected_value=EXPECTED_SCAN_ELEVATION))
+        if reference.sizes != dat.sizes:
+            print(f"  haloreader sizes {dict(reference.sizes)} != "
+                  f"{dict(dat.sizes)}")
+        else:
+            for name in FIELDS:
+                diff, nan_mismatch = max_diff(
+                    dat[name].values, reference[name].values)
+                print(f"  {name:20s} max abs diff to haloreader "
+                      f"{diff:.3g}, {nan_mismatch} NaN mismatches")
+            diff = np.max(np.abs(dat.time.values - reference.time.values))
+            print(f"  time                 max abs diff to haloreader "
+                  f"{diff / np.timedelta64(1, 's'):.3g} s")
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+Numerical diff of NetCDF files, to show that a faster version of a script
+writes the same L1, L2 and L3 files. Two files, or two directories (files
+paired by relative path), are compared variable by variable in blocks along
+the first dimension, so memory stays bounded by --block-size per worker
+whatever the file size, and directories are compared in parallel across
+files.
+
+Reported per variable: the max absolute and relative difference, values
+outside the tolerance, NaN (fill) mask disagreements and, for flag_*
+variables, the number of mismatched flags. Also dimensions, missing
+variables, dtypes and attributes. Values are compared decoded (scale and
+offset applied, times in the units of the first file). Exits non-zero if
+any file differs beyond the tolerances.
+
+python benchmarks/ncdiff.py old/L3 new/L3
+python benchmarks/ncdiff.py old.nc new.nc --rtol 1e-6 --tolerance wd=1e-4
+python benchmarks/ncdiff.py old/ new/ --workers 8 --json diff.json
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import netCDF4
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+import memtrack  # noqa: E402
+
+# differ between any two runs
+IGNORED_ATTRS = ["processing_time_utc"]
+BLOCK_SIZE = memtrack.parse_size("64M")
+RTOL = 1e-9
+ATOL = 1e-12
+
+
+def _equal(a, b):
+    a, b = np.asarray(a), np.asarray(b)
+    if a.dtype.kind == "f" and b.dtype.kind == "f":
+        # NaN fill values are equal
+        return np.array_equal(a, b, equal_nan=True)
+    return np.array_equal(a, b)
+
+
+def attr_diffs(a, b, ignored, prefix=""):
+    diffs = []
+    a_attrs = {k: a.getncattr(k) for k in a.ncattrs() if k not in ignored}
+    b_attrs = {k: b.getncattr(k) for k in b.ncattrs() if k not in ignored}
+    for key in sorted(set(a_attrs) | set(b_attrs)):
+        if key not in b_attrs:
+            diffs.append(f"{prefix}{key} only in a")
+        elif key not in a_attrs:
+            diffs.append(f"{prefix}{key} only in b")
+        elif not _equal(a_attrs[key], b_attrs[key]):
+            diffs.append(f"{prefix}{key}: {a_attrs[key]!r} != "
+                         f"{b_attrs[key]!r}")
+    return diffs
+
+
+def blocks(var, block_size):
+    """Slices along the first dimension of about block_size bytes."""
+    if var.ndim == 0 or var.shape[0] == 0:
+        yield ()
+        return
+    # variable length strings count as 8 bytes (a pointer) each
+    itemsize = getattr(var.dtype, "itemsize", 8)
+    row_bytes = itemsize * int(np.prod(var.shape[1:]))
+    rows = max(1, block_size // max(row_bytes, 1))
+    chunking = var.chunking()
+    if chunking != "contiguous" and rows > chunking[0]:
+        # whole chunks, each chunk decompressed once
+        rows -= rows % chunking[0]
+    for start in range(0, var.shape[0], rows):
+        yield slice(start, start + rows)
+
+
+def decoded(var, sl, units=None):
+    """Values of var[sl] as a float array with NaN for fill values, or as is
+    for non-numeric variables. Times in units if given."""
+    values = var[sl]
+    if units is not None:
+        calendar = getattr(var, "calendar", "standard")
+        values = netCDF4.date2num(
+            netCDF4.num2date(values, var.units, calendar,
+                             only_use_cftime_datetimes=False),
+            units, calendar)
+    if np.dtype(var.dtype).kind not in "fiub":
+        return np.ma.filled(values, b"")
+    return np.ma.filled(np.ma.asarray(values, dtype=np.float64), np.nan)
+
+
+def time_units(a, b):
+    """The units of a if b is a time in other units, else None."""
+    units = getattr(a, "units", None)
+    if isinstance(units, str) and " since " in units and \
+            getattr(b, "units", None) != units:
+        return units
+    return None
+
+
+def compare_variable(a, b, atol, rtol, block_size):
+    """Statistics of the differences of two variables of the same shape."""
+    is_flag = a.name.startswith("flag")
+    # times in other units are converted to the units of a
+    times = time_units(a, b)
+    stats = {"n": 0, "n_out": 0, "nan_mismatch": 0, "max_abs": 0.,
+             "max_rel": 0., "flag": is_flag}
+    for sl in blocks(a, block_size):
+        x = decoded(a, sl)
+        y = decoded(b, sl, units=times)
+        stats["n"] += x.size
+        if x.dtype.kind not in "f":
+            stats["n_out"] += int(np.sum(x != y))
+            continue
+        x_nan, y_nan = np.isnan(x), np.isnan(y)
+        stats["nan_mismatch"] += int(np.sum(x_nan != y_nan))
+        both = ~(x_nan | y_nan)
+        if not both.any():
+            continue
+        x, y = x[both], y[both]
+        diff = np.abs(x - y)
+        stats["max_abs"] = max(stats["max_abs"], float(diff.max()))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rel = np.where(diff > 0, diff / np.abs(x), 0)
+        stats["max_rel"] = max(stats["max_rel"], float(np.max(rel)))
+        stats["n_out"] += int(np.sum(diff > atol + rtol * np.abs(x)))
+    stats["ok"] = stats["n_out"] == 0 and stats["nan_mismatch"] == 0
+
+    return stats
+
+
+def compare_files(a_file, b_file, atol=ATOL, rtol=RTOL, tolerances=None,
+                  ignored_attrs=IGNORED_ATTRS, block_size=BLOCK_SIZE):
+    """
+    Differences between two NetCDF files.
+
+    Parameters
+    ----------
+    tolerances : dict
+        {variable: (atol, rtol)} overriding atol and rtol
+
+    Returns
+    -------
+    dict with "structure" and "attrs" (lists of differences), "variables"
+    ({name: statistics}) and "ok"
+    """
+    tolerances = tolerances or {}
+    result = {"a": a_file, "b": b_file, "structure": [], "attrs": [],
+              "variables": {}}
+    with netCDF4.Dataset(a_file) as a, netCDF4.Dataset(b_file) as b:
+        for dim in sorted(set(a.dimensions) | set(b.dimensions)):
+            a_size = len(a.dimensions[dim]) if dim in a.dimensions else None
+            b_size = len(b.dimensions[dim]) if dim in b.dimensions else None
+            if a_size != b_size:
+                result["structure"].append(
+                    f"dimension {dim}: {a_size} != {b_size}")
+        result["attrs"].extend(attr_diffs(a, b, ignored_attrs))
+        for name in sorted(set(a.variables) | set(b.variables)):
+            if name not in b.variables:
+                result["structure"].append(f"{name} only in a")
+                continue
+            if name not in a.variables:
+                result["structure"].append(f"{name} only in b")
+                continue
+            a_var, b_var = a.variables[name], b.variables[name]
+            # times are compared decoded, other units are only an encoding
+            var_ignored = list(ignored_attrs) + (
+                ["units"] if time_units(a_var, b_var) else [])
+            result["attrs"].extend(
+                attr_diffs(a_var, b_var, var_ignored, prefix=f"{name}."))
+            if a_var.dtype != b_var.dtype:
+                result["structure"].append(
+                    f"{name} dtype {a_var.dtype} != {b_var.dtype}")
+            if a_var.dimensions != b_var.dimensions or \
+                    a_var.shape != b_var.shape:
+                result["structure"].append(
+                    f"{name} {a_var.dimensions}{a_var.shape} != "
+                    f"{b_var.dimensions}{b_var.shape}")
+                continue
+            var_atol, var_rtol = tolerances.get(name, (atol, rtol))
+            result["variables"][name] = compare_variable(
+                a_var, b_var, var_atol, var_rtol, block_size)
+    result["ok"] = not result["structure"] and not result["attrs"] and all(
+        stats["ok"] for stats in result["variables"].values())
+
+    return result
+
+
+def _compare_files(args):
+    a_file, b_file, kwargs = args
+    try:
+        return compare_files(a_file, b_file, **kwargs)
+    except Exception as e:
+        return {"a": a_file, "b": b_file, "structure": [f"error: {e!r}"],
+                "attrs": [], "variables": {}, "ok": False}
+
+
+def file_pairs(a, b, pattern="**/*.nc"):
+    """
+    (a_file, b_file) pairs, b_file None for files only in a, a_file None for
+    files only in b.
+    """
+    if os.path.isfile(a):
+        return [(a, b)]
+    a_files = {os.path.relpath(f, a) for f in glob.glob(
+        os.path.join(a, pattern), recursive=True)}
+    b_files = {os.path.relpath(f, b) for f in glob.glob(
+        os.path.join(b, pattern), recursive=True)}
+    return [(os.path.join(a, f) if f in a_files else None,
+             os.path.join(b, f) if f in b_files else None)
+            for f in sorted(a_files | b_files)]
+
+
+def report(result, verbose=False):
+    lines = [f"{'OK  ' if result['ok'] else 'DIFF'} {result['a']}"]
+    lines.extend(f"    {diff}" for diff in result["structure"])
+    lines.extend(f"    attr {diff}" for diff in result["attrs"])
+    for name, stats in result["variables"].items():
+        if stats["ok"] and not verbose:
+            continue
+        kind = "flag" if stats["flag"] else "var"
+        lines.append(
+            f"    {kind} {name}: max abs {stats['max_abs']:.3g}, max rel "
+            f"{stats['max_rel']:.3g}, {stats['n_out']}/{stats['n']} outside "
+            f"tolerance, {stats['nan_mismatch']} NaN mask mismatches")
+    return "\n".join(lines)
+
+
+def parse_tolerance(tolerance):
+    """VAR=ATOL[,RTOL] -> (VAR, (atol, rtol))"""
+    name, _, values = tolerance.partition("=")
+    values = [float(value) for value in values.split(",")]
+    if len(values) == 1:
+        values.append(RTOL)
+    return name, tuple(values)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split("\n\n")[0])
+    parser.add_argument("a", help="NetCDF file or directory")
+    parser.add_argument("b", help="NetCDF file or directory")
+    parser.add_argument("--atol", type=float, default=ATOL)
+    parser.add_argument("--rtol", type=float, default=RTOL,
+                        help="Values differ if |a - b| > atol + rtol * |a|")
+    parser.add_argument("--tolerance", type=parse_tolerance, action="append",
+                        default=[], help="Per variable VAR=ATOL[,RTOL]")
+    parser.add_argument("--ignore-attr", action="append",
+                        default=list(IGNORED_ATTRS),
+                        help="Attribute to ignore, default "
+                        f"{', '.join(IGNORED_ATTRS)}")
+    parser.add_argument("--pattern", default="**/*.nc",
+                        help="Files compared in directories")
+    parser.add_argument("--block-size", type=memtrack.parse_size,
+                        default=BLOCK_SIZE,
+                        help="Bytes of a variable read at once, e.g. 64M")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="Files compared in parallel")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="Also list the variables that are the same")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    kwargs = {"atol": args.atol, "rtol": args.rtol,
+              "tolerances": dict(args.tolerance),
+              "ignored_attrs": args.ignore_attr,
+              "block_size": args.block_size}
+    pairs = file_pairs(args.a, args.b, args.pattern)
+    results = [{"a": a_file or b_file, "b": b_file, "ok": False,
+                "structure": [f"only in {'a' if a_file else 'b'}"],
+                "attrs": [], "variables": {}}
+               for a_file, b_file in pairs if a_file is None or b_file is None]
+    tasks = [(a_file, b_file, kwargs) for a_file, b_file in pairs
+             if a_file is not None and b_file is not None]
+    if args.workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            results.extend(pool.map(_compare_files, tasks))
+    else:
+        results.extend(map(_compare_files, tasks))
+
+    for result in sorted(results, key=lambda result: result["a"]):
+        print(report(result, verbose=args.verbose))
+    n_diff = sum(not result["ok"] for result in results)
+    print(f"{len(results) - n_diff} of {len(results)} files the same")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=1)
+
+    sys.exit(1 if n_diff else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Pinned reference inputs for the benchmarks. Every dataset is generated from
+a fixed seed and a named size, so two runs (on any machine, offline) time
+exactly the same work. The variables, dimensions and attributes are those
+the production scripts read at each level.
+"""
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+SEED = 20221207
+DAY = "2022-12-07"
+
+# per size: number of profiles in the day and number of range gates
+SIZES = {
+    "small": {
+        "streamline_scans": 288,
+        "streamline_gates": 100,
+        "w400s_profiles": 2880,
+        "w400s_gates": 80,
+        "wls70_profiles": 144,
+        "wls70_gates": 60,
+    },
+    "large": {
+        "streamline_scans": 1440,
+        "streamline_gates": 200,
+        "w400s_profiles": 21600,
+        "w400s_gates": 160,
+        "wls70_profiles": 144,
+        "wls70_gates": 120,
+    },
+}
+
+
+def _times(n):
+    return pd.date_range(DAY, periods=n, freq=pd.Timedelta(days=1) / n)
+
+
+def _wind(rng, shape, valid_gates):
+    ws = rng.gamma(2, 3, shape)
+    wd = rng.uniform(0, 360, shape)
+    ws[:, valid_gates:] = np.nan
+    wd[:, valid_gates:] = np.nan
+    return ws, wd
+
+
+def streamline_l1(size="small"):
+    """StreamLine L1 as written by streamLine_RAW_to_L1.to_xarray."""
+    s = SIZES[size]
+    rng = np.random.default_rng(SEED)
+    n_time, n_range = s["streamline_scans"], s["streamline_gates"]
+    time = _times(n_time)
+    gate_range = 30.
+    range_ = (np.arange(n_range) + 0.5) * gate_range
+    ws, wd = _wind(rng, (n_time, n_range), int(n_range * 0.6))
+    u = -ws * np.sin(np.deg2rad(wd))
+    v = -ws * np.cos(np.deg2rad(wd))
+    nrays = 12
+    elevation = 75.
+
+    return xr.Dataset(
+        data_vars={
+            "zonal_wind": (["time", "range"], u),
+            "meridional_wind": (["time", "range"], v),
+            "horizontal_wind_speed": (["time", "range"], ws),
+            "wind_direction": (["time", "range"], wd),
+            "wind_rmse": (["time", "range"], rng.gamma(1.5, 0.8, u.shape)),
+            "nrays_valid": (["time", "range"], rng.integers(
+                6, nrays + 1, u.shape).astype(float)),
+            "wind_mean_intensity": (["time", "range"], rng.normal(
+                1.01, 0.004, u.shape)),
+            "gate_length": (["time"], np.full(n_time, 10)),
+            "gate_range": (["time"], np.full(n_time, gate_range)),
+            "npulses": (["time"], np.full(n_time, 10000)),
+            "nrays": (["time"], np.full(n_time, nrays)),
+            "resolution": (["time"], np.full(n_time, 0.0382)),
+            "wavelength": (["time"], np.full(n_time, 1.565e-6)),
+            "wind_elevation": (["time"], np.full(n_time, elevation)),
+            "elevation": (["time"], np.full(n_time, elevation)),
+        },
+        coords={
+            "time": time,
+            "range": range_,
+            "height": (["range"], range_ * np.sin(np.deg2rad(elevation))),
+        },
+    )
+
+
+def w400s_l1a(size="small"):
+    """w400s_1a_LqualairLzamIdbs_v01 daily file contents."""
+    s = SIZES[size]
+    rng = np.random.default_rng(SEED + 1)
+    n_time, n_gates = s["w400s_profiles"], s["w400s_gates"]
+    ws, wd = _wind(rng, (n_time, n_gates), int(n_gates * 0.7))
+    status = (rng.random((n_time, n_gates)) > 0.1).astype("int8")
+    status[np.isnan(ws)] = 0
+
+    return xr.Dataset(
+        data_vars={
+            "horizontal_wind_speed": (["time", "gate_index"], ws),
+            "wind_direction": (["time", "gate_index"], wd),
+            "wind_speed_status": (["time", "gate_index"], status),
+            "wind_speed_ci": (["time", "gate_index"], rng.uniform(
+                90, 100.5, ws.shape)),
+            "elevation": (["time"], rng.normal(75, 0.01, n_time)),
+            "range": ((), 0, {
+                "meters_to_center_of_first_gate": 100,
+                "meters_between_gates": 25,
+            }),
+        },
+        coords={
+            "time": _times(n_time),
+            "gate_index": np.arange(n_gates),
+        },
+    )
+
+
+def l2(size="small", instrument="StreamLine"):
+    """An L2 file as read by L2_to_L3.py (vertical coordinate: height)."""
+    s = SIZES[size]
+    rng = np.random.default_rng(SEED + 2)
+    if instrument == "StreamLine":
+        n_time, n_height, gate = (
+            s["streamline_scans"], s["streamline_gates"], 30 * np.sin(
+                np.deg2rad(75)))
+    elif instrument == "w400s":
+        n_time, n_height, gate = (
+            s["w400s_profiles"] // 4, s["w400s_gates"], 25 * np.sin(
+                np.deg2rad(75)))
+    else:
+        n_time, n_height, gate = s["wls70_profiles"], s["wls70_gates"], 50.
+    ws, wd = _wind(rng, (n_time, n_height), int(n_height * 0.6))
+    u = -ws * np.sin(np.deg2rad(wd))
+    v = -ws * np.cos(np.deg2rad(wd))
+    flags = {
+        var: (["time", "height"], rng.random(u.shape) < 0.05)
+        for var in [
+            "flag_low_signal_warn",
+            "flag_low_signal_removed",
+            "flag_suspect_retrieval_warn",
+            "flag_suspect_retrieval_removed",
+            "flag_ws_out_of_range_removed",
+        ]
+    }
+
+    return xr.Dataset(
+        data_vars={
+            "u": (["time", "height"], u),
+            "v": (["time", "height"], v),
+            "n_rays_in_scan": (["time"], np.full(n_time, 12.)),
+            "raw_gate_length": (["time"], np.full(n_time, 30.)),
+            "n_pulses": (["time"], np.full(n_time, 10000.)),
+            **flags,
+        },
+        coords={
+            "time": _times(n_time),
+            "height": (np.arange(n_height) + 0.5) * gate,
+        },
+        attrs={"production_level": 2, "production_version": "reference"},
+    )
@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite for the pipeline stages on the pinned reference inputs of
+reference_data.py. For each stage the best wall time of --repeat runs and the
+peak traced (python + numpy) memory of one extra run are appended as one
+JSON line per run to the history file, so that a new __version__ of any
+script can be compared against a previous run.
+
+python benchmarks/run_benchmarks.py --size small
+python benchmarks/run_benchmarks.py --size large --only z_resample time_resample
+python benchmarks/run_benchmarks.py --compare
+"""
+import argparse
+import datetime as dt
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+os.chdir(os.path.dirname(BENCHMARK_DIR))  # meta/ paths are relative
+
+import numpy as np  # noqa: E402
+import xarray as xr  # noqa: E402
+import harmonise  # noqa: E402
+import reference_data  # noqa: E402
+import streamLine_L1_to_L2 as streamline  # noqa: E402
+import w400s_L1a_to_L2 as w400s  # noqa: E402
+import L2_to_L3  # noqa: E402
+
+HISTORY_FILE = os.path.join(BENCHMARK_DIR, "history.jsonl")
+TIME_AGG = 600
+
+
+class SkipBenchmark(Exception):
+    pass
+
+
+def _to_xarray_setup(size):
+    try:
+        from streamLine_RAW_to_L1 import to_xarray
+        from haloreader.variable import Variable
+    except Exception as e:
+        raise SkipBenchmark(f"streamLine_RAW_to_L1 not importable: {e!r}")
+    from dataclasses import make_dataclass
+
+    dat = reference_data.streamline_l1(size)
+    fields = {
+        name: Variable(name=name, dimensions=tuple(dat[name].dims),
+                       data=dat[name].values)
+        for name in ["zonal_wind", "meridional_wind", "wind_rmse",
+                     "nrays_valid", "wind_mean_intensity", "elevation"]
+    }
+    fields["time"] = Variable(name="time", dimensions=("time",),
+                              data=dat.time.values.astype("int64") / 1e9)
+    fields["range"] = Variable(name="range", dimensions=("range",),
+                               data=dat.range.values)
+    metadata = {
+        name: Variable(name=name, data=dat[name].values[0])
+        for name in ["gate_length", "gate_range", "npulses", "nrays",
+                     "resolution", "wavelength"]
+    }
+    Metadata = make_dataclass("Metadata", list(metadata))
+    HaloWind = make_dataclass("HaloWind", [*fields, "metadata"])
+    return to_xarray, HaloWind(**fields, metadata=Metadata(**metadata))
+
+
+def _streamline_qc_chain(dat):
+    dat = streamline.streamline_flag_suspect_retrieval_removed(dat)
+    dat = streamline.streamline_flag_low_signal_removed(dat)
+    dat = streamline.streamline_flag_low_signal_warn(dat)
+    dat = streamline.streamline_flag_suspect_retrieval_warn(dat)
+    dat = streamline.streamline_harmonise_varnames(dat)
+    dat = harmonise.flag_ws_out_of_range(dat)
+    dat = streamline.streamLine_height_as_vertical_dimension(dat)
+    dat = harmonise.select_preharmonisation_data_vars(dat)
+    return dat
+
+
+def _w400s_l1a(size):
+    dat = w400s.gate_index_to_range(reference_data.w400s_l1a(size))
+    u, v = harmonise.ws_wd_to_vector(dat["horizontal_wind_speed"].values,
+                                     dat["wind_direction"].values)
+    dat["u"], dat["v"] = [(["time", "range"], i) for i in [u, v]]
+    return dat
+
+
+def _l2_on_altitude(size):
+    return harmonise.sea_level_adjust(reference_data.l2(size), 100)
+
+
+def _z_resampled(size):
+    return harmonise.z_resample(
+        _l2_on_altitude(size), harmonise.MIN_ALTITUDE,
+        harmonise.MAX_ALTITUDE, harmonise.RES_ALTITUDE)
+
+
+def _l3_stations(size):
+    stations = L2_to_L3.stations_table().index
+    instruments = ["StreamLine", "w400s", "WLS70"]
+    dat_list = []
+    for i, station_code in enumerate(stations):
+        instrument = instruments[i % len(instruments)]
+        d = harmonise.Deployment(
+            index=i, station_code=station_code, instrument_serial=str(i),
+            instrument_type=instrument, start_datetime=None,
+            end_datetime=None, above_sea_level_m=100, do_bg_corr=None,
+            options={}, raw_files=[])
+        dat_list.append(L2_to_L3.harmonise_station(
+            reference_data.l2(size, instrument), d, TIME_AGG).load())
+    return dat_list
+
+
+def _to_netcdf(dat, level=None):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dat.to_netcdf(os.path.join(tmp_dir, "benchmark.nc"),
+                      encoding=harmonise.encode_nc_compression(dat, level))
+
+
+def _to_netcdf_trimmed(dat, level=None):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        harmonise.to_netcdf_trimmed(
+            dat, os.path.join(tmp_dir, "benchmark.nc"),
+            encoding=harmonise.encode_nc_compression(dat, level))
+
+
+# name: (setup(size) -> args, benchmarked function(*args))
+BENCHMARKS = {
+    "to_xarray": (
+        _to_xarray_setup,
+        lambda to_xarray, halo: to_xarray(halo)),
+    "streamline_qc_chain": (
+        lambda size: (reference_data.streamline_l1(size),),
+        _streamline_qc_chain),
+    "w400s_apply_pre_aggregation_qc": (
+        lambda size: (_w400s_l1a(size),),
+        w400s.w400s_apply_pre_aggregation_qc),
+    "w400s_aggregate_time": (
+        lambda size: (w400s.w400s_apply_pre_aggregation_qc(
+            _w400s_l1a(size)), "1min"),
+        w400s.w400s_aggregate_time),
+    "z_resample": (
+        lambda size: (_l2_on_altitude(size), harmonise.MIN_ALTITUDE,
+                      harmonise.MAX_ALTITUDE, harmonise.RES_ALTITUDE),
+        harmonise.z_resample),
+    "z_resample_trim": (
+        lambda size: (_l2_on_altitude(size), harmonise.MIN_ALTITUDE,
+                      harmonise.MAX_ALTITUDE, harmonise.RES_ALTITUDE),
+        lambda *args: harmonise.z_resample(*args, trim=True)),
+    "time_resample": (
+        lambda size: (_z_resampled(size), TIME_AGG),
+        harmonise.time_resample),
+    "vector_to_ws_wd": (
+        lambda size: [np.stack([d[var].values[0] for d in _l3_stations(
+            size)]) for var in ["u", "v"]],
+        harmonise.vector_to_ws_wd),
+    "l3_assembly": (
+        lambda size: (_l3_stations(size), TIME_AGG),
+        L2_to_L3.assemble_l3),
+    "to_netcdf_L2": (
+        lambda size: (_streamline_qc_chain(
+            reference_data.streamline_l1(size)),),
+        _to_netcdf),
+    "to_netcdf_L3": (
+        lambda size: (L2_to_L3.assemble_l3(_l3_stations(size), TIME_AGG),
+                      3),
+        _to_netcdf),
+    "to_netcdf_L3_trimmed": (
+        lambda size: (L2_to_L3.assemble_l3(_l3_stations(size), TIME_AGG),
+                      3),
+        _to_netcdf_trimmed),
+}
+
+
+def _copy(arg):
+    # stages modify their input datasets in place, give each run its own
+    if isinstance(arg, xr.Dataset):
+        return arg.copy(deep=True)
+    if isinstance(arg, np.ndarray):
+        return arg.copy()
+    if isinstance(arg, (list, tuple)):
+        return [_copy(a) for a in arg]
+    return arg
+
+
+def run_benchmark(name, size, repeat):
+    setup, fun = BENCHMARKS[name]
+    try:
+        args = setup(size)
+    except SkipBenchmark as e:
+        return {"skipped": str(e)}
+
+    times = []
+    for _ in range(repeat):
+        run_args = _copy(args)
+        t0 = time.perf_counter()
+        fun(*run_args)
+        times.append(time.perf_counter() - t0)
+
+    run_args = _copy(args)
+    tracemalloc.start()
+    fun(*run_args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "time_s": min(times),
+        "time_median_s": float(np.median(times)),
+        "peak_memory_mb": peak / 2**20,
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BENCHMARK_DIR,
+            capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def _versions():
+    return {
+        "streamLine_L1_to_L2": streamline.__version__,
+        "w400s_L1a_to_L2": w400s.__version__,
+        "L2_to_L3": str(L2_to_L3.__version__),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "xarray": xr.__version__,
+    }
+
+
+def read_history(history_file):
+    if not os.path.exists(history_file):
+        return []
+    with open(history_file) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(current, previous):
+    print(f"{'benchmark':<32} {'time_s':>10} {'prev':>10} {'ratio':>7} "
+          f"{'peak_mb':>9} {'prev':>9}")
+    for name, result in current["results"].items():
+        prev = previous["results"].get(name, {})
+        if "skipped" in result or "time_s" not in prev:
+            print(f"{name:<32} {result.get('time_s', float('nan')):>10.4f} "
+                  f"{'-':>10} {'-':>7} "
+                  f"{result.get('peak_memory_mb', float('nan')):>9.1f}")
+            continue
+        ratio = result["time_s"] / prev["time_s"]
+        print(f"{name:<32} {result['time_s']:>10.4f} {prev['time_s']:>10.4f} "
+              f"{ratio:>7.2f} {result['peak_memory_mb']:>9.1f} "
+              f"{prev['peak_memory_mb']:>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split("\n\n")[0])
+    parser.add_argument("--size", choices=list(reference_data.SIZES),
+                        default="small")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS),
+                        help="Run only these benchmarks")
+    parser.add_argument("--history", default=HISTORY_FILE,
+                        help="JSON lines file the results are appended to")
+    parser.add_argument("--label", default=None,
+                        help="Free text stored with the run, e.g. a branch")
+    parser.add_argument("--compare", action="store_true",
+                        help="Compare the last two runs of --size in the "
+                        "history instead of running")
+    args = parser.parse_args()
+
+    history = [h for h in read_history(args.history)
+               if h["size"] == args.size]
+    if args.compare:
+        if len(history) < 2:
+            sys.exit(f"Fewer than two {args.size} runs in {args.history}")
+        compare(history[-1], history[-2])
+        return
+
+    results = {}
+    for name in args.only or BENCHMARKS:
+        results[name] = run_benchmark(name, args.size, args.repeat)
+        print(name, results[name])
+
+    record = {
+        "run_time_utc": dt.datetime.now(tz=dt.timezone.utc).isoformat(),
+        "label": args.label,
+        "git_commit": _git_commit(),
+        "host": platform.node(),
+        "size": args.size,
+        "repeat": args.repeat,
+        "versions": _versions(),
+        "results": results,
+    }
+    with open(args.history, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+    if history:
+        compare(record, history[-1])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+"""
+Campaign climatology of the L3 wind profiles: diurnal (month x hour of day)
+and monthly mean profiles, wind speed quantiles by altitude and wind roses
+of every station. The L3 files are streamed once, in blocks of time steps,
+into accumulators of fixed size (sums and counts per station, month, hour
+and altitude, wind speed histograms and wind rose counts per station, month
+and altitude), so memory does not depend on the length of the campaign.
+Months are months of the year, so a campaign of several years is averaged
+into one annual cycle.
+
+The accumulators only add up, so the files can be split between workers
+and merged, and they are kept in a state file between runs: a run only
+reads the L3 files added since the last one and writes the summary product
+(in harmonise.CLIM_BASEDIR) from the state. L3 files that changed since they
+were added (e.g. a near-real-time day still growing) are not added twice,
+they need a --rebuild.
+
+python climatology.py -s 2022-12-01 -e 2024-01-01
+python climatology.py -s 2022-12-01 -e 2024-01-01 --workers 8 --rebuild
+"""
+
+import os
+import json
+import pickle
+import logging
+import argparse
+import datetime as dt
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import xarray as xr
+import harmonise
+import memtrack
+import L2_to_L3
+import l3diag
+
+__version__ = 1.0
+product_name = "paris_dwl_L3clim"
+STATE_FILENAME = "climatology-{time_agg}s.pkl"
+MEAN_VARS = ["u", "v", "ws"]
+# wind speed histogram bins (m s-1) of the quantiles, faster winds are in
+# the last bin
+WS_BIN_WIDTH = 0.25
+QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+# wind rose sectors and lower bounds of the wind speed classes (m s-1)
+WD_SECTORS = 16
+WS_CLASSES = [0, 2, 4, 6, 8, 10, 15]
+# by default all L3 values are used (see l3diag.usable)
+MAX_FLAG_PC = 100
+# bytes of L3 read per block of time steps
+BLOCK_SIZE = memtrack.parse_size("256M")
+# working set of a block in multiples of its input (masks, indices and
+# weights of the finite values)
+WORKING_SET_FACTOR = 4
+
+
+def clim_filename(time_agg):
+    return os.path.join(harmonise.CLIM_BASEDIR, "{product_name}V{version}_"
+                        "{time_agg}s.nc".format(product_name=product_name,
+                                                version=__version__,
+                                                time_agg=time_agg))
+
+
+def histogram_quantiles(hist, quantiles, bin_width):
+    """
+    Quantiles of the values of histograms along the last axis (bins of
+    bin_width from 0), linear within a bin. NaN for empty histograms.
+
+    Returns
+    -------
+    np.ndarray (quantile, ...)
+    """
+    cum = np.cumsum(hist, axis=-1)
+    total = cum[..., -1:]
+    out = np.full((len(quantiles),) + hist.shape[:-1], np.nan)
+    for k, q in enumerate(quantiles):
+        target = q * total
+        # the first bin that reaches the target
+        i = np.minimum(np.sum(cum < target, axis=-1, keepdims=True),
+                       hist.shape[-1] - 1)
+        below = np.where(i > 0, np.take_along_axis(
+            cum, np.maximum(i - 1, 0), axis=-1), 0)
+        in_bin = np.take_along_axis(hist, i, axis=-1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            fraction = np.where(in_bin > 0, (target - below) / in_bin, 0)
+        value = (i + np.clip(fraction, 0, 1)) * bin_width
+        out[k] = np.where(total > 0, value, np.nan)[..., 0]
+
+    return out
+
+
+class Climatology:
+    """
+    Mergeable accumulators of the L3 of one aggregation.
+
+    Parameters
+    ----------
+    time_agg : int
+        seconds, of the L3 files added
+    state_file : str, optional
+        the accumulators are loaded from and saved to this file
+    """
+
+    def __init__(self, time_agg, max_flag_pc=MAX_FLAG_PC, state_file=None):
+        self.time_agg = int(time_agg)
+        self.max_flag_pc = max_flag_pc
+        self.state_file = state_file
+        self.ws_bins = int(np.ceil(harmonise.MAX_VALID_WS / WS_BIN_WIDTH))
+        self.altitude = None
+        self.stations = {}
+        self.files = {}
+        self.time_range = None
+        if state_file is not None and os.path.exists(state_file):
+            with open(state_file, "rb") as f:
+                state = pickle.load(f)
+            for key in ["time_agg", "max_flag_pc"]:
+                if state[key] != getattr(self, key):
+                    raise ValueError(
+                        f"{state_file} is for {key} {state[key]}, rebuild")
+            for key in ["altitude", "stations", "files", "time_range"]:
+                setattr(self, key, state[key])
+
+    def save(self):
+        if self.state_file is None:
+            return
+        tmp_file = f"{self.state_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "wb") as f:
+            pickle.dump({key: getattr(self, key) for key in [
+                "time_agg", "max_flag_pc", "altitude", "stations", "files",
+                "time_range"]}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, self.state_file)
+
+    def _station(self, station_code):
+        n_altitude = len(self.altitude)
+        return self.stations.setdefault(station_code, {
+            "n": np.zeros((12, 24, n_altitude), dtype=np.int64),
+            "sum": {var: np.zeros((12, 24, n_altitude))
+                    for var in MEAN_VARS},
+            "ws_hist": np.zeros((12, n_altitude, self.ws_bins),
+                                dtype=np.int64),
+            "rose": np.zeros((12, n_altitude, WD_SECTORS, len(WS_CLASSES)),
+                             dtype=np.int64),
+        })
+
+    def _check_altitude(self, altitude):
+        if self.altitude is None:
+            self.altitude = np.asarray(altitude)
+        elif not np.array_equal(self.altitude, altitude):
+            raise ValueError("The altitude grid differs from the L3 added "
+                             "before")
+
+    def add_block(self, dat):
+        """Add the L3 time steps of dat (u, v, ws, wd and the flags, loaded)."""
+        self._check_altitude(dat.altitude.values)
+        n_altitude = len(self.altitude)
+        times = pd.DatetimeIndex(dat.time.values)
+        month_hour = (times.month.values - 1) * 24 + times.hour.values
+        dims = ("station", "time", "altitude")
+        values = {var: dat[var].transpose(*dims).values
+                  for var in MEAN_VARS + ["wd"]}
+        ok = l3diag.usable(dat.transpose(*dims), self.max_flag_pc)
+        for var in MEAN_VARS:
+            ok &= np.isfinite(values[var])
+
+        for s, station_code in enumerate(dat.station.values):
+            time_index, z = np.nonzero(ok[s])
+            if not len(z):
+                continue
+            acc = self._station(str(station_code))
+            cell = month_hour[time_index] * n_altitude + z
+            acc["n"] += np.bincount(
+                cell, minlength=acc["n"].size).reshape(acc["n"].shape)
+            for var in MEAN_VARS:
+                acc["sum"][var] += np.bincount(
+                    cell, weights=values[var][s][ok[s]],
+                    minlength=acc["n"].size).reshape(acc["n"].shape)
+
+            month = month_hour[time_index] // 24
+            ws = values["ws"][s][ok[s]]
+            ws_bin = np.minimum((ws / WS_BIN_WIDTH).astype(np.int64),
+                                self.ws_bins - 1)
+            acc["ws_hist"] += np.bincount(
+                (month * n_altitude + z) * self.ws_bins + ws_bin,
+                minlength=acc["ws_hist"].size).reshape(acc["ws_hist"].shape)
+
+            wd = values["wd"][s][ok[s]]
+            has_wd = np.isfinite(wd)
+            sector = np.floor(
+                (wd[has_wd] + 180 / WD_SECTORS) / (360 / WD_SECTORS)
+            ).astype(np.int64) % WD_SECTORS
+            ws_class = np.searchsorted(WS_CLASSES, ws[has_wd],
+                                       side="right") - 1
+            acc["rose"] += np.bincount(
+                (((month[has_wd] * n_altitude + z[has_wd]) * WD_SECTORS +
+                  sector) * len(WS_CLASSES) + ws_class),
+                minlength=acc["rose"].size).reshape(acc["rose"].shape)
+
+        if len(times):
+            self.time_range = (
+                min(times[0], self.time_range[0]),
+                max(times[-1], self.time_range[1])) \
+                if self.time_range else (times[0], times[-1])
+
+    def add_file(self, l3_file, block_size=BLOCK_SIZE):
+        """
+        Add an L3 file in blocks of time steps of about block_size bytes.
+
+        Returns
+        -------
+        False if the file was added before (a warning if it changed since)
+        """
+        key = os.path.relpath(l3_file, harmonise.L3_BASEDIR).replace(
+            os.sep, "/")
+        fingerprint = harmonise.file_fingerprint(l3_file)
+        if key in self.files:
+            if self.files[key]["mtime"] != fingerprint["mtime"] or \
+                    self.files[key]["size"] != fingerprint["size"]:
+                logging.warning(f"{l3_file} changed since it was added to the "
+                                "climatology, not added again (rebuild)")
+            return False
+
+        with xr.open_dataset(l3_file) as src:
+            if int(src.attrs["aggregation_time_s"]) != self.time_agg:
+                raise ValueError(f"{l3_file} is not {self.time_agg}s")
+            inputs = MEAN_VARS + ["wd"] + [
+                var for var in src.data_vars if var.startswith("flag")]
+            bytes_per_step = sum(
+                src[var].dtype.itemsize * src[var].size / src.sizes["time"]
+                for var in inputs)
+            block_steps = memtrack.block_length(
+                block_size, bytes_per_step, src.sizes["time"],
+                working_set_factor=WORKING_SET_FACTOR)
+            for i in range(0, src.sizes["time"], block_steps):
+                self.add_block(src[inputs].isel(
+                    time=slice(i, i + block_steps)).load())
+        self.files[key] = fingerprint
+
+        return True
+
+    def merge(self, other):
+        """Add the accumulators of another Climatology (e.g. of a worker)."""
+        if other.altitude is None:
+            return self
+        duplicates = set(self.files) & set(other.files)
+        if duplicates:
+            raise ValueError(f"{sorted(duplicates)} added to both")
+        self._check_altitude(other.altitude)
+        for station_code, other_acc in other.stations.items():
+            acc = self._station(station_code)
+            for key in ["n", "ws_hist", "rose"]:
+                acc[key] += other_acc[key]
+            for var in MEAN_VARS:
+                acc["sum"][var] += other_acc["sum"][var]
+        self.files.update(other.files)
+        if other.time_range:
+            self.time_range = (
+                min(other.time_range[0], self.time_range[0]),
+                max(other.time_range[1], self.time_range[1])) \
+                if self.time_range else other.time_range
+
+        return self
+
+    def summary(self):
+        """
+        The climatology product of the accumulators (without global attrs),
+        None if nothing was added.
+        """
+        if not self.stations:
+            return None
+        station_codes = sorted(self.stations)
+        accs = [self.stations[station_code] for station_code in station_codes]
+
+        def stack(key):
+            return np.stack([acc[key] for acc in accs])
+
+        n_diurnal = stack("n")
+        n_monthly = n_diurnal.sum(axis=2)
+        data_vars = {
+            "n_diurnal": (["station", "month", "hour", "altitude"],
+                          n_diurnal),
+            "n_monthly": (["station", "month", "altitude"], n_monthly),
+        }
+        with np.errstate(invalid="ignore", divide="ignore"):
+            for var in MEAN_VARS:
+                sums = np.stack([acc["sum"][var] for acc in accs])
+                data_vars[f"{var}_diurnal"] = (
+                    ["station", "month", "hour", "altitude"],
+                    np.where(n_diurnal > 0, sums / n_diurnal, np.nan))
+                data_vars[f"{var}_monthly"] = (
+                    ["station", "month", "altitude"],
+                    np.where(n_monthly > 0, sums.sum(axis=2) / n_monthly,
+                             np.nan))
+            rose = stack("rose")
+            rose_total = rose.sum(axis=(-2, -1), keepdims=True)
+            data_vars["wind_rose"] = (
+                ["station", "month", "altitude", "wd_sector", "ws_class"],
+                np.where(rose_total > 0, rose / rose_total * 100, np.nan))
+        for period in ["diurnal", "monthly"]:
+            data_vars[f"wd_{period}"] = (
+                data_vars[f"u_{period}"][0], harmonise.vector_to_ws_wd(
+                    data_vars[f"u_{period}"][1],
+                    data_vars[f"v_{period}"][1])[1])
+        data_vars["ws_quantile"] = (
+            ["station", "month", "quantile", "altitude"],
+            np.moveaxis(histogram_quantiles(
+                stack("ws_hist"), QUANTILES, WS_BIN_WIDTH), 0, 2))
+
+        return xr.Dataset(data_vars=data_vars, coords={
+            "station": station_codes,
+            "month": np.arange(1, 13),
+            "hour": np.arange(24),
+            "altitude": self.altitude,
+            "quantile": QUANTILES,
+            "wd_sector": np.arange(WD_SECTORS) * 360 / WD_SECTORS,
+            "ws_class": WS_CLASSES,
+        })
+
+    def attrs(self):
+        return {
+            "title": "Climatology of the harmonised boundary layer wind "
+            "profiles across Paris, France",
+            "processing_level": "L3 derived",
+            "processing_level_description": "Diurnal and monthly mean "
+            "profiles, wind speed quantiles and wind roses of the L3 wind "
+            "profiles, by month of the year.",
+            "processing_name": "climatology.py",
+            "processing_version_clim": str(__version__),
+            "processing_version_L3": str(L2_to_L3.__version__),
+            "processing_time_utc": dt.datetime.now(
+                tz=dt.timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+            "start_time_utc": str(self.time_range[0]),
+            "end_time_utc": str(self.time_range[1]),
+            "aggregation_time_s": self.time_agg,
+            "source_files": len(self.files),
+            "climatology_parameters": json.dumps({
+                "max_flag_pc": self.max_flag_pc,
+                "ws_bin_width": WS_BIN_WIDTH}, sort_keys=True),
+        }
+
+
+def write_climatology(clim):
+    """Write the summary product of clim, None if there is nothing in it."""
+    dat = clim.summary()
+    if dat is None:
+        return None
+    dat = dat.merge(xr.Dataset.from_dataframe(
+        L2_to_L3.stations_table()).sel(station=dat.station.values))
+    dat = harmonise.apply_attrs(dat, level=3)
+    dat.attrs = clim.attrs()
+    nc_file = clim_filename(clim.time_agg)
+    os.makedirs(os.path.dirname(nc_file), exist_ok=True)
+    tmp_file = f"{nc_file}.{os.getpid()}.tmp"
+    harmonise.to_netcdf_trimmed(
+        dat, tmp_file, encoding=harmonise.encode_nc_compression(dat, level=3))
+    os.replace(tmp_file, nc_file)
+    logging.info(nc_file)
+
+    return nc_file
+
+
+def _add_files(args):
+    l3_files, time_agg, max_flag_pc, block_size = args
+    clim = Climatology(time_agg, max_flag_pc)
+    for l3_file in l3_files:
+        clim.add_file(l3_file, block_size)
+    return clim
+
+
+def l3_files(start_datetime, end_datetime, time_agg):
+    """The L3 files of every day in [start, end]."""
+    days = pd.date_range(start_datetime, end_datetime, freq="D")
+    filenames = [L2_to_L3.l3_filename(
+        str(day), str(day + pd.Timedelta(days=1)), time_agg) for day in days]
+    return [filename for filename in filenames if os.path.exists(filename)]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Update the campaign climatology with new L3 files.")
+    parser.add_argument("-s", "--startdate", required=True,
+                        help="Start date in ISO format")
+    parser.add_argument("-e", "--enddate", required=True,
+                        help="End date (inclusive) in ISO format")
+    parser.add_argument("--time-agg", type=int, default=L2_to_L3.time_aggs[0],
+                        help="L3 aggregation (s)")
+    parser.add_argument("--max-flag-pc", type=float, default=MAX_FLAG_PC,
+                        help="Do not use L3 values with more of their "
+                        "samples flagged (%%)")
+    parser.add_argument("--block-size", type=memtrack.parse_size,
+                        default=BLOCK_SIZE,
+                        help="Bytes of L3 processed at once per worker, "
+                        "e.g. 256M")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="Workers the new L3 files are split between")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="Start from empty accumulators instead of the "
+                        "state of the previous runs")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    state_file = os.path.join(harmonise.CLIM_BASEDIR, STATE_FILENAME.format(
+        time_agg=args.time_agg))
+    os.makedirs(harmonise.CLIM_BASEDIR, exist_ok=True)
+    if args.rebuild and os.path.exists(state_file):
+        os.remove(state_file)
+    clim = Climatology(args.time_agg, args.max_flag_pc, state_file)
+
+    filenames = l3_files(args.startdate, args.enddate, args.time_agg)
+    new = [filename for filename in filenames if os.path.relpath(
+        filename, harmonise.L3_BASEDIR).replace(os.sep, "/")
+        not in clim.files]
+    for filename in set(filenames) - set(new):
+        # only warns if the file changed
+        clim.add_file(filename)
+    logging.info(f"{len(new)} new L3 files, {len(clim.files)} added before")
+    if args.workers > 1 and len(new) > 1:
+        tasks = [(new[i::args.workers], args.time_agg, args.max_flag_pc,
+                  args.block_size) for i in range(args.workers)]
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            for worker_clim in pool.map(_add_files, tasks):
+                clim.merge(worker_clim)
+    else:
+        for filename in new:
+            clim.add_file(filename, args.block_size)
+
+    clim.save()
+    write_climatology(clim)
+
+
+if __name__ == "__main__":
+    main()
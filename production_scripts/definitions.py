@@ -4,6 +4,8 @@ Created on Thu Jul  4 14:01:52 2024
 
 @author: willm
 """
+import os
+
 # output directory definitions
 L1_BASEDIR = "D:/Urbisphere/sandbox/data/L1/by-serialnr/France/Paris/"
 L2_BASEDIR = "D:/Urbisphere/sandbox/data/L2/by-serialnr/France/Paris/"
@@ -12,6 +14,33 @@ L3_BASEDIR = "D:/urbisphere/sandbox/data/L3/by-instrumentmodel/DWL/"
 L1_BASEDIR = "C:/Users/wmorris2/data/urbisphere/sandbox/data/L1/by-serialnr/France/Paris/"
 L2_BASEDIR = "C:/Users/wmorris2/data/urbisphere/sandbox/data/L2/by-serialnr/France/Paris/"
 L3_BASEDIR = "C:/Users/wmorris2/data/urbisphere/sandbox/data/L3/by-instrumentmodel/DWL/"
+QL_BASEDIR = "C:/Users/wmorris2/data/urbisphere/sandbox/data/QL/by-instrumentmodel/DWL/"
+DIAG_BASEDIR = "C:/Users/wmorris2/data/urbisphere/sandbox/data/L3diag/by-instrumentmodel/DWL/"
+CLIM_BASEDIR = "C:/Users/wmorris2/data/urbisphere/sandbox/data/L3clim/by-instrumentmodel/DWL/"
+
+# input RAW StreamLine archive
+RAW_BASEDIR = os.path.join(
+    "D:/urbisphere/status-meteo-archive-offline/srv/meteo/archive/urbisphere/",
+    "data/RAW/by-source/smurobs/by-serialnr/France/Paris/StreamLine/",
+)
+
+# deployment and station metadata
+DEPLOYMENTS_FILE = "meta/deployments-DWL.json"
+STATIONS_FILE = "meta/stations-DWL.json"
+
+# run the whole pipeline on another data tree with its own metadata, e.g. a
+# campaign written by synthetic_campaign.py
+DATA_DIR = os.environ.get("PARIS_DWL_DATA_DIR")
+if DATA_DIR:
+    RAW_BASEDIR = os.path.join(DATA_DIR, "RAW", "StreamLine", "")
+    L1_BASEDIR = os.path.join(DATA_DIR, "L1", "")
+    L2_BASEDIR = os.path.join(DATA_DIR, "L2", "")
+    L3_BASEDIR = os.path.join(DATA_DIR, "L3", "")
+    QL_BASEDIR = os.path.join(DATA_DIR, "QL", "")
+    DIAG_BASEDIR = os.path.join(DATA_DIR, "L3diag", "")
+    CLIM_BASEDIR = os.path.join(DATA_DIR, "L3clim", "")
+    DEPLOYMENTS_FILE = os.path.join(DATA_DIR, "meta", "deployments-DWL.json")
+    STATIONS_FILE = os.path.join(DATA_DIR, "meta", "stations-DWL.json")
 
 # some label defs
 WS_UNITS = "m.s^-1"
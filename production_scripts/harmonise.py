@@ -3,10 +3,17 @@
 Created on Thu Jun 20 11:47:12 2024
 
 @author: willm
+
+xarray is imported in the functions that use it, so the paths, metadata
+and helpers here are cheap to import (e.g. for staging.py).
 """
 import numpy as np
 import json
-import xarray as xr
+import os
+import hashlib
+import bisect
+import datetime as dt
+from collections import namedtuple, defaultdict
 from vardimdefs import vardimdefs
 from definitions import *
 
@@ -15,18 +22,252 @@ class GateLengthNotIdentical(Exception):
     pass
 
 
-def get_deployments(json_filename="meta/deployments-DWL.json"):
+def get_deployments(json_filename=None):
+    json_filename = json_filename or DEPLOYMENTS_FILE
     with open(json_filename) as json_file:
         deployments = json.load(json_file)
     return deployments
 
 
-def get_stations(json_filename="meta/stations-DWL.json"):
+def get_stations(json_filename=None):
+    json_filename = json_filename or STATIONS_FILE
     with open(json_filename) as json_file:
         deployments = json.load(json_file)
     return deployments
 
 
+Deployment = namedtuple("Deployment", [
+    "index",
+    "station_code",
+    "instrument_serial",
+    "instrument_type",
+    "start_datetime",
+    "end_datetime",
+    "above_sea_level_m",
+    "do_bg_corr",
+    "options",
+    "raw_files",
+])
+
+
+class DeploymentCalendar:
+    """
+    Interval index over the deployments in meta/deployments-DWL.json.
+
+    The deployment start and end times split the timeline into elementary
+    segments, each holding the deployments active throughout it. A query for
+    [t0, t1) bisects the segment boundaries, so it costs O(log n + k) rather
+    than a scan of every deployment. Deployments are half-open intervals
+    [start_datetime, end_datetime).
+    """
+
+    def __init__(self, deployments):
+        self.deployments = [
+            Deployment(
+                index=i,
+                station_code=d["station"]["code"],
+                instrument_serial=d["instrument"]["serial"],
+                instrument_type=d["instrument"]["type"],
+                start_datetime=dt.datetime.fromisoformat(d["start_datetime"]),
+                end_datetime=dt.datetime.fromisoformat(d["end_datetime"]),
+                above_sea_level_m=d["above_sea_level_m"],
+                do_bg_corr=d.get("do_bg_corr"),
+                options=d.get("options", {}),
+                raw_files=d.get("raw_files", []),
+            ) for i, d in enumerate(deployments)
+        ]
+        self.station_codes = sorted(
+            {d.station_code for d in self.deployments})
+
+        self._bounds = sorted(
+            {d.start_datetime for d in self.deployments} |
+            {d.end_datetime for d in self.deployments})
+        self._segments = [[] for _ in range(max(len(self._bounds) - 1, 0))]
+        for d in self.deployments:
+            first = bisect.bisect_left(self._bounds, d.start_datetime)
+            last = bisect.bisect_left(self._bounds, d.end_datetime)
+            for segment in range(first, last):
+                self._segments[segment].append(d.index)
+
+    @classmethod
+    def from_json(cls, json_filename=None):
+        return cls(get_deployments(json_filename))
+
+    def active(self, t0, t1):
+        """
+        All deployments active at any time in [t0, t1), ordered by start time
+        then by their order in the json file.
+        """
+        first = max(bisect.bisect_right(self._bounds, t0) - 1, 0)
+        last = min(bisect.bisect_left(self._bounds, t1), len(self._segments))
+        indices = set()
+        for segment in self._segments[first:last]:
+            indices.update(segment)
+        active = [self.deployments[i] for i in indices]
+
+        return sorted(active, key=lambda d: (d.start_datetime, d.index))
+
+    def resolve(self, t0, t1, key="station_code"):
+        """
+        One deployment per key (e.g. station_code or instrument_serial) for
+        [t0, t1). Concurrent deployments are resolved to the one covering most
+        of [t0, t1), then the one that started last, then the one listed last
+        in the json file.
+        """
+        candidates = defaultdict(list)
+        for d in self.active(t0, t1):
+            candidates[getattr(d, key)].append(d)
+
+        def overlap(d):
+            return min(d.end_datetime, t1) - max(d.start_datetime, t0)
+
+        resolved = [
+            max(ds, key=lambda d: (overlap(d), d.start_datetime, d.index))
+            for ds in candidates.values()
+        ]
+        return sorted(resolved, key=lambda d: getattr(d, key))
+
+    def concurrent(self, t0, t1, key="station_code"):
+        """The keys that have more than one deployment active in [t0, t1)."""
+        counts = defaultdict(int)
+        for d in self.active(t0, t1):
+            counts[getattr(d, key)] += 1
+        return sorted(k for k, n in counts.items() if n > 1)
+
+
+# how each L3_fun in vardimdefs aggregates a resampled L2 variable, given the
+# number of samples that could have been in each interval
+L3_FUNS = {
+    "mean": lambda resampled, n_maxsamples: resampled.mean(),
+    "pc": lambda resampled, n_maxsamples: (
+        resampled.sum() / n_maxsamples) * 100,
+}
+DEFAULT_COMPRESSION = {"zlib": True, "complevel": 2}
+# levels per netCDF chunk of the variables on the vertical grid (see
+# to_netcdf_trimmed)
+Z_CHUNK_LEVELS = 20
+
+VarDimDef = namedtuple("VarDimDef", [
+    "name",
+    "level",
+    "type",
+    "L2_name",
+    "L3_fun",
+    "aggregate",
+    "attrs",
+    "encoding",
+])
+
+
+class VarDimRegistry:
+    """
+    vardimdefs compiled once into lookups by (name, level) and by
+    (L2_name, level), with the attributes, aggregation function and netCDF
+    encoding (compression, chunksizes, dtype) of each variable resolved up
+    front.
+
+    A vardimdefs entry can override the default compression with
+    "compression" (None for uncompressed), and set "chunksizes" and "dtype".
+    """
+    attr_keys = ['standard_name', 'long_name', 'units', 'comment',
+                 'reference_geoid']
+
+    def __init__(self, vardimdefs):
+        self._by_name = {}
+        self._by_l2_name = {}
+        self._aggregated = defaultdict(list)
+        duplicates = set()
+
+        for d in vardimdefs:
+            compression = d.get("compression", DEFAULT_COMPRESSION)
+            encoding = dict(compression or {})
+            for k in ["chunksizes", "dtype"]:
+                if d.get(k) is not None:
+                    encoding[k] = d[k]
+            vardimdef = VarDimDef(
+                name=d.get("name"),
+                level=d.get("level"),
+                type=d.get("type"),
+                L2_name=d.get("L2_name"),
+                L3_fun=d.get("L3_fun"),
+                aggregate=L3_FUNS.get(d.get("L3_fun")),
+                attrs={k: d[k] for k in self.attr_keys if d.get(k)},
+                encoding=encoding,
+            )
+            key = (vardimdef.name, vardimdef.level)
+            if key in self._by_name:
+                duplicates.add(key)
+            self._by_name[key] = vardimdef
+            if vardimdef.L2_name is not None:
+                self._by_l2_name[(vardimdef.L2_name, vardimdef.level)] = \
+                    vardimdef
+            if vardimdef.type == "variable" and vardimdef.aggregate:
+                self._aggregated[vardimdef.level].append(vardimdef)
+
+        # ambiguous definitions are treated as missing
+        for key in duplicates:
+            del self._by_name[key]
+
+    def get(self, name, level):
+        return self._by_name.get((name, level))
+
+    def from_L2_name(self, L2_name, level):
+        return self._by_l2_name.get((L2_name, level))
+
+    def aggregated(self, level):
+        """The variables aggregated from L2 for level, in vardimdefs order."""
+        return self._aggregated[level]
+
+    def encoding(self, name, level=None):
+        vardimdef = self.get(name, level) if level is not None else None
+        if vardimdef is None:
+            return dict(DEFAULT_COMPRESSION)
+        return dict(vardimdef.encoding)
+
+
+vardim_registry = VarDimRegistry(vardimdefs)
+
+
+def file_fingerprint(filename, basedir=None, checksum=False):
+    """
+    Describe a file well enough to tell whether it has changed since a product
+    that consumed it was made.
+
+    Parameters
+    ----------
+    filename : str | os.PathLike
+        Path to the file.
+    basedir : str, optional
+        If given, the recorded path is relative to basedir so that fingerprints
+        survive moving the data tree.
+    checksum : bool
+        Record the sha256 of the file contents instead of the mtime. Slower,
+        but immune to mtime changes from copying or touching the file.
+
+    Returns
+    -------
+    dict with path, size and mtime (or sha256)
+
+    """
+    stat = os.stat(filename)
+    path = os.path.relpath(filename, basedir) if basedir else \
+        os.fspath(filename)
+    fingerprint = {
+        "path": path.replace(os.sep, "/"),
+        "size": stat.st_size,
+    }
+    if not checksum:
+        fingerprint["mtime"] = int(stat.st_mtime)
+    else:
+        sha256 = hashlib.sha256()
+        with open(filename, "rb") as f:
+            for block in iter(lambda: f.read(2**20), b""):
+                sha256.update(block)
+        fingerprint["sha256"] = sha256.hexdigest()
+
+    return fingerprint
+
+
 def range_to_height_adjust(dat, elevation):
     """
 
@@ -62,23 +303,127 @@ def sea_level_adjust(dat, instrument_sea_level):
     return dat
 
 
-def ws_wd_to_vector(ws, wd):
+def _vector_buffers(a, b, out, dtype):
+    # output buffers in the precision numpy gives the inputs (float32 stays
+    # float32, anything else float64), or in dtype
+    if out is not None:
+        return out
+    if dtype is None:
+        dtype = np.result_type(a, b, np.float32)
+    shape = np.broadcast_shapes(np.shape(a), np.shape(b))
+    return np.empty(shape, dtype=dtype), np.empty(shape, dtype=dtype)
+
+
+def _as_dtype(a, dtype):
+    return np.asarray(a) if dtype is None else np.asarray(a, dtype=dtype)
+
+
+def ws_wd_to_vector(ws, wd, out=None, dtype=None):
+    """
+
 
-    u = -1 * ws * np.sin(wd * np.pi / 180)
-    v = -1 * ws * np.cos(wd * np.pi / 180)
+    Parameters
+    ----------
+    ws : np.ndarray
+        Horizontal wind speed.
+    wd : np.ndarray
+        Horizontal wind direction (degrees, direction the wind comes from).
+    out : tuple of np.ndarray, optional
+        Buffers for u and v with the broadcast shape of ws and wd. They must
+        not share memory with ws or wd.
+    dtype : np.dtype, optional
+        Opt in to computing in this precision, e.g. float32 for float64
+        input. By default the precision of the inputs, as -ws * sin(wd)
+        gives: float32 input stays float32, anything else is float64.
+
+    Returns
+    -------
+    u, v : np.ndarray
+        Computed in place in the output buffers without temporaries, with the
+        operations of -1 * ws * np.sin(wd * np.pi / 180) so that the values
+        are the same.
+
+    """
+    ws = _as_dtype(ws, dtype)
+    wd = _as_dtype(wd, dtype)
+    u, v = _vector_buffers(ws, wd, out, dtype)
+
+    np.multiply(wd, np.pi, out=v)
+    np.divide(v, 180, out=v)
+    np.sin(v, out=u)
+    np.cos(v, out=v)
+    # -1 * ws * x is -(ws * x) exactly
+    np.multiply(u, ws, out=u)
+    np.negative(u, out=u)
+    np.multiply(v, ws, out=v)
+    np.negative(v, out=v)
 
     return u, v
 
 
-def vector_to_ws_wd(u, v):
+def vector_to_ws_wd(u, v, out=None, dtype=None):
+    """
 
-    horizontal_wind_speed = np.sqrt(u**2 + v**2)
-    horizontal_wind_direction = (np.arctan2(-u, -v) * 180/np.pi)
-    horizontal_wind_direction[horizontal_wind_direction <= 0] += 360.
+
+    Parameters
+    ----------
+    u : np.ndarray
+        Eastward wind component.
+    v : np.ndarray
+        Northward wind component.
+    out : tuple of np.ndarray, optional
+        Buffers for ws and wd with the broadcast shape of u and v. They must
+        not share memory with u or v.
+    dtype : np.dtype, optional
+        Opt in to computing in this precision (see ws_wd_to_vector).
+
+    Returns
+    -------
+    horizontal_wind_speed, horizontal_wind_direction : np.ndarray
+        Direction in (0, 360], computed in the output buffers with the
+        operations of np.sqrt(u**2 + v**2) and
+        np.arctan2(-u, -v) * 180 / np.pi so that the values are the same.
+
+    """
+    u = _as_dtype(u, dtype)
+    v = _as_dtype(v, dtype)
+    horizontal_wind_speed, horizontal_wind_direction = _vector_buffers(
+        u, v, out, dtype)
+
+    np.multiply(v, v, out=horizontal_wind_direction)
+    np.multiply(u, u, out=horizontal_wind_speed)
+    np.add(horizontal_wind_speed, horizontal_wind_direction,
+           out=horizontal_wind_speed)
+    np.sqrt(horizontal_wind_speed, out=horizontal_wind_speed)
+
+    # -v is the only temporary of the size of the data
+    np.negative(u, out=horizontal_wind_direction)
+    np.arctan2(horizontal_wind_direction, np.negative(v),
+               out=horizontal_wind_direction)
+    np.multiply(horizontal_wind_direction, 180,
+                out=horizontal_wind_direction)
+    np.divide(horizontal_wind_direction, np.pi,
+              out=horizontal_wind_direction)
+    # keep directions in (0, 360]
+    np.add(horizontal_wind_direction, 360., out=horizontal_wind_direction,
+           where=horizontal_wind_direction <= 0)
 
     return horizontal_wind_speed, horizontal_wind_direction
 
 
+def vector_to_ws_wd_xr(u, v):
+    """
+    vector_to_ws_wd for xr.DataArray u and v. Dask backed arrays stay lazy
+    and are converted chunk by chunk.
+    """
+    import xarray as xr
+
+    dtype = np.result_type(u.dtype, v.dtype, np.float32)
+    return xr.apply_ufunc(
+        vector_to_ws_wd, u, v, output_core_dims=[[], []],
+        dask="parallelized", output_dtypes=[dtype, dtype])
+
+
 def select_preharmonisation_data_vars(dat):
 
     data_vars = [
@@ -100,12 +445,15 @@ def select_preharmonisation_data_vars(dat):
     return dat
 
 
-def encode_nc_compression(dat):
-    not_compressed = [
-        "system_id",
-    ]
-    return {var: {'zlib': True, "complevel": 2}
-            for var in dat.data_vars if var not in not_compressed}
+def encode_nc_compression(dat, level=None, registry=None):
+    """
+    netCDF encoding for every data variable of dat. With a level, the
+    compression, chunking and dtype come from the variable's vardimdefs
+    entry, otherwise (and for variables without an entry) the default
+    compression is used.
+    """
+    registry = registry or vardim_registry
+    return {var: registry.encoding(var, level) for var in dat.data_vars}
 
 
 def flag_ws_out_of_range(dat, ws_var_name="horizontal_wind_speed"):
@@ -124,54 +472,95 @@ def flag_ws_out_of_range(dat, ws_var_name="horizontal_wind_speed"):
     return dat
 
 
-def apply_attrs(dat, level: int, vardimdefs=vardimdefs):
-    attr_keys = ['standard_name', 'long_name', 'units', 'comment', 'reference_geoid']
+def apply_attrs(dat, level: int, registry=None):
+    registry = registry or vardim_registry
 
     for var in [*dat.coords, *dat.data_vars]:
-        vardimdef = [
-            d for d in vardimdefs if
-            (d.get("name") == var) and
-            (d.get("level") == level)
-        ]
-        if not vardimdef or len(vardimdef) > 1:
+        vardimdef = registry.get(var, level)
+        if vardimdef is None:
             print(f"{var} has incorrect attr definitions")
             continue
-        vardimdef = vardimdef[0]
-        attrs = {k: vardimdef[k] for k in attr_keys if vardimdef.get(k)}
-        dat[var].attrs = attrs
+        dat[var].attrs = dict(vardimdef.attrs)
     return dat
 
 
-def time_resample(dat, res=600, vardimdefs=vardimdefs):
+def time_resample(dat, res=600, registry=None):
+    import xarray as xr
+
+    registry = registry or vardim_registry
     out_list = []
     res = f"{res}s"
 
     n_maxsamples = xr.ones_like(dat.u).resample(time=res).count()
 
-    for vardef in vardimdefs:
-        if vardef.get("type") != "variable":
+    for vardef in registry.aggregated(level=3):
+        if vardef.L2_name not in dat.data_vars:
             continue
-        if vardef.get("L2_name") in dat.data_vars:
-            dat_var = dat[vardef["L2_name"]].resample(time=res)
-            if vardef["L3_fun"] == "mean":
-                dat_var = dat_var.mean()
-            if vardef["L3_fun"] == "pc":
-                dat_var = (dat_var.sum() / n_maxsamples) * 100
-        else:
-            continue
-        dat_var = dat_var.rename(vardef["name"])
+        dat_var = vardef.aggregate(
+            dat[vardef.L2_name].resample(time=res), n_maxsamples)
+        dat_var = dat_var.rename(vardef.name)
         out_list.append(dat_var)
 
     out_dat = xr.merge(out_list)
     return out_dat
 
 
-def z_resample(dat, min_z, max_z, res_z, z_name="altitude"):
+def valid_top(dat, z_name="altitude", keep_dims=(), registry=None):
+    """
+    Highest z_name of dat with data at any time: a finite value of a variable
+    aggregated to L3 as a mean, or a non-zero value (a raised flag) of one
+    aggregated as a percentage. dat can have the L2 or the L3 names.
+
+    Returns
+    -------
+    xr.DataArray over keep_dims, NaN where there is no data
+    """
+    import xarray as xr
+
+    registry = registry or vardim_registry
+    has_data = xr.zeros_like(dat[z_name], dtype=bool)
+    for vardef in registry.aggregated(level=3):
+        for name in {vardef.L2_name, vardef.name}:
+            if name not in dat.data_vars or z_name not in dat[name].dims:
+                continue
+            if vardef.L3_fun == "pc":
+                var_has_data = dat[name].fillna(0) != 0
+            else:
+                var_has_data = dat[name].notnull()
+            has_data = has_data | var_has_data.any(
+                [dim for dim in var_has_data.dims
+                 if dim != z_name and dim not in keep_dims])
+
+    return dat[z_name].where(has_data).max(z_name)
+
+
+def z_levels(min_z, max_z, res_z):
+    """The levels of z_resample(dat, min_z, max_z, res_z)."""
+    return np.arange(min_z, max_z, res_z)
+
+
+def z_resample(dat, min_z, max_z, res_z, z_name="altitude", trim=False):
+    """
+    dat on the levels z_levels(min_z, max_z, res_z). With trim, only on those
+    up to the gate above the valid top of dat (valid_top), which is all the
+    levels that can have data: the levels above are left out rather than
+    computed as missing.
+    """
     # if the vertical coordinate is not int, then there are some issues
     # so far just assume vertical coordinate is int or n.5, so use 0.5 res step
     height_gate_lengths = np.unique(np.round(np.diff(dat[z_name]), 1))
     if len(height_gate_lengths) > 1:
         raise GateLengthNotIdentical
+    if trim:
+        # profiles are interpolated up to the gate above the top
+        top = valid_top(dat, z_name).item()
+        z = dat[z_name].values
+        if np.isnan(top):
+            top = min_z
+        elif np.any(z > top):
+            top = z[z > top].min()
+        max_z = min(max_z, int(
+            min_z + (np.floor((top + 0.5 - min_z) / res_z) + 1) * res_z))
     dat = dat.sel({z_name: slice(0, max_z + (res_z * 2))})
     dat = dat.reindex({z_name: np.arange(min_z, max_z, 1)}, method="nearest", tolerance=0.5)
     dat = dat.interpolate_na(dim=z_name, max_gap=res_z*2)
@@ -182,7 +571,73 @@ def z_resample(dat, min_z, max_z, res_z, z_name="altitude"):
     return dat
 
 
+def to_netcdf_trimmed(dat, path, encoding=None, z_name="altitude",
+                      by="station", z_chunk=Z_CHUNK_LEVELS):
+    """
+    dat.to_netcdf(path, encoding=encoding), except that the variables on
+    z_name are chunked by z_chunk levels (and single values of by) and only
+    written up to the highest level with data of each by. The chunks above
+    are never written: they take no space and read back as missing values
+    (_FillValue), so the file still reads as the full grid.
+    """
+    import xarray as xr
+    import netCDF4
+    # the lock xarray holds for netCDF4/HDF5 calls, which are not thread safe
+    from xarray.backends.netCDF4_ import NETCDF4_PYTHON_LOCK
+
+    encoding = encoding or {}
+    z_vars = [var for var in dat.data_vars if z_name in dat[var].dims]
+    dat.drop_vars(z_vars).to_netcdf(path, encoding={
+        var: var_encoding for var, var_encoding in encoding.items()
+        if var not in z_vars})
+
+    with NETCDF4_PYTHON_LOCK, netCDF4.Dataset(path, "a") as nc:
+        for name in z_vars:
+            variable = dat[name].variable.copy(deep=False)
+            variable.encoding = dict(encoding.get(name, {}))
+            var_encoding = variable.encoding
+            # as the xarray netCDF4 backend
+            variable = xr.conventions.encode_cf_variable(variable, name=name)
+            attrs = dict(variable.attrs)
+            fill_value = attrs.pop("_FillValue", None)
+            if fill_value is None and variable.dtype.kind == "f":
+                fill_value = np.nan
+            chunksizes = tuple(
+                min(z_chunk, size) if dim == z_name else
+                1 if dim == by else size
+                for dim, size in variable.sizes.items())
+            nc_var = nc.createVariable(
+                name, variable.dtype, variable.dims,
+                zlib=var_encoding.get("zlib", False),
+                complevel=var_encoding.get("complevel", 4),
+                shuffle=var_encoding.get("shuffle", True),
+                chunksizes=chunksizes, fill_value=fill_value)
+            nc_var.setncatts(attrs)
+
+            # number of levels with data of each by
+            has_data = dat[name].notnull()
+            if by in has_data.dims:
+                has_data = has_data.transpose(by, ...)
+            has_data = has_data.any([dim for dim in has_data.dims
+                                     if dim not in (by, z_name)]).values
+            n_levels = np.where(
+                has_data.any(axis=-1),
+                has_data.shape[-1] - np.argmax(has_data[..., ::-1], axis=-1),
+                0)
+            z_axis = variable.dims.index(z_name)
+            by_axis = variable.dims.index(by) if by in variable.dims else None
+            for i, n in np.ndenumerate(n_levels):
+                if n == 0:
+                    continue
+                region = [slice(None)] * variable.ndim
+                region[z_axis] = slice(0, n)
+                if by_axis is not None:
+                    region[by_axis] = i[0]
+                nc_var[tuple(region)] = variable.values[tuple(region)]
+
+
 def add_system_id_var(dat, system_id):
+    import xarray as xr
 
     system_id_values = np.full(
         dat.time.shape, system_id).astype("S" + str(len(system_id)))
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Binary cache of parsed RAW files. Parsing the ASCII .hpl scans is the
+largest cost of reprocessing RAW -> L1, yet the RAW files never change, so
+the parsed result of each file (e.g. a haloreader Halo with its time,
+azimuth, elevation, range, doppler and intensity arrays) is pickled once and
+loaded from the cache on every later run.
+
+An entry is valid for the same file path, size and mtime, parser version and
+tag (e.g. the product read). Each cache file starts with that key, so
+a stale entry is detected without loading the arrays.
+"""
+
+import os
+import pickle
+import hashlib
+import logging
+import harmonise
+
+
+class ParseCache:
+    """
+    Parameters
+    ----------
+    cache_dir : str
+    parser_version : str
+        e.g. the haloreader version, a new version invalidates all entries
+    """
+
+    def __init__(self, cache_dir, parser_version):
+        self.cache_dir = cache_dir
+        self.parser_version = str(parser_version)
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _key(self, path, tag):
+        fingerprint = harmonise.file_fingerprint(path)
+        return {"path": os.path.abspath(path), "size": fingerprint["size"],
+                "mtime": fingerprint["mtime"],
+                "parser_version": self.parser_version, "tag": str(tag)}
+
+    def _cache_file(self, key):
+        name = hashlib.sha1(
+            f"{key['path']}|{key['tag']}".encode()).hexdigest()
+        return os.path.join(self.cache_dir, name[:2], f"{name}.pkl")
+
+    def _read_key(self, cache_file):
+        with open(cache_file, "rb") as f:
+            return pickle.load(f)
+
+    def has(self, path, tag=""):
+        """Whether path has a valid entry."""
+        key = self._key(path, tag)
+        try:
+            return self._read_key(self._cache_file(key)) == key
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return False
+
+    def get(self, path, parse, tag=""):
+        """
+        The parsed path, from the cache or parse(path). parse may read
+        another copy of the file (e.g. a staged one) and return None (e.g.
+        for a file the parser skips), which is cached too.
+        """
+        key = self._key(path, tag)
+        cache_file = self._cache_file(key)
+        try:
+            with open(cache_file, "rb") as f:
+                if pickle.load(f) == key:
+                    parsed = pickle.load(f)
+                    self.hits += 1
+                    return parsed
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass
+
+        parsed = parse(path)
+        self.misses += 1
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_file, "wb") as f:
+                pickle.dump(key, f, protocol=pickle.HIGHEST_PROTOCOL)
+                pickle.dump(parsed, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, cache_file)
+        except (OSError, pickle.PicklingError) as e:
+            logging.warning(f"Could not cache {path}: {e}")
+
+        return parsed
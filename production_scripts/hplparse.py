@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""
+Parser of the HALO Photonics StreamLine .hpl scan files, in place of
+haloreader's read. read returns the haloreader Halo that read does (same
+variables, metadata and file merge), but:
+
+- the header is read once, line by line as "key:<tab>value", not through
+  the lark grammar (most of the parse time of the small scan files)
+- the data section is memory-mapped and parsed in bulk: all values split
+  and converted to float at once (in C), then reshaped to the fixed layout
+  of the ray blocks (a ray line and ngates gate lines) instead of read ray
+  by ray. The day change of the ray times and the range gate check are
+  vectorised
+- files of a different number of pulses per ray can be merged, npulses
+  is then given per ray (time)
+"""
+
+import mmap
+import logging
+import re
+from collections import Counter
+from pathlib import Path
+import numpy as np
+from haloreader.exceptions import (
+    FileEmpty,
+    HeaderNotFound,
+    InconsistentRangeError,
+    MergeError,
+    UnexpectedDataTokens,
+)
+from haloreader.halo import Halo
+from haloreader.metadata import Metadata
+from haloreader.scantype import ScanType
+from haloreader.transformer import HeaderTransformer, range_func
+from haloreader.utils import UNIX_TIME_UNIT
+from haloreader.variable import Variable
+
+__version__ = "1.0"
+
+# files haloreader's read skips (with a warning) rather than fail on
+SKIP_ERRORS = (FileEmpty, HeaderNotFound, InconsistentRangeError,
+               UnicodeDecodeError, UnexpectedDataTokens)
+
+# the header ends with the line starting "****" in the first bytes
+HEADER_END_MARKER = b"****"
+MAX_HEADER_BYTES = 2048
+
+# "Scan type" values of the header grammar
+SCAN_TYPES = {
+    "Stare": ScanType.STARE,
+    "Stare - overlapping": ScanType.STARE_OVERLAPPING,
+    "SECTORSCAN - stepped": ScanType.SECTORSCAN_STEPPED,
+    "VAD": ScanType.VAD,
+    "VAD - stepped": ScanType.VAD_STEPPED,
+    "VAD - overlapping": ScanType.VAD_OVERLAPPING,
+    "User file 1 - stepped": ScanType.USER1_STEPPED,
+    "User file 1 - csm - overlapping": ScanType.USER1_CSM_OVERLAPPING,
+    "User file 2 - stepped": ScanType.USER2_STEPPED,
+    "User file 2 - csm": ScanType.USER2_CSM,
+    "Wind profile": ScanType.WIND_PROFILE,
+    "Wind profile - overlapping": ScanType.WIND_PROFILE_OVERLAPPING,
+    "RHI": ScanType.RHI,
+}
+# header "key:\tvalue" lines, key: (metadata field, type)
+HEADER_FIELDS = {
+    "Filename": ("filename", str),
+    "System ID": ("system_id", str),
+    "Number of gates": ("ngates", int),
+    "Range gate length (m)": ("gate_range", float),
+    "Gate length (pts)": ("gate_length", int),
+    "Pulses/ray": ("npulses", int),
+    "No. of rays in file": ("nrays", int),
+    "No. of waypoints in file": ("nwaypoints", int),
+    "Scan type": ("scantype", SCAN_TYPES.__getitem__),
+    "Focus range": ("focus_range", float),
+    "Start time": ("start_time", str),
+    "Resolution (m/s)": ("resolution", float),
+}
+# columns of the "Data line 1" (ray) and "Data line 2" (gate) lines, as
+# the terminals of haloreader's header grammar
+DATA_LINE_VARIABLES = {
+    "Decimal time (hours)": "DECIMAL_TIME_H",
+    "Azimuth (degrees)": "AZIMUTH_DEG",
+    "Elevation (degrees)": "ELEVATION_DEG",
+    "Pitch (degrees)": "PITCH_DEG",
+    "Roll (degrees)": "ROLL_DEG",
+    "Range Gate": "RANGE_GATE",
+    "Doppler (m/s)": "DOPPLER",
+    "Intensity (SNR + 1)": "INTENSITY",
+    "Beta (m-1 sr-1)": "BETA",
+    "Spectral Width": "SPECTRAL_WIDTH",
+}
+DATA_LINE_PATTERN = re.compile(
+    "|".join(re.escape(label) for label in DATA_LINE_VARIABLES))
+SPECTRAL_WIDTH_PATTERN = re.compile(
+    r"^\*\*\*\* Instrument spectral width = ([-+]?\d+(\.\d+)?)$")
+
+DAY_SECONDS = 86400
+HALF_DAY_SECONDS = 43200
+
+
+def _header_end(buf):
+    """Offset of the first data byte, after the "****" line."""
+    marker = buf.find(HEADER_END_MARKER, 0, MAX_HEADER_BYTES)
+    end = -1 if marker < 0 else buf.find(b"\r\n", marker, MAX_HEADER_BYTES)
+    if end < 0:
+        raise HeaderNotFound
+    return end + 2
+
+
+def read_header(header):
+    """
+    Metadata, (ray) time variables and (gate) time range variables of the
+    decoded header, as haloreader's header grammar gives them.
+    """
+    transformer = HeaderTransformer()
+    fields = {}
+    time_vars = time_range_vars = None
+    for line in header.split("\r\n"):
+        key, sep, value = line.partition(":\t")
+        if sep and key in HEADER_FIELDS:
+            name, type_ = HEADER_FIELDS[key]
+            try:
+                fields[name] = getattr(transformer, name)([type_(value)])
+            except (KeyError, ValueError, NotImplementedError):
+                raise HeaderNotFound(f"Unexpected header line {line}")
+        elif line.startswith("Data line 1: "):
+            time_vars = _data_line_variables(transformer, line)
+        elif line.startswith("Data line 2: "):
+            time_range_vars = _data_line_variables(transformer, line)
+        elif match := SPECTRAL_WIDTH_PATTERN.match(line):
+            fields["instrument_spectral_width"] = transformer.\
+                end_of_header_with_instrument_spectral_width(
+                    [float(match.group(1))])
+    if time_vars is None or time_range_vars is None:
+        raise HeaderNotFound("No data line definitions in the header")
+    if "start_time" in fields:
+        fields.update(fields["start_time"])
+    try:
+        metadata = Metadata(**fields)
+    except TypeError:
+        missing = set(Metadata.__dataclass_fields__) - set(fields)
+        raise HeaderNotFound(f"Header without {missing}")
+    return metadata, time_vars, time_range_vars
+
+
+def _data_line_variables(transformer, line):
+    labels = DATA_LINE_PATTERN.findall(line)
+    return [getattr(transformer, DATA_LINE_VARIABLES[label])(None)
+            for label in labels]
+
+
+def _ray_blocks(data, ngates, n_time, n_range):
+    """
+    (n_time, nrays) ray and (n_range, nrays, ngates) gate values of the data
+    section: nrays blocks of n_time ray values and ngates lines of n_range
+    gate values.
+    """
+    # one C split and float conversion of all values, no loop over the lines
+    try:
+        values = np.array(data.split(), dtype=np.float64)
+    except ValueError:
+        raise UnexpectedDataTokens
+    block_length = n_time + ngates * n_range
+    if len(values) == 0 or len(values) % block_length:
+        raise UnexpectedDataTokens
+    blocks = values.reshape(-1, block_length)
+    nrays = len(blocks)
+    return (np.ascontiguousarray(blocks[:, :n_time].T),
+            np.ascontiguousarray(blocks[:, n_time:].reshape(
+                nrays, ngates, n_range).transpose(2, 0, 1)))
+
+
+def _decimal_time_to_timestamp(hours, metadata):
+    """
+    Seconds since 1970 of the decimal hours of the rays, from the start of
+    the day of the file, a day later after every step back of over 12 h.
+    """
+    day_start = np.floor(
+        metadata.start_time.data / DAY_SECONDS) * DAY_SECONDS
+    time = day_start + 3600 * hours
+    time += DAY_SECONDS * np.cumsum(np.r_[
+        False, np.diff(time) < -HALF_DAY_SECONDS])
+    return Variable(name="time", long_name="time", calendar="standard",
+                    data=time, dimensions=("time",), units=UNIX_TIME_UNIT)
+
+
+def _parse(buf):
+    if len(buf) == 0:
+        raise FileEmpty
+    header_end = _header_end(buf)
+    metadata, time_vars, time_range_vars = read_header(
+        bytes(buf[:header_end]).decode())
+    ngates = metadata.ngates.data
+    ray_values, gate_values = _ray_blocks(
+        buf[header_end:], ngates, len(time_vars), len(time_range_vars))
+    for var, value in zip(time_vars, ray_values):
+        var.data = value
+    for var, value in zip(time_range_vars, gate_values):
+        var.data = value
+    vars_ = {var.name: var for var in time_vars + time_range_vars}
+    if "range" not in vars_ or not np.isclose(
+            np.arange(ngates), vars_["range"].data).all():
+        raise InconsistentRangeError
+    vars_["time"] = _decimal_time_to_timestamp(vars_["time"].data, metadata)
+    vars_["range"] = range_func(vars_["range"], metadata.gate_range)
+    return Halo(metadata=metadata, **vars_)
+
+
+def parse_file(src):
+    """
+    haloreader Halo of one .hpl file (a path or a binary file object).
+    Raises the SKIP_ERRORS of a file that is not a valid scan file.
+    """
+    if not isinstance(src, (str, Path)):
+        return _parse(src.read())
+    with open(src, "rb") as f:
+        if f.seek(0, 2) == 0:
+            raise FileEmpty
+        # closed once the parse no longer refers to it (also from the
+        # traceback of an error), not at the end of a with block
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return _parse(buf)
+
+
+def read_file(src):
+    """parse_file, or None (with a warning) for a file haloreader skips."""
+    try:
+        return parse_file(src)
+    except SKIP_ERRORS as err:
+        logging.warning(f"Skipping file {src}", exc_info=err)
+    return None
+
+
+def npulses_changed(halo):
+    """Whether the npulses of halo are given per ray."""
+    return halo.metadata.npulses.dimensions == ("time",)
+
+
+def merge(halos, npulses_per_ray=False):
+    """
+    Halo.merge of the halos (None for skipped files are left out) with the
+    most common number of gates, as haloreader's read merges its files.
+
+    Parameters
+    ----------
+    halos : list of haloreader.halo.Halo | None
+    npulses_per_ray : bool
+        merge halos of a different number of pulses per ray (otherwise a
+        haloreader MergeError), metadata.npulses then has the (time,) pulses
+        of every ray
+
+    Returns
+    -------
+    haloreader.halo.Halo | None
+    """
+    halos = [halo for halo in halos if halo is not None]
+    most_common_ngates = Counter(
+        halo.metadata.ngates.data for halo in halos).most_common(1)
+    if not most_common_ngates:
+        return None
+    halos = [halo for halo in halos
+             if halo.metadata.ngates.data == most_common_ngates[0][0]]
+    npulses = [halo.metadata.npulses.data for halo in halos]
+    if len(set(npulses)) < 2:
+        return Halo.merge(halos)
+    if not npulses_per_ray:
+        raise MergeError(f"Files of {sorted(set(npulses))} pulses per ray")
+    # merged with the same npulses, then the npulses of each file matched
+    # to the (sorted, deduplicated) rays by time
+    times = np.concatenate([halo.time.data for halo in halos])
+    ray_npulses = np.concatenate([
+        np.full(len(halo.time.data), n) for halo, n in zip(halos, npulses)])
+    for halo in halos:
+        halo.metadata.npulses.data = npulses[0]
+    halo = Halo.merge(halos)
+    order = np.argsort(times, kind="stable")
+    halo.metadata.npulses = Variable(
+        name="npulses", long_name="number of pulses", dimensions=("time",),
+        data=ray_npulses[order][np.searchsorted(
+            times[order], halo.time.data)])
+    return halo
+
+
+def read(src_files, npulses_per_ray=False):
+    """
+    haloreader's read(src_files): the files parsed with parse_file (skipped
+    with a warning where read skips them) and merged.
+
+    Parameters
+    ----------
+    src_files : list of str | pathlib.Path | binary file objects
+    npulses_per_ray : bool
+        see merge
+
+    Returns
+    -------
+    haloreader.halo.Halo | None
+    """
+    return merge([read_file(src) for src in src_files],
+                 npulses_per_ray=npulses_per_ray)
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Read-ahead / write-behind runner for the processing stages. Each stage reads
+its inputs, computes and writes a (compressed) NetCDF per work unit; run in
+sequence the CPU waits on the archive reads and the compute waits on the
+zlib compression of the writes. pipelined() reads the next units on a
+background thread and hands finished datasets to a small writer pool while
+the current unit is computed.
+
+Memory stays bounded: at most read_ahead units are read ahead, and once
+writers results are waiting to be written the compute blocks until the oldest
+is on disk (back-pressure). xarray serialises its netCDF4/HDF5 calls with a
+lock, so reads and writes of NetCDF files do not overlap each other, only
+the compute and the parsing of other files (e.g. the RAW .hpl files).
+"""
+
+import logging
+from collections import deque
+from itertools import islice
+from concurrent.futures import Future, ThreadPoolExecutor
+
+_END = object()
+
+
+def _call(stage, function, unit, describe, failed, *args):
+    # errors are logged, not raised, so that one bad unit does not stop the
+    # others (as in L2_to_L3.process_unit). The unit is added to failed
+    try:
+        return function(*args)
+    except Exception as e:
+        logging.error(f"{e} error for {describe(unit)} ({stage})")
+        if failed is not None:
+            failed.append(unit)
+        return None
+
+
+def _finished(writes, max_pending):
+    """
+    Pop the writes at the front of writes that are finished, waiting for the
+    oldest while more than max_pending are unfinished.
+    """
+    while writes:
+        unit, written = writes[0]
+        if isinstance(written, Future):
+            pending = sum(isinstance(w, Future) and not w.done()
+                          for _, w in writes)
+            if not written.done() and pending <= max_pending:
+                return
+            written = written.result()
+        writes.popleft()
+        yield unit, written
+
+
+def pipelined(units, read, write, compute=None, read_ahead=1, writers=1,
+              describe=str, failed=None):
+    """
+    read -> compute -> write for each unit, the reads of the next units and
+    the writes of the previous ones overlapping the compute.
+
+    Parameters
+    ----------
+    units : iterable
+        consumed lazily, read_ahead units ahead of the unit computed (so
+        e.g. staging.stage_ahead prefetches from there)
+    read : callable
+        unit -> data, run on the read-ahead thread. None skips the unit
+    write : callable
+        (unit, result) -> what to yield, e.g. the filename, run by the
+        writer pool
+    compute : callable, optional
+        (unit, data) -> result, run in the calling thread. None skips the
+        unit. Default passes the data read on to write
+    read_ahead : int
+        units read ahead of the unit computed, 0 to read in the calling
+        thread
+    writers : int
+        writer threads, also the most results waiting to be written. 0 to
+        write in the calling thread
+    describe : callable
+        unit -> str for the log
+    failed : list, optional
+        the units that raised in any stage are appended to it, e.g. for the
+        exit status of a script
+
+    Yields
+    ------
+    (unit, written) in the order of units, written None if the unit was
+    skipped or failed (the error is logged)
+    """
+    units = iter(units)
+    reader = ThreadPoolExecutor(
+        max_workers=1, thread_name_prefix="read-ahead") \
+        if read_ahead > 0 else None
+    writer = ThreadPoolExecutor(
+        max_workers=writers, thread_name_prefix="write-behind") \
+        if writers > 0 else None
+    reads = deque()
+    writes = deque()
+
+    def read_more():
+        for unit in islice(units, max(read_ahead - len(reads), 0)):
+            reads.append((unit, reader.submit(
+                _call, "read", read, unit, describe, failed, unit)))
+
+    try:
+        while True:
+            if reader is None:
+                unit = next(units, _END)
+                if unit is _END:
+                    break
+                data = _call("read", read, unit, describe, failed, unit)
+            else:
+                read_more()
+                if not reads:
+                    break
+                unit, future = reads.popleft()
+                # the next read starts before this one is waited for
+                read_more()
+                data = future.result()
+
+            result = data
+            if data is not None and compute is not None:
+                result = _call("compute", compute, unit, describe, failed,
+                               unit, data)
+            del data
+            if result is None:
+                writes.append((unit, None))
+            elif writer is None:
+                writes.append((unit, _call(
+                    "write", write, unit, describe, failed, unit, result)))
+            else:
+                writes.append((unit, writer.submit(
+                    _call, "write", write, unit, describe, failed, unit,
+                    result)))
+            del result
+            yield from _finished(writes, writers)
+
+        yield from _finished(writes, 0)
+    finally:
+        if reader is not None:
+            reader.shutdown(wait=True, cancel_futures=True)
+        if writer is not None:
+            writer.shutdown(wait=True)
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+"""
+Derived diagnostics of the L3 wind profiles: vertical wind shear, speed
+shear, veer and low-level jet (LLJ) detection. Each L3 file is read in
+blocks of time steps and the diagnostics of every station, time and altitude
+of a block are computed at once with numpy over the station x time x
+altitude cube. They are written as a separate product (one file per L3 file,
+in harmonise.DIAG_BASEDIR) with the vardimdefs attributes. Only L3 files
+newer than their diagnostics are processed, all with --rebuild.
+
+L3 values with more than --max-flag-pc % of their samples flagged (any
+flag_* variable) are not used, so gradients and jets next to them are
+missing rather than computed from suspect retrievals.
+
+A jet is the wind speed maximum in the lowest LLJ_MAX_HEIGHT m above the
+station that is at least LLJ_MIN_FALLOFF m s-1 and LLJ_MIN_FALLOFF_PC %
+faster than the minimum above it within the same layer (Baas et al. 2009,
+doi:10.1175/2008JAMC1965.1, with a deeper layer for the urban boundary layer).
+
+python l3diag.py -s 2023-01-01 -e 2023-01-31
+python l3diag.py -s 2022-12-01 -e 2024-01-01 --workers 8 --rebuild
+"""
+
+import os
+import sys
+import json
+import logging
+import argparse
+import datetime as dt
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import xarray as xr
+import harmonise
+import memtrack
+import L2_to_L3
+
+__version__ = 1.0
+product_name = "paris_dwl_L3diag"
+DIAG_VARS = ["shear", "speed_shear", "veer", "llj", "llj_altitude",
+             "llj_speed", "llj_falloff"]
+STATION_VARS = ["station_lat", "station_lon", "station_altitude",
+                "station_height"]
+# L3 values with more flagged samples (%) are not used
+MAX_FLAG_PC = 50
+# jet nose and falloff searched up to this height (m) above the station
+LLJ_MAX_HEIGHT = 1500
+# least decrease of the wind speed above the nose (m s-1 and % of the nose)
+LLJ_MIN_FALLOFF = 2
+LLJ_MIN_FALLOFF_PC = 25
+# bytes of L3 read per block of time steps
+BLOCK_SIZE = memtrack.parse_size("256M")
+# working set of a block in multiples of its input (masked inputs, three
+# gradients and the LLJ search layers)
+WORKING_SET_FACTOR = 8
+
+
+def diag_filename(l3_file):
+    """The diagnostics file of an L3 file."""
+    return os.path.join(harmonise.DIAG_BASEDIR, os.path.basename(
+        l3_file).replace(L2_to_L3.product_name, product_name, 1))
+
+
+def usable(dat, max_flag_pc=MAX_FLAG_PC):
+    """
+    (station, time, altitude) mask of the L3 values with at most max_flag_pc
+    % of their samples flagged. Flags without a QC test (missing) count as 0.
+    """
+    flagged = np.zeros(dat.u.shape, dtype=bool)
+    for var in dat.data_vars:
+        if var.startswith("flag"):
+            flagged |= dat[var].transpose(*dat.u.dims).values > max_flag_pc
+
+    return ~flagged
+
+
+def centred_difference(x, z, period=None):
+    """
+    dx/dz along the last axis: centred differences inside, one-sided at the
+    ends, missing next to missing values. With period (e.g. 360 for
+    directions) the differences are wrapped to [-period / 2, period / 2).
+    """
+    z = np.asarray(z, dtype=np.float64)
+    dx = np.empty_like(x)
+    dz = np.empty_like(z)
+    dx[..., 1:-1] = x[..., 2:] - x[..., :-2]
+    dz[1:-1] = z[2:] - z[:-2]
+    dx[..., 0] = x[..., 1] - x[..., 0]
+    dz[0] = z[1] - z[0]
+    dx[..., -1] = x[..., -1] - x[..., -2]
+    dz[-1] = z[-1] - z[-2]
+    if period is not None:
+        dx = (dx + period / 2) % period - period / 2
+
+    return dx / dz
+
+
+def low_level_jets(ws, height):
+    """
+    LLJ of every profile of ws (..., altitude) with height (..., altitude)
+    above the station.
+
+    Returns
+    -------
+    llj (1., 0. or NaN if undecided), nose index, nose speed and falloff
+    (NaN where there is no jet)
+    """
+    in_layer = (height >= 0) & (height <= LLJ_MAX_HEIGHT)
+    layer_ws = np.where(in_layer, ws, np.nan)
+    has_data = np.isfinite(layer_ws).any(axis=-1)
+    nose = np.argmax(np.where(np.isfinite(layer_ws), layer_ws, -np.inf),
+                     axis=-1)
+    nose_ws = np.take_along_axis(layer_ws, nose[..., None], axis=-1)[..., 0]
+    above = np.arange(ws.shape[-1]) > nose[..., None]
+    with np.errstate(invalid="ignore"):
+        min_above = np.fmin.reduce(
+            np.where(above, layer_ws, np.nan), axis=-1)
+    falloff = nose_ws - min_above
+    # a nose at the top of the layer is no jet, a nose below missing values
+    # could be one
+    layer_top = in_layer.shape[-1] - 1 - np.argmax(in_layer[..., ::-1],
+                                                   axis=-1)
+    decided = has_data & (np.isfinite(min_above) | (nose == layer_top))
+    with np.errstate(invalid="ignore"):
+        is_jet = decided & (falloff >= LLJ_MIN_FALLOFF) & (
+            falloff >= nose_ws * LLJ_MIN_FALLOFF_PC / 100)
+    llj = np.where(decided, is_jet.astype(np.float64), np.nan)
+
+    return (llj, nose, np.where(is_jet, nose_ws, np.nan),
+            np.where(is_jet, falloff, np.nan))
+
+
+def diagnostics(dat, max_flag_pc=MAX_FLAG_PC):
+    """
+    The diagnostics of an L3 dataset (or a block of its time steps), loaded.
+
+    Returns
+    -------
+    xr.Dataset of DIAG_VARS on the station, time (and altitude) of dat
+    """
+    dims = ("station", "time", "altitude")
+    ok = usable(dat, max_flag_pc)
+    u = np.where(ok, dat.u.transpose(*dims).values, np.nan)
+    v = np.where(ok, dat.v.transpose(*dims).values, np.nan)
+    ws, wd = harmonise.vector_to_ws_wd(u, v)
+    altitude = dat.altitude.values
+
+    du = centred_difference(u, altitude)
+    dv = centred_difference(v, altitude)
+    shear = np.hypot(du, dv)
+    del du, dv
+    speed_shear = centred_difference(ws, altitude)
+    veer = centred_difference(wd, altitude, period=360)
+
+    height = altitude[None, None, :] - dat.station_altitude.values[
+        :, None, None]
+    llj, nose, llj_speed, llj_falloff = low_level_jets(ws, height)
+    llj_altitude = np.where(np.isfinite(llj_speed), altitude[nose], np.nan)
+
+    return xr.Dataset(
+        data_vars={
+            "shear": (dims, shear),
+            "speed_shear": (dims, speed_shear),
+            "veer": (dims, veer),
+            "llj": (dims[:2], llj),
+            "llj_altitude": (dims[:2], llj_altitude),
+            "llj_speed": (dims[:2], llj_speed),
+            "llj_falloff": (dims[:2], llj_falloff),
+        },
+        coords={dim: dat[dim] for dim in dims})
+
+
+def diag_attrs(l3_attrs, l3_file, max_flag_pc):
+    attrs = {key: value for key, value in l3_attrs.items()
+             if key != "processing_dependencies"}
+    attrs.update({
+        "processing_level": "L3 derived",
+        "processing_level_description": "Diagnostics derived from the L3 "
+        "wind profiles: vertical wind shear, speed shear, veer and "
+        "low-level jets.",
+        "processing_name": "l3diag.py",
+        "processing_version_diag": str(__version__),
+        "processing_time_utc": dt.datetime.now(
+            tz=dt.timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+        "source_file": os.path.basename(l3_file),
+        "diagnostic_parameters": json.dumps({
+            "max_flag_pc": max_flag_pc,
+            "llj_max_height": LLJ_MAX_HEIGHT,
+            "llj_min_falloff": LLJ_MIN_FALLOFF,
+            "llj_min_falloff_pc": LLJ_MIN_FALLOFF_PC}, sort_keys=True),
+    })
+
+    return attrs
+
+
+def diagnose_file(l3_file, max_flag_pc=MAX_FLAG_PC, block_size=BLOCK_SIZE):
+    """
+    Write the diagnostics file of one L3 file, computed in blocks of time
+    steps of about block_size bytes of L3.
+
+    Returns
+    -------
+    the diagnostics filename
+    """
+    with xr.open_dataset(l3_file) as src:
+        inputs = ["u", "v"] + [var for var in src.data_vars
+                               if var.startswith("flag")]
+        bytes_per_step = sum(
+            src[var].dtype.itemsize * src[var].size / src.sizes["time"]
+            for var in inputs)
+        block_steps = memtrack.block_length(
+            block_size, bytes_per_step, src.sizes["time"],
+            working_set_factor=WORKING_SET_FACTOR)
+        blocks = [
+            diagnostics(src[inputs + ["station_altitude"]].isel(
+                time=slice(i, i + block_steps)).load(), max_flag_pc)
+            for i in range(0, src.sizes["time"], block_steps)]
+        dat_out = xr.concat(blocks, dim="time") if len(blocks) > 1 \
+            else blocks[0]
+        dat_out = dat_out.merge(src[STATION_VARS].load())
+        l3_attrs = dict(src.attrs)
+        time_agg = int(src.attrs["aggregation_time_s"])
+
+    dat_out = harmonise.apply_attrs(dat_out, level=3)
+    dat_out.time.attrs["comment"] = dat_out.time.attrs["comment"].format(
+        time_window_s=time_agg)
+    dat_out.attrs = diag_attrs(l3_attrs, l3_file, max_flag_pc)
+    nc_file = diag_filename(l3_file)
+    os.makedirs(os.path.dirname(nc_file), exist_ok=True)
+    harmonise.to_netcdf_trimmed(
+        dat_out, nc_file,
+        encoding=harmonise.encode_nc_compression(dat_out, level=3))
+    logging.info(nc_file)
+
+    return nc_file
+
+
+def _diagnose_file(args):
+    l3_file, max_flag_pc, block_size = args
+    try:
+        return diagnose_file(l3_file, max_flag_pc, block_size)
+    except Exception as e:
+        logging.error(f"{e} error for {l3_file}")
+        return None
+
+
+def l3_files(start_datetime, end_datetime, time_aggs, rebuild=False):
+    """
+    The L3 files of every day and aggregation in [start, end], without those
+    whose diagnostics are newer than the L3 unless rebuilding.
+    """
+    days = pd.date_range(start_datetime, end_datetime, freq="D")
+    filenames = []
+    for day in days:
+        for time_agg in time_aggs:
+            l3_file = L2_to_L3.l3_filename(
+                str(day), str(day + pd.Timedelta(days=1)), time_agg)
+            if not os.path.exists(l3_file):
+                continue
+            nc_file = diag_filename(l3_file)
+            if not rebuild and os.path.exists(nc_file) and \
+                    os.path.getmtime(nc_file) >= os.path.getmtime(l3_file):
+                continue
+            filenames.append(l3_file)
+
+    return filenames
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compute wind shear, veer and low-level jets from L3.")
+    parser.add_argument("-s", "--startdate", required=True,
+                        help="Start date in ISO format")
+    parser.add_argument("-e", "--enddate", required=True,
+                        help="End date (inclusive) in ISO format")
+    parser.add_argument("--time-aggs", type=int, nargs="+",
+                        default=L2_to_L3.time_aggs,
+                        help="L3 aggregations (s)")
+    parser.add_argument("--max-flag-pc", type=float, default=MAX_FLAG_PC,
+                        help="Do not use L3 values with more of their "
+                        "samples flagged (%%)")
+    parser.add_argument("--block-size", type=memtrack.parse_size,
+                        default=BLOCK_SIZE,
+                        help="Bytes of L3 processed at once per worker, "
+                        "e.g. 256M")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="L3 files processed in parallel")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="Process all L3 files, also those older than "
+                        "their diagnostics")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    tasks = [(l3_file, args.max_flag_pc, args.block_size)
+             for l3_file in l3_files(args.startdate, args.enddate,
+                                     args.time_aggs, rebuild=args.rebuild)]
+    logging.info(f"{len(tasks)} L3 files")
+    if args.workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            written = list(pool.map(_diagnose_file, tasks))
+    else:
+        written = list(map(_diagnose_file, tasks))
+    logging.info(f"{sum(nc_file is not None for nc_file in written)} "
+                 "diagnostics files written")
+    failed = sum(nc_file is None for nc_file in written)
+    if failed:
+        logging.error(f"{failed} of {len(tasks)} L3 files failed")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
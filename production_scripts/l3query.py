@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+"""
+Subset queries over the L3 output, e.g. one station, 100 - 1500 m, three
+weeks of 10 min data, returned as one xarray Dataset.
+
+An index of the L3 files (their time range, aggregation, stations,
+altitudes and the chunk layout of every variable) is kept next to the files
+and refreshed from the file headers when files change, so a query opens
+only the files it overlaps. Within a file only the chunks intersecting the
+subset are read, and decompressed chunks are kept in a size bounded
+in-process cache for the next queries.
+"""
+
+import os
+import glob
+import json
+import logging
+import argparse
+import itertools
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import xarray as xr
+import harmonise
+import memtrack
+
+INDEX_FILENAME = "l3-index.json"
+DEFAULT_CACHE_SIZE = memtrack.parse_size("512M")
+
+
+def scan_file(filename):
+    """Index entry of one L3 file, from its header and coordinates."""
+    with xr.open_dataset(filename, cache=False) as dat:
+        times = dat.time.values
+        entry = {
+            "fingerprint": harmonise.file_fingerprint(filename),
+            "start_time_utc": dat.attrs["start_time_utc"],
+            "end_time_utc": dat.attrs["end_time_utc"],
+            "aggregation_time_s": int(dat.attrs["aggregation_time_s"]),
+            "version": str(dat.attrs["processing_version_L3"]),
+            "time_first": str(pd.Timestamp(times[0])),
+            "n_time": len(times),
+            "stations": [str(s) for s in dat.station.values],
+            "altitude": [int(a) for a in dat.altitude.values],
+            "variables": {},
+        }
+        # regular time steps are stored as first and step only
+        steps = np.unique(np.diff(times))
+        if len(steps) > 1:
+            entry["times"] = [str(pd.Timestamp(t)) for t in times]
+        entry["time_step_s"] = int(steps[0] / np.timedelta64(1, "s")) \
+            if len(steps) else entry["aggregation_time_s"]
+        for var in dat.data_vars:
+            chunks = dat[var].encoding.get("chunksizes")
+            if chunks is None or len(chunks) != dat[var].ndim:
+                chunks = dat[var].shape
+            entry["variables"][var] = {
+                "dims": list(dat[var].dims),
+                "shape": list(dat[var].shape),
+                "chunks": [int(c) for c in chunks],
+            }
+
+    return entry
+
+
+def entry_times(entry):
+    if "times" in entry:
+        return pd.DatetimeIndex(entry["times"])
+    return pd.date_range(entry["time_first"], periods=entry["n_time"],
+                         freq=pd.Timedelta(seconds=entry["time_step_s"]))
+
+
+class L3Index:
+    """
+    Index of the L3 files in l3_dir, saved as INDEX_FILENAME in l3_dir.
+    """
+
+    def __init__(self, l3_dir=None):
+        self.l3_dir = l3_dir or harmonise.L3_BASEDIR
+        self.index_file = os.path.join(self.l3_dir, INDEX_FILENAME)
+        try:
+            with open(self.index_file) as f:
+                self.files = json.load(f)
+        except (OSError, ValueError):
+            self.files = {}
+
+    def refresh(self):
+        """Scan new and changed files, forget removed ones."""
+        filenames = sorted(glob.glob(os.path.join(self.l3_dir, "*.nc")))
+        changed = False
+        for filename in filenames:
+            key = os.path.basename(filename)
+            entry = self.files.get(key)
+            if entry is not None and \
+                    harmonise.file_fingerprint(filename) == \
+                    entry["fingerprint"]:
+                continue
+            try:
+                self.files[key] = scan_file(filename)
+            except (OSError, KeyError, ValueError) as e:
+                logging.warning(f"Could not index {filename}: {e}")
+                continue
+            changed = True
+        keys = {os.path.basename(filename) for filename in filenames}
+        for key in set(self.files) - keys:
+            del self.files[key]
+            changed = True
+        if changed:
+            self.save()
+
+        return self
+
+    def save(self):
+        tmp_file = self.index_file + ".tmp"
+        try:
+            with open(tmp_file, "w") as f:
+                json.dump(self.files, f)
+            os.replace(tmp_file, self.index_file)
+        except OSError as e:
+            logging.warning(f"Could not save {self.index_file}: {e}")
+
+    def select(self, start_datetime, end_datetime, time_agg, version=None):
+        """
+        Files of the time_agg aggregation overlapping [start, end), of
+        version (default the latest indexed), sorted by time.
+        """
+        start, end = pd.Timestamp(start_datetime), pd.Timestamp(end_datetime)
+        entries = {key: entry for key, entry in self.files.items()
+                   if entry["aggregation_time_s"] == time_agg}
+        if version is None and entries:
+            version = max((entry["version"] for entry in entries.values()),
+                          key=float)
+        return sorted(
+            ((key, entry) for key, entry in entries.items()
+             if entry["version"] == str(version) and
+             pd.Timestamp(entry["start_time_utc"]) < end and
+             pd.Timestamp(entry["end_time_utc"]) > start),
+            key=lambda item: item[1]["start_time_utc"])
+
+
+class ChunkCache:
+    """LRU cache of decompressed chunks, bounded by max_bytes."""
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._chunks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, load):
+        with self._lock:
+            if key in self._chunks:
+                self._chunks.move_to_end(key)
+                self.hits += 1
+                return self._chunks[key]
+        chunk = load()
+        with self._lock:
+            self.misses += 1
+            if chunk.nbytes > self.max_bytes:
+                return chunk
+            if key not in self._chunks:
+                self._chunks[key] = chunk
+                self.n_bytes += chunk.nbytes
+            while self.n_bytes > self.max_bytes:
+                _, evicted = self._chunks.popitem(last=False)
+                self.n_bytes -= evicted.nbytes
+        return chunk
+
+    def clear(self):
+        with self._lock:
+            self._chunks.clear()
+            self.n_bytes = 0
+
+
+_cache = ChunkCache()
+
+
+def read_subset(dat, var, var_entry, region, cache, file_key):
+    """
+    dat[var][region] assembled from whole chunks (region is a slice per
+    dimension), each read once and then served from cache.
+    """
+    shape = var_entry["shape"]
+    chunks = var_entry["chunks"]
+    out = None
+    chunk_ranges = [
+        range(r.start // c, (r.stop - 1) // c + 1) if r.stop > r.start
+        else range(0)
+        for r, c in zip(region, chunks)]
+    for chunk_index in itertools.product(*chunk_ranges):
+        chunk_region = tuple(
+            slice(i * c, min((i + 1) * c, n))
+            for i, c, n in zip(chunk_index, chunks, shape))
+        chunk = cache.get(
+            (file_key, var, chunk_index),
+            lambda: dat[var][chunk_region].values)
+        if out is None:
+            out = np.empty([r.stop - r.start for r in region],
+                           dtype=chunk.dtype)
+        # overlap of the chunk and the region, in both their coordinates
+        overlap = [(max(r.start, c.start), min(r.stop, c.stop))
+                   for r, c in zip(region, chunk_region)]
+        out[tuple(slice(a - r.start, b - r.start)
+                  for (a, b), r in zip(overlap, region))] = \
+            chunk[tuple(slice(a - c.start, b - c.start)
+                        for (a, b), c in zip(overlap, chunk_region))]
+    if out is None:
+        out = np.empty([r.stop - r.start for r in region],
+                       dtype=dat[var].dtype)
+
+    return out
+
+
+def query_file(filename, entry, stations, start, end, alt_min, alt_max,
+               variables, cache):
+    """The subset of one L3 file, None if it has none of it."""
+    times = entry_times(entry)
+    time_region = slice(*times.slice_indexer(
+        start, end - pd.Timedelta(1)).indices(len(times))[:2])
+    altitude = np.array(entry["altitude"])
+    alt_region = slice(
+        int(np.searchsorted(altitude, alt_min, side="left")),
+        int(np.searchsorted(altitude, alt_max, side="right")))
+    station_index = [entry["stations"].index(s) for s in stations
+                     if s in entry["stations"]]
+    if time_region.stop <= time_region.start or not station_index:
+        return None
+    station_region = slice(min(station_index), max(station_index) + 1)
+    regions = {"time": time_region, "altitude": alt_region,
+               "station": station_region}
+    file_key = (filename, entry["fingerprint"]["mtime"])
+
+    out = xr.Dataset(coords={
+        "time": times[time_region],
+        "altitude": altitude[alt_region],
+        "station": entry["stations"][station_region]})
+    with xr.open_dataset(filename, cache=False) as dat:
+        for var in variables or entry["variables"]:
+            var_entry = entry["variables"][var]
+            region = [regions.get(dim, slice(0, n)) for dim, n in zip(
+                var_entry["dims"], var_entry["shape"])]
+            out[var] = xr.Variable(
+                var_entry["dims"],
+                read_subset(dat, var, var_entry, region, cache, file_key),
+                attrs=dat[var].attrs)
+        for coord in ["time", "altitude", "station"]:
+            out[coord].attrs = dat[coord].attrs
+        attrs = dat.attrs
+
+    out = out.sel(station=[s for s in stations if s in out.station.values])
+    out.attrs = attrs
+
+    return out
+
+
+def query(stations=None, start_datetime=None, end_datetime=None,
+          alt_min=None, alt_max=None, time_agg=600, variables=None,
+          version=None, index=None, cache=None):
+    """
+    Subset of the L3 data as one dataset.
+
+    Parameters
+    ----------
+    stations : list of str
+        station codes, default all
+    start_datetime, end_datetime : str | datetime
+        [start, end) of the time labels
+    alt_min, alt_max : float
+        inclusive altitude range (m), default all
+    time_agg : int
+        L3 aggregation in seconds
+    variables : list of str
+        default all variables of the files
+    version : str
+        L3 version, default the latest in the index
+    index : L3Index
+        default the (refreshed) index of harmonise.L3_BASEDIR
+    cache : ChunkCache
+        default a module level cache shared by all queries
+
+    Returns
+    -------
+    xr.Dataset, None if no file overlaps the query
+    """
+    if index is None:
+        index = L3Index().refresh()
+    cache = cache or _cache
+    start = pd.Timestamp(start_datetime or pd.Timestamp.min)
+    end = pd.Timestamp(end_datetime or pd.Timestamp.max)
+    alt_min = -np.inf if alt_min is None else alt_min
+    alt_max = np.inf if alt_max is None else alt_max
+
+    dat_list = []
+    for key, entry in index.select(start, end, time_agg, version=version):
+        file_stations = stations or entry["stations"]
+        dat = query_file(
+            os.path.join(index.l3_dir, key), entry, file_stations, start,
+            end, alt_min, alt_max, variables, cache)
+        if dat is not None:
+            dat_list.append(dat)
+    if not dat_list:
+        return None
+
+    attrs = dict(dat_list[0].attrs)
+    attrs.pop("processing_dependencies", None)
+    dat = xr.concat(dat_list, dim="time", data_vars="minimal",
+                    coords="minimal", compat="override", join="outer",
+                    combine_attrs="drop")
+    attrs["start_time_utc"] = str(pd.Timestamp(dat.time.values[0]))
+    attrs["end_time_utc"] = str(pd.Timestamp(dat.time.values[-1]))
+    dat.attrs = attrs
+    logging.debug(f"L3 chunk cache {cache.hits} hits, {cache.misses} "
+                  f"misses, {memtrack.format_size(cache.n_bytes)}")
+
+    return dat
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Write a subset of the L3 data to one NetCDF file.")
+    parser.add_argument("-s", "--startdate", required=True,
+                        help="Start datetime in ISO format")
+    parser.add_argument("-e", "--enddate", required=True,
+                        help="End datetime (exclusive) in ISO format")
+    parser.add_argument("--stations", nargs="+",
+                        help="Station codes, default all")
+    parser.add_argument("--alt-min", type=float, help="Lowest altitude (m)")
+    parser.add_argument("--alt-max", type=float, help="Highest altitude (m)")
+    parser.add_argument("--agg", type=int, default=600,
+                        help="L3 aggregation time in seconds")
+    parser.add_argument("--vars", nargs="+", help="Variables, default all")
+    parser.add_argument("--version", help="L3 version, default the latest")
+    parser.add_argument("-o", "--output", required=True,
+                        help="Output NetCDF file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    dat = query(args.stations, args.startdate, args.enddate,
+                alt_min=args.alt_min, alt_max=args.alt_max,
+                time_agg=args.agg, variables=args.vars, version=args.version)
+    if dat is None:
+        raise SystemExit("No L3 data for this query")
+    dat.to_netcdf(args.output, encoding={
+        var: harmonise.DEFAULT_COMPRESSION for var in dat.data_vars
+        if dat[var].dtype.kind == "f"})
+    logging.info(f"Wrote {args.output} {dict(dat.sizes)}")
+
+
+if __name__ == "__main__":
+    main()
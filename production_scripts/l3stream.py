@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+Online (streaming) L3 aggregation for near-real-time products. Instead of
+resampling whole days of L2 (harmonise.time_resample), each L2 profile is put
+on the L3 altitude grid as it arrives and added to running sums and counts of
+its station's time bin, for every variable aggregated at L3 (u, v, flags and
+metadata). A bin is closed once a later profile of the station has arrived
+(or when flushed) and emitted as L3 rows, equal to the rows L2_to_L3.py
+computes from the same profiles within float32 rounding: the running sums
+are float64, the batch resample sums the float32 L2 (e.g. u, v and ws differ
+by up to about 5e-6 m s-1).
+
+The open bins and the last profile time of each station are kept in a state
+file between runs, so each run only reads the profiles added to the L2 files
+since the last run and the cost per new scan is constant.
+
+python l3stream.py -s 2023-01-01 -e 2023-01-02
+python l3stream.py -s 2023-01-01 -e 2023-01-02 --flush
+"""
+
+import os
+import pickle
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+import xarray as xr
+import harmonise
+import L2_to_L3
+
+STATE_FILENAME = "l3stream-{time_agg}s.pkl"
+
+
+class OnlineL3:
+    """
+    Running per (station, altitude, time bin) sums and counts of one L3
+    aggregation.
+
+    Parameters
+    ----------
+    time_agg : int
+        seconds, dividing a day
+    state_file : str, optional
+        the open bins are loaded from and saved to this file
+    """
+
+    def __init__(self, time_agg, state_file=None, registry=None):
+        self.time_agg = int(time_agg)
+        self.res = pd.Timedelta(seconds=self.time_agg)
+        self.state_file = state_file
+        self.registry = registry or harmonise.vardim_registry
+        self.stations = {}
+        if state_file is not None and os.path.exists(state_file):
+            with open(state_file, "rb") as f:
+                state = pickle.load(f)
+            if state["time_agg"] != self.time_agg:
+                raise ValueError(f"{state_file} is for {state['time_agg']}s")
+            self.stations = state["stations"]
+
+    def save(self):
+        if self.state_file is None:
+            return
+        tmp_file = f"{self.state_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "wb") as f:
+            pickle.dump({"time_agg": self.time_agg, "stations": self.stations},
+                        f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, self.state_file)
+
+    def add(self, d, dat):
+        """
+        Add the L2 profiles of deployment d (L2 dataset, e.g. a whole L2 file
+        or the scans of the last minutes) that are newer than the ones added
+        before. Profiles of bins that were already closed are dropped.
+
+        Returns
+        -------
+        the number of profiles added
+        """
+        station = self.stations.setdefault(
+            d.station_code, {"last_time": None, "closed_until": None,
+                             "altitude": None, "bins": {}})
+        times = pd.DatetimeIndex(dat.time.values)
+        new = np.ones(len(times), dtype=bool)
+        if station["last_time"] is not None:
+            new &= times > station["last_time"]
+        if station["closed_until"] is not None:
+            late = new & (times < station["closed_until"])
+            if late.any():
+                logging.warning(
+                    f"{d.station_code} {late.sum()} profiles before "
+                    f"{station['closed_until']} arrived after their bins "
+                    "were closed, dropped")
+            new &= ~late
+        if not new.any():
+            return 0
+        # the sums are kept on the full altitude grid
+        dat = L2_to_L3.harmonise_station_altitude(
+            dat.isel(time=np.flatnonzero(new)).load(), d, trim=False)
+        if station["altitude"] is None:
+            station["altitude"] = dat.altitude.values
+        bins = pd.DatetimeIndex(dat.time.values).floor(self.res)
+
+        variables = {
+            vardef.L2_name: dat[vardef.L2_name].transpose(
+                "time", ...).values.astype(np.float64)
+            for vardef in self.registry.aggregated(level=3)
+            if vardef.L2_name in dat.data_vars}
+        for bin_start in bins.unique():
+            index = np.flatnonzero(bins == bin_start)
+            acc = station["bins"].setdefault(bin_start, {
+                "n": 0, "system_id": d.instrument_serial, "sum": {},
+                "count": {}})
+            acc["n"] += len(index)
+            for name, values in variables.items():
+                values = values[index]
+                acc["sum"][name] = acc["sum"].get(name, 0) + np.nansum(
+                    values, axis=0)
+                acc["count"][name] = acc["count"].get(name, 0) + np.sum(
+                    ~np.isnan(values), axis=0)
+        station["last_time"] = times[new].max()
+
+        return int(new.sum())
+
+    def _station_rows(self, station_code, station, bin_starts):
+        """L3 rows of the bins of one station (as L2_to_L3.harmonise_station)."""
+        altitude = station["altitude"]
+        dat = xr.Dataset(coords={"time": pd.DatetimeIndex(bin_starts),
+                                 "altitude": altitude})
+        accs = [station["bins"][bin_start] for bin_start in bin_starts]
+        n = np.array([acc["n"] for acc in accs], dtype=np.float64)
+        for vardef in self.registry.aggregated(level=3):
+            if vardef.L2_name not in accs[0]["sum"]:
+                continue
+            sums = np.array([acc["sum"][vardef.L2_name] for acc in accs])
+            if vardef.L3_fun == "pc":
+                values = (sums / n.reshape(-1, *[1] * (sums.ndim - 1))) * 100
+            else:
+                counts = np.array(
+                    [acc["count"][vardef.L2_name] for acc in accs])
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    values = np.where(counts > 0, sums / counts, np.nan)
+            dims = ["time", "altitude"][:values.ndim]
+            dat[vardef.name] = (dims, values)
+        dat = L2_to_L3.valid_levels(dat)
+        ws, wd = harmonise.vector_to_ws_wd_xr(dat.u, dat.v)
+        dat = L2_to_L3.full_levels(dat.assign(ws=ws, wd=wd), altitude)
+        system_ids = [acc["system_id"] for acc in accs]
+        dat["system_id"] = ("time", np.array(system_ids).astype(
+            "S" + str(max(len(s) for s in system_ids))))
+        dat = dat.expand_dims(dim="station").assign_coords(
+            station=("station", [station_code]))
+
+        return dat
+
+    def close(self, until=None):
+        """
+        Remove the closed bins from the state and return them as L3 rows.
+        A bin is closed once a later profile of the station was added, or
+        with until (e.g. now minus the latency allowed) once it ended before
+        until.
+
+        Returns
+        -------
+        xr.Dataset in the L3 layout (without global attrs), None if no bin
+        closed
+        """
+        dat_list = []
+        for station_code, station in self.stations.items():
+            if until is not None:
+                closed_until = pd.Timestamp(until).floor(self.res)
+            elif station["last_time"] is not None:
+                closed_until = station["last_time"].floor(self.res)
+            else:
+                continue
+            bin_starts = sorted(
+                bin_start for bin_start in station["bins"]
+                if bin_start < closed_until)
+            if station["closed_until"] is None or \
+                    closed_until > station["closed_until"]:
+                station["closed_until"] = closed_until
+            if not bin_starts:
+                continue
+            dat_list.append(
+                self._station_rows(station_code, station, bin_starts))
+            for bin_start in bin_starts:
+                del station["bins"][bin_start]
+        if not dat_list:
+            return None
+
+        return L2_to_L3.assemble_l3(dat_list, self.time_agg)
+
+
+def write_rows(dat, time_agg, checksum=False):
+    """
+    Merge L3 rows into the L3 file of each day they fall on.
+
+    Returns
+    -------
+    list of the L3 filenames written
+    """
+    written = []
+    days = pd.DatetimeIndex(dat.time.values).floor("D")
+    for day in days.unique():
+        start_datetime = str(day)
+        end_datetime = str(day + pd.Timedelta(days=1))
+        dat_day = dat.isel(time=np.flatnonzero(days == day))
+        nc_file = L2_to_L3.l3_filename(start_datetime, end_datetime, time_agg)
+        if os.path.exists(nc_file):
+            with xr.open_dataset(nc_file) as previous:
+                dat_day = dat_day.combine_first(previous.load())
+            dat_day = L2_to_L3.add_valid_top(dat_day)
+        dat_day.attrs = L2_to_L3.l3_attrs(
+            start_datetime, end_datetime, time_agg,
+            L2_to_L3.l3_dependencies(
+                start_datetime, end_datetime, time_agg, checksum=checksum))
+        # readers of the near-real-time files never see a partial file
+        tmp_file = f"{nc_file}.{os.getpid()}.tmp"
+        harmonise.to_netcdf_trimmed(
+            dat_day, tmp_file,
+            encoding=harmonise.encode_nc_compression(dat_day, level=3))
+        os.replace(tmp_file, nc_file)
+        logging.info(f"{nc_file} {dat_day.sizes['time']} time steps")
+        written.append(nc_file)
+
+    return written
+
+
+def feed_day(engines, start_datetime, end_datetime):
+    """Add the L2 files of every station for one day to the engines."""
+    for station_code in L2_to_L3.deployment_calendar().station_codes:
+        d = L2_to_L3.get_station_deployment(
+            station_code, start_datetime, end_datetime)
+        if d is None:
+            continue
+        # only the day's own files, the open bins carry over from the
+        # previous day in the state
+        for filename in L2_to_L3.find_l2_files(
+                d, start_datetime, start_datetime, 0):
+            with xr.open_dataset(filename) as dat:
+                dat = dat.sel(time=slice(
+                    pd.Timestamp(start_datetime),
+                    pd.Timestamp(end_datetime) - pd.Timedelta(1)))
+                for engine in engines:
+                    n = engine.add(d, dat)
+                    logging.debug(f"{station_code} {n} profiles added "
+                                  f"({engine.time_agg}s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Aggregate new L2 profiles into L3 incrementally.")
+    parser.add_argument("-s", "--startdate", required=True,
+                        help="Start date in ISO format")
+    parser.add_argument("-e", "--enddate", required=True,
+                        help="End date (inclusive) in ISO format")
+    parser.add_argument("--time-aggs", type=int, nargs="+",
+                        default=L2_to_L3.time_aggs,
+                        help="L3 aggregations (s)")
+    parser.add_argument("--state-dir", default=harmonise.L3_BASEDIR,
+                        help="Directory of the state files of the open bins")
+    parser.add_argument("--flush", action="store_true",
+                        help="Also close the bins still open at the end, "
+                        "e.g. at the end of a campaign")
+    parser.add_argument("--checksum", action="store_true",
+                        help="Track L2 inputs by sha256 instead of mtime")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    engines = [OnlineL3(time_agg, os.path.join(
+        args.state_dir, STATE_FILENAME.format(time_agg=time_agg)))
+        for time_agg in args.time_aggs]
+    for day in pd.date_range(args.startdate, args.enddate, freq="D"):
+        feed_day(engines, str(day), str(day + pd.Timedelta(days=1)))
+        for engine in engines:
+            rows = engine.close()
+            if rows is not None:
+                write_rows(rows, engine.time_agg, checksum=args.checksum)
+    for engine in engines:
+        if args.flush:
+            rows = engine.close(until=pd.Timestamp.max)
+            if rows is not None:
+                write_rows(rows, engine.time_agg, checksum=args.checksum)
+        engine.save()
+
+
+if __name__ == "__main__":
+    main()
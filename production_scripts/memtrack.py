@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in memory accounting for the processing stages, and the sizing of time
+blocks and worker counts from a memory budget.
+
+Peak resident memory is sampled from a background thread while a stage runs.
+With trace_allocations the largest Python/numpy allocations are also recorded
+through tracemalloc (HDF5/netCDF C allocations are only visible in the RSS).
+"""
+
+import os
+import json
+import math
+import time
+import logging
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+SIZE_UNITS = {"": 1, "b": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3,
+              "t": 1024 ** 4}
+# headroom on top of the estimated or measured working set of a unit
+SAFETY_FACTOR = 1.25
+
+
+def parse_size(size):
+    """
+    Bytes from a size like 4G, 512M, 1.5g, 2GB or a plain number of bytes.
+    """
+    if size is None:
+        return None
+    if isinstance(size, (int, float)):
+        return int(size)
+    size_str = str(size).strip().lower()
+    if size_str.endswith("ib"):
+        size_str = size_str[:-2]
+    elif size_str.endswith("b"):
+        size_str = size_str[:-1]
+    unit = size_str[-1:] if size_str[-1:].isalpha() else ""
+    if unit not in SIZE_UNITS:
+        raise ValueError(f"Unknown size unit in {size}")
+    number = size_str[:len(size_str) - len(unit)]
+
+    return int(float(number) * SIZE_UNITS[unit])
+
+
+def memory_budget(value):
+    """
+    argparse type for a memory budget: a size (see parse_size), or auto for
+    the memory currently available on the node.
+    """
+    if str(value).strip().lower() == "auto":
+        available = available_memory()
+        if available is None:
+            raise ValueError("Available memory unknown, give the budget size")
+        return available
+    return parse_size(value)
+
+
+def format_size(n_bytes):
+    if n_bytes is None:
+        return "n/a"
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if abs(n_bytes) < 1024:
+            return f"{n_bytes:.1f}{unit}"
+        n_bytes /= 1024
+    return f"{n_bytes:.1f}TiB"
+
+
+def current_rss():
+    """Resident set size of this process in bytes, None if unavailable."""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def available_memory():
+    """Memory available to new processes in bytes, None if unavailable."""
+    if psutil is not None:
+        return psutil.virtual_memory().available
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+class _RSSSampler(threading.Thread):
+
+    def __init__(self, interval):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = current_rss()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            rss = current_rss()
+            if rss is not None and (self.peak is None or rss > self.peak):
+                self.peak = rss
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        rss = current_rss()
+        if rss is not None and (self.peak is None or rss > self.peak):
+            self.peak = rss
+        return self.peak
+
+
+class MemoryTracker:
+    """
+    Records the peak memory of each (stage, unit) processed under track().
+
+    A disabled tracker (the default in the processing scripts) does nothing,
+    so track() can wrap the production code unconditionally.
+
+    Parameters
+    ----------
+    enabled : bool
+    trace_allocations : bool
+        also trace allocations with tracemalloc and keep the n_allocations
+        largest (by source line) of each unit. Slows processing noticeably.
+    n_allocations : int
+    interval : float
+        RSS sampling interval in seconds
+    log_file : str
+        append every record as a JSON line to this file
+    """
+
+    def __init__(self, enabled=True, trace_allocations=False, n_allocations=5,
+                 interval=0.05, log_file=None):
+        self.enabled = enabled
+        self.trace_allocations = trace_allocations
+        self.n_allocations = n_allocations
+        self.interval = interval
+        self.log_file = log_file
+        self.records = []
+
+    @contextmanager
+    def track(self, stage, unit=None):
+        if not self.enabled:
+            yield
+            return
+
+        record = {"stage": stage, "unit": None if unit is None else str(unit),
+                  "pid": os.getpid(), "rss_start": current_rss()}
+        tracing = self.trace_allocations
+        if tracing:
+            started_tracing = not tracemalloc.is_tracing()
+            if started_tracing:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            traced_start = tracemalloc.get_traced_memory()[0]
+        sampler = _RSSSampler(self.interval)
+        sampler.start()
+        t0 = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = round(time.perf_counter() - t0, 3)
+            record["peak_rss"] = sampler.stop()
+            record["rss_end"] = current_rss()
+            if tracing:
+                record["traced_peak"] = \
+                    tracemalloc.get_traced_memory()[1] - traced_start
+                record["top_allocations"] = [
+                    {"location": str(stat.traceback[0]),
+                     "size": stat.size, "count": stat.count}
+                    for stat in tracemalloc.take_snapshot().statistics(
+                        "lineno")[:self.n_allocations]]
+                if started_tracing:
+                    tracemalloc.stop()
+            self._add(record)
+
+    def _add(self, record, log=True):
+        self.records.append(record)
+        if self.log_file is not None:
+            with open(self.log_file, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        if not log:
+            return
+        logging.info(
+            f"memory {record['stage']} {record['unit']}: "
+            f"peak rss {format_size(record['peak_rss'])} "
+            f"(start {format_size(record['rss_start'])}) "
+            f"in {record['seconds']}s")
+        for allocation in record.get("top_allocations", []):
+            logging.info(f"    {format_size(allocation['size'])} "
+                         f"in {allocation['count']} blocks at "
+                         f"{allocation['location']}")
+
+    def extend(self, records):
+        """
+        Add records measured elsewhere, e.g. returned by a worker process that
+        has logged them already.
+        """
+        for record in records:
+            self._add(record, log=False)
+
+    def peak(self, stage=None):
+        """The largest peak RSS recorded (for stage), None if none recorded."""
+        peaks = [r["peak_rss"] for r in self.records
+                 if r["peak_rss"] is not None and
+                 (stage is None or r["stage"] == stage)]
+        return max(peaks) if peaks else None
+
+    def summary(self):
+        """{stage: {n_units, peak_rss, seconds}} over all records."""
+        stages = {}
+        for r in self.records:
+            s = stages.setdefault(
+                r["stage"], {"n_units": 0, "peak_rss": 0, "seconds": 0.})
+            s["n_units"] += 1
+            s["peak_rss"] = max(s["peak_rss"], r["peak_rss"] or 0)
+            s["seconds"] += r["seconds"]
+        return stages
+
+
+def worker_count(memory_budget, unit_bytes, max_workers=None,
+                 safety_factor=SAFETY_FACTOR):
+    """
+    Number of units of unit_bytes that can run at once in memory_budget.
+
+    unit_bytes should be the peak RSS of a whole process running one unit (not
+    just the increment), as every worker carries the interpreter and imports.
+    Always at least 1: a budget smaller than one unit is reported but not
+    enforced.
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if memory_budget is None or not unit_bytes:
+        return max_workers
+    n_workers = int(memory_budget // (unit_bytes * safety_factor))
+    if n_workers < 1:
+        logging.warning(
+            f"Memory budget {format_size(memory_budget)} is smaller than "
+            f"one unit ({format_size(unit_bytes)}), running one at a time")
+    return max(1, min(n_workers, max_workers))
+
+
+def block_length(memory_budget, bytes_per_step, n_steps, align=1,
+                 working_set_factor=1, safety_factor=SAFETY_FACTOR):
+    """
+    Steps per block so one block's working set fits in memory_budget.
+
+    Parameters
+    ----------
+    memory_budget : int
+        bytes, None for a single block of n_steps
+    bytes_per_step : float
+        input bytes of one step (e.g. one time stamp of all variables)
+    n_steps : int
+    align : int
+        blocks are a multiple of align steps (e.g. a whole statistics window)
+    working_set_factor : float
+        peak memory of processing relative to the input size
+
+    Returns
+    -------
+    int between align and n_steps (n_steps if that is smaller than align)
+    """
+    if memory_budget is None or bytes_per_step <= 0:
+        return n_steps
+    steps = memory_budget / (bytes_per_step * working_set_factor *
+                             safety_factor)
+    steps = max(align, int(math.floor(steps / align)) * align)
+    if steps < n_steps and steps == align and \
+            align * bytes_per_step * working_set_factor > memory_budget:
+        logging.warning(
+            f"Memory budget {format_size(memory_budget)} is smaller than one "
+            f"aligned block ({align} steps), using the smallest block")
+    return min(steps, n_steps)
@@ -5,10 +5,14 @@ Created on Mon Jul  1 11:25:37 2024
 @author: willm
 """
 
-reject_files_glob_L0 = [
-    # the pulses per ray change on this day. the code can't handle that
+# the pulses per ray change on this day. haloreader can't merge that, these
+# are only read where the npulses are kept per ray (--retrieval vad)
+npulses_change_files_glob_L0 = [
     "Wind_Profile_30_20220808_1*",
     "Wind_Profile_30_20220808_2*",
+]
+
+reject_files_glob_L0 = [
     # the new deployment with updated scan. these files are 120 point. after are 12 point
     "VAD_30_20221207_0*",
     "VAD_30_20221207_10*",
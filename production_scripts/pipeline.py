@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+RAW -> L1 -> L2 -> L3 for whole days in memory. The StreamLine stages of
+streamLine_RAW_to_L1.py and streamLine_L1_to_L2.py are chained for each
+deployment of the day and their L2 handed to L2_to_L3.l2_to_l3 directly, so
+the L1 and L2 NetCDF files are only written when asked for. The L2 of the
+other instruments (from their own L1a products) is read from file as usual.
+"""
+
+import os
+import argparse
+import logging
+import datetime as dt
+import pandas as pd
+import harmonise
+import memtrack
+import quicklook
+import staging
+import L2_to_L3
+import streamLine_L1_to_L2
+
+log_dir = "C:/Users/wmorris2/Desktop/pipeline_logs/"
+
+
+def streamline_deployments(start_datetime, end_datetime):
+    return [
+        deployment for deployment in L2_to_L3.deployment_calendar().resolve(
+            start_datetime.to_pydatetime(), end_datetime.to_pydatetime(),
+            key="instrument_serial")
+        if deployment.instrument_type == "StreamLine"]
+
+
+def day_raw_files(date):
+    """Archive RAW files read for all StreamLine deployments on date."""
+    import streamLine_RAW_to_L1
+
+    start_datetime = pd.Timestamp(date)
+    return [
+        path for deployment in streamline_deployments(
+            start_datetime, start_datetime + pd.Timedelta(days=1))
+        for path in streamLine_RAW_to_L1.raw_files(deployment, start_datetime)]
+
+
+def streamline_l2(deployment, date, write_l1=False, write_l2=False,
+                  staging_cache=None, parse_cache=None,
+                  retrieval="haloreader", parser="haloreader"):
+    """
+    L2 of one StreamLine deployment for the day starting at date, produced
+    from the RAW files in memory. None if there is nothing to process.
+    """
+    # haloreader is only needed (and installed) where the RAW data is
+    import streamLine_RAW_to_L1
+
+    dat = streamLine_RAW_to_L1.raw_to_l1(deployment, date,
+                                         staging=staging_cache,
+                                         parse_cache=parse_cache,
+                                         retrieval=retrieval, parser=parser)
+    if dat is None:
+        return None
+    if write_l1:
+        streamLine_RAW_to_L1.write_l1(dat, deployment.instrument_serial, date)
+    dat = streamLine_L1_to_L2.streamline_l1_to_l2(dat)
+    if write_l2:
+        out_file = streamLine_L1_to_L2.write_l2(
+            dat, deployment.instrument_serial, date)
+        logging.info(f"Wrote {out_file}")
+
+    return dat
+
+
+def streamline_l2_dependencies(deployment, date, checksum=False,
+                               retrieval="haloreader"):
+    """
+    What the L2 of streamline_l2 depends on, for L2_to_L3.l3_dependencies in
+    place of the L2 files: the RAW files it was made from and the versions
+    of the stages.
+    """
+    import streamLine_RAW_to_L1
+
+    return {
+        "raw_to_l1_version": streamLine_RAW_to_L1.__version__,
+        "l1_to_l2_version": streamLine_L1_to_L2.__version__,
+        "retrieval": retrieval,
+        "raw_files": [
+            harmonise.file_fingerprint(
+                path, basedir=streamLine_RAW_to_L1.ARCHIVE_DIR,
+                checksum=checksum)
+            for path in streamLine_RAW_to_L1.raw_files(
+                deployment, date, retrieval=retrieval)],
+    }
+
+
+def process_day(date, write_l1=False, write_l2=False, checksum=False,
+                tracker=None, lazy=False, staging_cache=None,
+                parse_cache=None, retrieval="haloreader",
+                parser="haloreader"):
+    """
+    All L3 files (one per aggregation) of the day starting at date. With lazy
+    they are computed as one dask graph (see L2_to_L3.l2_to_l3_lazy). RAW
+    files are read through staging_cache (a staging.StagingCache) and parsed
+    scans loaded from parse_cache (a hplcache.ParseCache) if given. retrieval
+    is the StreamLine wind retrieval (streamLine_RAW_to_L1.RETRIEVALS) and
+    parser the .hpl parser (streamLine_RAW_to_L1.PARSERS).
+
+    Returns
+    -------
+    list of the L3 filenames written
+    """
+    if tracker is None:
+        tracker = memtrack.MemoryTracker(enabled=False)
+    start_datetime = pd.Timestamp(date)
+    end_datetime = start_datetime + pd.Timedelta(days=1)
+
+    l2_data = {}
+    l2_data_dependencies = {}
+    for deployment in streamline_deployments(start_datetime, end_datetime):
+        unit = f"{deployment.instrument_serial} {start_datetime:%Y%m%d}"
+        try:
+            with tracker.track("raw_to_l2", unit):
+                dat = streamline_l2(deployment, start_datetime,
+                                    write_l1=write_l1, write_l2=write_l2,
+                                    staging_cache=staging_cache,
+                                    parse_cache=parse_cache,
+                                    retrieval=retrieval, parser=parser)
+            if dat is None:
+                continue
+            # the L2 files on disk are not what the L3 is made from
+            dependencies = streamline_l2_dependencies(
+                deployment, start_datetime, checksum=checksum,
+                retrieval=retrieval)
+        except Exception as e:
+            logging.error(f"{e} error for {unit}")
+            continue
+        l2_data[deployment.instrument_serial] = dat
+        l2_data_dependencies[deployment.instrument_serial] = dependencies
+
+    if lazy:
+        return L2_to_L3.process_interval_lazy(
+            str(start_datetime), str(end_datetime), checksum=checksum,
+            tracker=tracker, l2_data=l2_data,
+            l2_data_dependencies=l2_data_dependencies)
+
+    written = []
+    for time_agg in L2_to_L3.time_aggs:
+        nc_file = L2_to_L3.process_unit(
+            str(start_datetime), str(end_datetime), time_agg,
+            checksum=checksum, tracker=tracker, l2_data=l2_data,
+            l2_data_dependencies=l2_data_dependencies)
+        if nc_file is not None:
+            written.append(nc_file)
+
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Produce L3 from RAW StreamLine files in memory.")
+    parser.add_argument("-s", "--startdate",
+                        help="Start date in format YYYY-MM-DD",
+                        type=dt.date.fromisoformat,
+                        default=L2_to_L3.start_datetime_full[:10])
+    parser.add_argument("-e", "--enddate",
+                        help="End date (inclusive) in format YYYY-MM-DD",
+                        type=dt.date.fromisoformat,
+                        default=L2_to_L3.start_datetime_full[:10])
+    parser.add_argument("--write-l1", action="store_true",
+                        help="Also write the StreamLine L1 files")
+    parser.add_argument("--write-l2", action="store_true",
+                        help="Also write the StreamLine L2 files")
+    parser.add_argument("--checksum", action="store_true",
+                        help="Track L2 inputs by sha256 instead of mtime")
+    parser.add_argument("--track-memory", action="store_true",
+                        help="Log the peak memory of every stage")
+    parser.add_argument("--lazy", action="store_true",
+                        help="Compute the L3 of a day as one dask graph")
+    parser.add_argument("--scheduler", default="threads",
+                        choices=["threads", "processes", "synchronous",
+                                 "distributed"],
+                        help="dask scheduler for --lazy")
+    parser.add_argument("--staging-dir",
+                        help="Local directory to stage the RAW files in "
+                        "before reading them")
+    parser.add_argument("--staging-size", type=memtrack.parse_size,
+                        default="50G",
+                        help="Size limit of the staging directory, e.g. 50G")
+    parser.add_argument("--prefetch", type=int, default=1,
+                        help="Days to stage ahead of the day processed")
+    parser.add_argument("--parse-cache",
+                        help="Directory of the cache of parsed scan files, "
+                        "kept between runs")
+    parser.add_argument("--retrieval", choices=["haloreader", "vad"],
+                        default="haloreader",
+                        help="StreamLine wind retrieval, see "
+                        "streamLine_RAW_to_L1.py and vadwind.py")
+    parser.add_argument("--parser", choices=["haloreader", "hpl"],
+                        default="haloreader",
+                        help="StreamLine .hpl parser, see "
+                        "streamLine_RAW_to_L1.py")
+    parser.add_argument("--quicklook", action="store_true",
+                        help="Update the quicklook pyramid with every L3 "
+                        "file written")
+    args = parser.parse_args()
+
+    L2_to_L3.setup_logging(os.path.join(
+        log_dir, f"{dt.datetime.utcnow().strftime('%Y%m%d%H%M%S')}.log"))
+    logging.info(f"Command line arguments {args}")
+
+    tracker = memtrack.MemoryTracker(enabled=args.track_memory)
+    staging_cache = None
+    if args.staging_dir:
+        staging_cache = staging.StagingCache(args.staging_dir,
+                                             args.staging_size)
+    parse_cache = None
+    if args.parse_cache:
+        import streamLine_RAW_to_L1
+        parse_cache = streamLine_RAW_to_L1.open_parse_cache(
+            args.parse_cache, args.parser)
+    dates = pd.date_range(args.startdate, args.enddate, freq="D")
+    try:
+        with L2_to_L3.dask_scheduler(args.scheduler):
+            for date in staging.stage_ahead(staging_cache, dates,
+                                            day_raw_files,
+                                            depth=args.prefetch):
+                written = process_day(
+                    date, write_l1=args.write_l1, write_l2=args.write_l2,
+                    checksum=args.checksum, tracker=tracker, lazy=args.lazy,
+                    staging_cache=staging_cache, parse_cache=parse_cache,
+                    retrieval=args.retrieval, parser=args.parser)
+                if args.quicklook:
+                    quicklook.update(written)
+    finally:
+        if staging_cache is not None:
+            staging_cache.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+"""
+QC threshold sweep. Evaluates a grid of QC threshold sets without writing
+L2 or L3 files: the L1 of each swept instrument is loaded once per day and
+QCed with all sets at once by the production L1 -> L2 functions, the
+thresholds given as xr.DataArrays along a qc_set dimension. The L2 of each
+set is then put on the L3 grid (L2_to_L3.harmonise_station), still along
+qc_set. Stations of instruments without swept thresholds are read from
+their L2 files and are the same in every set.
+
+For each set it reports, per station, the percentage of the L2 values with
+L1 data that the QC retains and the percentage of those flagged warn, and
+per pair of stations the agreement of the L3 wind (number of common values,
+ws bias and RMSD, vector RMSD).
+
+python qcsweep.py -s 2023-01-01 -e 2023-01-08 \
+    --param wind_rmse_valid_err=2,3,4 --param nrays_pc_valid=50,75 \
+    --param ws_max_abs_diff=10,15,20 -o sweep
+"""
+
+import os
+import glob
+import logging
+import argparse
+import itertools
+import numpy as np
+import pandas as pd
+import xarray as xr
+import harmonise
+import memtrack
+import L2_to_L3
+import streamLine_L1_to_L2 as streamline
+import w400s_L1a_to_L2 as w400s
+
+# the thresholds of each instrument type that can be swept, keyword
+# arguments of its L1 -> L2 function
+SWEPT_PARAMS = {
+    "StreamLine": ["wind_rmse_valid_warn", "wind_rmse_valid_err",
+                   "nrays_pc_valid", "intensity_valid_warn",
+                   "intensity_valid_err"],
+    "w400s": ["fraction_above_ws_threshold", "ws_max_abs_diff"],
+}
+# L2 variables carried to the L3 grid
+SWEEP_VARS = ["u", "v", "flag_suspect_retrieval_warn"]
+# peak memory of harmonising one set relative to its altitude grid at 1 m
+# (see harmonise.z_resample)
+WORKING_SET_FACTOR = 3
+
+
+def threshold_sets(params):
+    """
+    The sweep grid: every combination of the values of params
+    ({name: [values]}), one row per set.
+    """
+    sets = pd.DataFrame(list(itertools.product(*params.values())),
+                        columns=list(params))
+    sets.index.name = "qc_set"
+
+    return sets
+
+
+def instrument_sets(sets, instrument_type):
+    """
+    The distinct threshold sets of one instrument type as {name: DataArray
+    along qc_set}, and the index of each set of the sweep in them. Sets that
+    only differ in the thresholds of other instruments are QCed once.
+    """
+    params = [p for p in sets.columns
+              if p in SWEPT_PARAMS.get(instrument_type, [])]
+    if not params:
+        return {}, np.zeros(len(sets), dtype=int)
+    combos = sets[params].drop_duplicates().reset_index(drop=True)
+    index = sets[params].merge(
+        combos.reset_index(), on=params, how="left")["index"].to_numpy()
+    thresholds = {p: xr.DataArray(combos[p].to_numpy(), dims="qc_set")
+                  for p in params}
+
+    return thresholds, index
+
+
+def streamline_l1(d, date):
+    filenames = glob.glob(os.path.join(
+        harmonise.L1_BASEDIR, d.instrument_serial,
+        f"halo-reader_WIND_{date:%Y%m%d}_{d.instrument_serial}_"
+        f"{streamline.L1_version}.nc"))
+    if not filenames:
+        return None
+    return xr.load_dataset(filenames[0])
+
+
+def w400s_l1(d, date):
+    filename = os.path.join(harmonise.L1_BASEDIR, d.instrument_serial,
+                            date.strftime(w400s.INPUT_FILE_DT))
+    if not os.path.exists(filename):
+        return None
+    return w400s.gate_index_to_range(xr.load_dataset(filename))
+
+
+def streamline_l2(l1, thresholds):
+    return streamline.streamline_l1_to_l2(l1.copy(), **thresholds)
+
+
+def w400s_l2(l1, thresholds):
+    return w400s.w400s_l1a_to_l2(l1.copy(), **thresholds)
+
+
+def streamline_l1_cells(l1):
+    return int(l1.zonal_wind.notnull().sum())
+
+
+def w400s_l1_cells(l1):
+    # L2 values are w400s.AGG_RES means
+    return int((l1.horizontal_wind_speed.resample(
+        time=w400s.AGG_RES).count() > 0).sum())
+
+
+# per swept instrument type: L1 of a deployment and day, L1 -> L2 with
+# thresholds, and the number of L2 values with L1 data
+INSTRUMENTS = {
+    "StreamLine": (streamline_l1, streamline_l2, streamline_l1_cells),
+    "w400s": (w400s_l1, w400s_l2, w400s_l1_cells),
+}
+
+
+def harmonised_sets(l2, d, start_datetime, end_datetime, time_agg):
+    """
+    The L2 of one deployment (along qc_set or not) on the L3 grid as a
+    dataset of SWEEP_VARS and ws with dims (qc_set, time, altitude).
+    """
+    dat = l2[[var for var in SWEEP_VARS if var in l2.data_vars]]
+    dat = dat.sel(time=slice(pd.Timestamp(start_datetime),
+                             pd.Timestamp(end_datetime)))
+    dat = L2_to_L3.harmonise_station(dat, d, time_agg).isel(station=0)
+    dat = dat[["u", "v", "ws"]]
+    if "qc_set" not in dat.dims:
+        dat = dat.expand_dims("qc_set")
+
+    return dat.transpose("qc_set", "time", "altitude")
+
+
+def sweep_station(l1, d, thresholds, index, start_datetime, end_datetime,
+                  time_agg, memory_budget=None):
+    """
+    QC the L1 of one deployment with every set of thresholds.
+
+    Returns
+    -------
+    L3 grid dataset along the qc_set of the sweep, and {count: array per set}
+    of the L2 values retained and warned of
+    """
+    l1_to_l2 = INSTRUMENTS[d.instrument_type][1]
+    n_combos = len(next(iter(thresholds.values()))) if thresholds else 1
+    n_altitude = harmonise.MAX_ALTITUDE - harmonise.MIN_ALTITUDE
+    bytes_per_set = l1.sizes["time"] * n_altitude * len(SWEEP_VARS) * 8
+    block_sets = memtrack.block_length(
+        memory_budget, bytes_per_set, n_combos,
+        working_set_factor=WORKING_SET_FACTOR)
+
+    l3_blocks = []
+    retained = []
+    warned = []
+    for i in range(0, n_combos, block_sets):
+        block = {name: values.isel(qc_set=slice(i, i + block_sets))
+                 for name, values in thresholds.items()}
+        l2 = l1_to_l2(l1, block)
+        valid = l2.u.notnull()
+        other_dims = [dim for dim in valid.dims if dim != "qc_set"]
+        retained.append(np.atleast_1d(valid.sum(other_dims).values))
+        warned.append(np.atleast_1d(
+            (valid & (l2.flag_suspect_retrieval_warn == 1)).sum(
+                other_dims).values))
+        l3_blocks.append(harmonised_sets(
+            l2, d, start_datetime, end_datetime, time_agg))
+    l3 = xr.concat(l3_blocks, dim="qc_set", join="outer")
+
+    counts = {"retained": np.concatenate(retained)[index],
+              "warned": np.concatenate(warned)[index]}
+
+    return l3.isel(qc_set=index), counts
+
+
+def pair_stats(a, b):
+    """
+    Agreement of the L3 wind of two stations, arrays along qc_set.
+    """
+    a, b = xr.align(a, b, join="inner", exclude=["qc_set"])
+    common = (a.ws.notnull() & b.ws.notnull()).values
+    ws_diff = np.where(common, (a.ws - b.ws).values, 0)
+    vector_diff = np.where(
+        common, ((a.u - b.u) ** 2 + (a.v - b.v) ** 2).values, 0)
+    return {"n": common.sum(axis=(1, 2)),
+            "ws_diff": ws_diff.sum(axis=(1, 2)),
+            "ws_diff_sq": (ws_diff ** 2).sum(axis=(1, 2)),
+            "vector_diff_sq": vector_diff.sum(axis=(1, 2))}
+
+
+def sweep_interval(sets, start_datetime, end_datetime, time_agg,
+                   memory_budget=None):
+    """
+    Counts of one interval (e.g. a day), {station: {count: array per set}}
+    and {(station, station): {sum: array per set}}.
+    """
+    date = pd.Timestamp(start_datetime)
+    station_counts = {}
+    l3 = {}
+    for station_code in L2_to_L3.deployment_calendar().station_codes:
+        d = L2_to_L3.get_station_deployment(
+            station_code, start_datetime, end_datetime)
+        if d is None:
+            continue
+        if d.instrument_type in INSTRUMENTS:
+            read_l1, _, l1_cells = INSTRUMENTS[d.instrument_type]
+            l1 = read_l1(d, date)
+            if l1 is None:
+                logging.info(f"{station_code}({d.instrument_serial}) "
+                             f"{date:%Y%m%d} no L1 file found")
+                continue
+            thresholds, index = instrument_sets(sets, d.instrument_type)
+            l3[station_code], counts = sweep_station(
+                l1, d, thresholds, index, start_datetime, end_datetime,
+                time_agg, memory_budget=memory_budget)
+            counts["l1_cells"] = np.full(len(sets), l1_cells(l1))
+            station_counts[station_code] = counts
+        else:
+            dat = L2_to_L3.station_l2(d, start_datetime, end_datetime,
+                                      time_agg)
+            if dat is None:
+                continue
+            l3[station_code] = harmonised_sets(
+                dat.load(), d, start_datetime, end_datetime,
+                time_agg).isel(qc_set=np.zeros(len(sets), dtype=int))
+        station_counts.setdefault(station_code, {})["l3_values"] = \
+            l3[station_code].ws.notnull().sum(["time", "altitude"]).values
+        logging.info(f"{station_code} {date:%Y%m%d} swept")
+
+    pair_counts = {
+        (a, b): pair_stats(l3[a], l3[b])
+        for a, b in itertools.combinations(sorted(l3), 2)}
+
+    return station_counts, pair_counts
+
+
+def accumulate(totals, counts):
+    for key, values in counts.items():
+        totals.setdefault(key, {})
+        for name, value in values.items():
+            totals[key][name] = totals[key].get(name, 0) + value
+
+
+def sweep(sets, start_datetime, end_datetime, time_agg=None,
+          memory_budget=None):
+    """
+    Evaluate the threshold sets over [start_datetime, end_datetime), one
+    day at a time.
+
+    Returns
+    -------
+    stations, pairs : pd.DataFrame
+        one row per set and station and per set and pair of stations
+    """
+    time_agg = time_agg or min(L2_to_L3.time_aggs)
+    days = pd.date_range(start_datetime, end_datetime, freq=L2_to_L3.file_freq)
+    station_totals = {}
+    pair_totals = {}
+    for start, end in zip(days[:-1], days[1:]):
+        station_counts, pair_counts = sweep_interval(
+            sets, str(start), str(end), time_agg,
+            memory_budget=memory_budget)
+        accumulate(station_totals, station_counts)
+        accumulate(pair_totals, pair_counts)
+
+    stations = []
+    for station_code, totals in station_totals.items():
+        df = sets.copy()
+        df.insert(0, "station", station_code)
+        df["l3_values"] = totals["l3_values"]
+        if "l1_cells" in totals:
+            df["retained_pc"] = 100 * totals["retained"] / totals["l1_cells"]
+            df["warn_pc"] = 100 * totals["warned"] / totals["retained"]
+        stations.append(df)
+    pairs = []
+    for (a, b), totals in pair_totals.items():
+        df = sets.copy()
+        df.insert(0, "station_b", b)
+        df.insert(0, "station_a", a)
+        n = totals["n"]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            df["n"] = n
+            df["ws_bias"] = totals["ws_diff"] / n
+            df["ws_rmsd"] = np.sqrt(totals["ws_diff_sq"] / n)
+            df["vector_rmsd"] = np.sqrt(totals["vector_diff_sq"] / n)
+        pairs.append(df)
+
+    return (pd.concat(stations) if stations else pd.DataFrame(),
+            pd.concat(pairs) if pairs else pd.DataFrame())
+
+
+def summary(sets, stations, pairs):
+    """Per set: mean retained_pc of the swept stations, pooled vector RMSD."""
+    out = sets.copy()
+    if "retained_pc" in stations:
+        out["retained_pc"] = stations.groupby(level="qc_set").retained_pc.mean()
+    if len(pairs):
+        pooled = pairs.assign(sq=pairs.vector_rmsd ** 2 * pairs.n).groupby(
+            level="qc_set")[["sq", "n"]].sum()
+        out["pair_values"] = pooled.n
+        out["vector_rmsd"] = np.sqrt(pooled.sq / pooled.n)
+
+    return out
+
+
+def parse_param(param):
+    """name=v1,v2,... -> (name, [float])"""
+    name, _, values = param.partition("=")
+    if not values:
+        raise argparse.ArgumentTypeError(f"Expected name=v1,v2,... not {param}")
+    known = [p for params in SWEPT_PARAMS.values() for p in params]
+    if name not in known:
+        raise argparse.ArgumentTypeError(
+            f"Unknown threshold {name}, one of {', '.join(known)}")
+
+    return name, [float(value) for value in values.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Evaluate a grid of QC thresholds without writing L2.")
+    parser.add_argument("-s", "--startdate", required=True,
+                        help="Start datetime in ISO format")
+    parser.add_argument("-e", "--enddate", required=True,
+                        help="End datetime (exclusive) in ISO format")
+    parser.add_argument("--param", type=parse_param, action="append",
+                        required=True,
+                        help="Threshold values to sweep, name=v1,v2,... "
+                        "Repeat for more thresholds, the grid is every "
+                        "combination")
+    parser.add_argument("--time-agg", type=int,
+                        help="L3 aggregation (s) the stations are compared "
+                        f"at, default {min(L2_to_L3.time_aggs)}")
+    parser.add_argument("--memory-budget", type=memtrack.memory_budget,
+                        help="QC and harmonise the sets in blocks that fit "
+                        "this much memory, e.g. 4G, or auto")
+    parser.add_argument("-o", "--output", default="qcsweep",
+                        help="Prefix of the {output}_stations.csv, "
+                        "{output}_pairs.csv and {output}_summary.csv files")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    sets = threshold_sets(dict(args.param))
+    logging.info(f"{len(sets)} threshold sets")
+    stations, pairs = sweep(sets, args.startdate, args.enddate,
+                            time_agg=args.time_agg,
+                            memory_budget=args.memory_budget)
+    stations.to_csv(f"{args.output}_stations.csv")
+    pairs.to_csv(f"{args.output}_pairs.csv")
+    out = summary(sets, stations, pairs)
+    out.to_csv(f"{args.output}_summary.csv")
+    print(out.to_string())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+Quicklook (QL) pyramid of the L3 data. For each station the finest L3
+aggregation is kept as time-height tiles at three levels: one file per day
+at 10 min, per week at 1 h and per month at 6 h. Each level is coarser in
+altitude too. Tiles hold the mean and the number of L3 values of ws, u, v and
+the flag percentages (wd is recomputed from the mean u and v), so coarser
+tiles are exact weighted means of the finer ones.
+
+update() refreshes the tiles touched by newly written L3 files, render()
+plots any time range from the coarsest level that still resolves it.
+"""
+
+import os
+import glob
+import argparse
+import logging
+import numpy as np
+import pandas as pd
+import xarray as xr
+import harmonise
+
+QL_VARS = ["ws", "u", "v", "flag_suspect_retrieval_warn",
+           "flag_suspect_retrieval_removed"]
+# finest to coarsest, each with the period one tile covers
+LEVELS = {
+    "daily": {"period": "D", "time_res": "10min", "z_res": 50},
+    "weekly": {"period": "W-SUN", "time_res": "1h", "z_res": 100},
+    "monthly": {"period": "M", "time_res": "6h", "z_res": 200},
+}
+# render from the coarsest level with at least this many time steps
+MIN_COLUMNS = 200
+PLOT_STYLES = {
+    "ws": {"cmap": "viridis", "vmin": 0, "vmax": 20, "label": "ws (m s-1)"},
+    "wd": {"cmap": "twilight", "vmin": 0, "vmax": 360, "label": "wd (deg)"},
+    "u": {"cmap": "RdBu_r", "vmin": -20, "vmax": 20, "label": "u (m s-1)"},
+    "v": {"cmap": "RdBu_r", "vmin": -20, "vmax": 20, "label": "v (m s-1)"},
+    "flag_suspect_retrieval_warn": {
+        "cmap": "magma_r", "vmin": 0, "vmax": 100, "label": "warn (%)"},
+    "flag_suspect_retrieval_removed": {
+        "cmap": "magma_r", "vmin": 0, "vmax": 100, "label": "removed (%)"},
+}
+
+
+def tile_filename(station, level, period):
+    return os.path.join(
+        harmonise.QL_BASEDIR, station, level,
+        f"{station}_QL_{level}_{period.start_time:%Y%m%d}.nc")
+
+
+def add_wd(tile):
+    ws, wd = harmonise.vector_to_ws_wd(tile["u"].values, tile["v"].values)
+    tile["wd"] = tile["u"].copy(data=wd)
+    return tile
+
+
+def coarsen(tile, time_res, z_res):
+    """
+    Tile (with {var} and {var}_count) aggregated to time_res and z_res metres,
+    means weighted by the counts.
+    """
+    step = int(tile.altitude.diff("altitude").min()) if \
+        tile.sizes["altitude"] > 1 else z_res
+    sums = xr.Dataset(
+        {var: (tile[var] * tile[f"{var}_count"]).fillna(0) for var in QL_VARS})
+    sums.update({f"{var}_count": tile[f"{var}_count"] for var in QL_VARS})
+    sums = sums.resample(time=time_res).sum()
+    if z_res > step:
+        sums = sums.coarsen(altitude=z_res // step, boundary="pad",
+                            coord_func="min").sum()
+    out = xr.Dataset(coords=sums.coords)
+    for var in QL_VARS:
+        count = sums[f"{var}_count"]
+        out[var] = (sums[var] / count).where(count > 0).astype(np.float32)
+        out[f"{var}_count"] = count.astype(np.int32)
+    out["altitude"] = out.altitude.astype(np.int32)
+
+    return add_wd(out)
+
+
+def l3_tile(dat, station):
+    """The finest tile of one station from an L3 dataset, None if no data."""
+    dat = dat.sel(station=station)
+    tile = xr.Dataset(coords={"time": dat.time, "altitude": dat.altitude})
+    for var in QL_VARS:
+        tile[var] = dat[var]
+        tile[f"{var}_count"] = dat[var].notnull().astype(np.int32)
+    if not int(tile["ws_count"].sum()):
+        return None
+    daily = LEVELS["daily"]
+
+    return coarsen(tile, daily["time_res"], daily["z_res"])
+
+
+def write_tile(tile, filename):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmp_file = filename + ".tmp"
+    tile.to_netcdf(tmp_file, encoding={
+        var: harmonise.DEFAULT_COMPRESSION for var in tile.data_vars})
+    os.replace(tmp_file, filename)
+
+
+def read_tiles(station, level, start, end):
+    """
+    Tiles of a level overlapping [start, end) concatenated in time, None if
+    there are none.
+    """
+    periods = pd.period_range(start, pd.Timestamp(end) - pd.Timedelta(1),
+                              freq=LEVELS[level]["period"])
+    tiles = []
+    for period in periods:
+        filename = tile_filename(station, level, period)
+        if os.path.exists(filename):
+            with xr.open_dataset(filename) as tile:
+                tiles.append(tile.load())
+    if not tiles:
+        return None
+    tiles = xr.concat(tiles, dim="time", join="outer")
+
+    return tiles.sel(time=slice(start, pd.Timestamp(end) - pd.Timedelta(1)))
+
+
+def update_station_day(dat, station, day):
+    """Write the daily tile of station and rebuild the coarser ones."""
+    tile = l3_tile(dat.sel(time=slice(day, day + pd.Timedelta(days=1) -
+                                      pd.Timedelta(1))), station)
+    if tile is None:
+        return
+    write_tile(tile, tile_filename(station, "daily", pd.Period(day, "D")))
+    for level, spec in list(LEVELS.items())[1:]:
+        period = pd.Period(day, spec["period"])
+        daily = read_tiles(station, "daily", period.start_time,
+                           period.end_time + pd.Timedelta(1))
+        write_tile(coarsen(daily, spec["time_res"], spec["z_res"]),
+                   tile_filename(station, level, period))
+
+
+def update(l3_files):
+    """
+    Update the pyramid with L3 files. Only files of the finest L3
+    aggregation are used, others are ignored.
+    """
+    for l3_file in l3_files:
+        with xr.open_dataset(l3_file) as dat:
+            if int(dat.attrs["aggregation_time_s"]) > pd.Timedelta(
+                    LEVELS["daily"]["time_res"]).total_seconds():
+                continue
+            days = pd.date_range(dat.time.values[0], dat.time.values[-1],
+                                 freq="D", normalize=True)
+            dat = dat[QL_VARS].load()
+        for station in dat.station.values:
+            for day in days:
+                update_station_day(dat, str(station), day)
+        logging.info(f"Updated quicklooks from {l3_file}")
+
+
+def choose_level(start, end, min_columns=MIN_COLUMNS):
+    """The coarsest level with at least min_columns time steps in the range."""
+    duration = pd.Timestamp(end) - pd.Timestamp(start)
+    chosen = list(LEVELS)[0]
+    for level, spec in LEVELS.items():
+        if duration / pd.Timedelta(spec["time_res"]) >= min_columns:
+            chosen = level
+
+    return chosen
+
+
+def render(start, end, out_file, var="ws", stations=None,
+           min_columns=MIN_COLUMNS):
+    """
+    Time-height plot of var, one panel per station, read from the pyramid.
+
+    Returns
+    -------
+    the level used
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    level = choose_level(start, end, min_columns)
+    if stations is None:
+        stations = sorted(os.listdir(harmonise.QL_BASEDIR))
+    tiles = {station: read_tiles(station, level, start, end)
+             for station in stations}
+    tiles = {station: tile for station, tile in tiles.items()
+             if tile is not None}
+    if not tiles:
+        raise FileNotFoundError(f"No {level} quicklooks for {start} - {end}")
+
+    style = PLOT_STYLES[var]
+    fig, axs = plt.subplots(len(tiles), 1, sharex=True, squeeze=False,
+                            figsize=(12, 1.8 * len(tiles) + 1))
+    for ax, (station, tile) in zip(axs[:, 0], tiles.items()):
+        mesh = ax.pcolormesh(tile.time.values, tile.altitude.values,
+                             tile[var].values.T, shading="nearest",
+                             cmap=style["cmap"], vmin=style["vmin"],
+                             vmax=style["vmax"])
+        ax.set_ylabel(f"{station}\naltitude (m)")
+        ax.set_xlim(pd.Timestamp(start), pd.Timestamp(end))
+    fig.colorbar(mesh, ax=axs[:, 0], label=style["label"])
+    axs[0, 0].set_title(f"{var} {start} - {end} ({level})")
+    fig.savefig(out_file, dpi=100)
+    plt.close(fig)
+    logging.info(f"Wrote {out_file} from {level} quicklooks")
+
+    return level
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Update or render the L3 quicklook pyramid.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    update_parser = subparsers.add_parser(
+        "update", help="(Re)build the pyramid from existing L3 files")
+    render_parser = subparsers.add_parser(
+        "render", help="Plot a time range from the pyramid")
+    for subparser in [update_parser, render_parser]:
+        subparser.add_argument("-s", "--startdate", required=True,
+                               help="Start datetime in ISO format")
+        subparser.add_argument("-e", "--enddate", required=True,
+                               help="End datetime in ISO format")
+    render_parser.add_argument("-o", "--output", required=True,
+                               help="Image file")
+    render_parser.add_argument("--var", default="ws",
+                               choices=list(PLOT_STYLES))
+    render_parser.add_argument("--station", nargs="+",
+                               help="Station codes, default all")
+    render_parser.add_argument("--min-columns", type=int,
+                               default=MIN_COLUMNS,
+                               help="Use the coarsest level with at least "
+                               "this many time steps in the range")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == "update":
+        l3_files = []
+        for l3_file in sorted(glob.glob(
+                os.path.join(harmonise.L3_BASEDIR, "*.nc"))):
+            with xr.open_dataset(l3_file) as dat:
+                file_start = pd.Timestamp(dat.attrs["start_time_utc"])
+            if pd.Timestamp(args.startdate) <= file_start < \
+                    pd.Timestamp(args.enddate):
+                l3_files.append(l3_file)
+        update(l3_files)
+    else:
+        render(args.startdate, args.enddate, args.output, var=args.var,
+               stations=args.station, min_columns=args.min_columns)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+Local staging of RAW archive files. The archive (harmonise.RAW_BASEDIR) is a
+slow offline drive; files are copied once to a fast local directory and read
+from there while they are unchanged in the archive (same size and mtime).
+The local copies are a size bounded LRU cache that survives between runs,
+and the files of upcoming work units can be copied in the background while
+the current unit is processed.
+"""
+
+import os
+import json
+import time
+import shutil
+import logging
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import harmonise
+
+INDEX_FILENAME = "staging-index.json"
+
+
+class StagingCache:
+    """
+    Size bounded LRU cache of archive files in a local directory.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Local (fast) directory for the copies and the index.
+    max_bytes : int
+        Total size of the copies. The least recently used unpinned copies are
+        evicted to make room. A file larger than max_bytes is read from the
+        archive directly.
+    archive_dir : str
+        Files are cached under their path relative to archive_dir. Files
+        outside it are read from where they are.
+    """
+
+    def __init__(self, cache_dir, max_bytes, archive_dir=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.archive_dir = archive_dir or harmonise.RAW_BASEDIR
+        self.hits = 0
+        self.misses = 0
+        self._cond = threading.Condition()
+        self._copying = set()
+        self._pinned = {}
+        self._executor = None
+        self._prefetched = set()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._index = self._load_index()
+
+    def _index_file(self):
+        return os.path.join(self.cache_dir, INDEX_FILENAME)
+
+    def _load_index(self):
+        try:
+            with open(self._index_file()) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        # drop entries whose copy has gone or was cut short
+        return {
+            key: entry for key, entry in index.items()
+            if os.path.isfile(self._local_path(key)) and
+            os.path.getsize(self._local_path(key)) == entry["size"]
+        }
+
+    def save(self):
+        with self._cond:
+            index = dict(self._index)
+        tmp_file = self._index_file() + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_file, self._index_file())
+
+    def _key(self, path):
+        rel_path = os.path.relpath(path, self.archive_dir)
+        if rel_path.startswith(os.pardir) or os.path.isabs(rel_path):
+            return None
+        return rel_path.replace(os.sep, "/")
+
+    def _local_path(self, key):
+        return os.path.join(self.cache_dir, *key.split("/"))
+
+    def size(self):
+        with self._cond:
+            return sum(entry["size"] for entry in self._index.values())
+
+    def _make_room(self, n_bytes):
+        # called with self._cond held
+        used = sum(entry["size"] for entry in self._index.values())
+        lru = sorted(self._index.items(), key=lambda item: item[1]["used"])
+        for key, entry in lru:
+            if used + n_bytes <= self.max_bytes:
+                break
+            if key in self._pinned or key in self._copying:
+                continue
+            try:
+                os.remove(self._local_path(key))
+            except FileNotFoundError:
+                pass
+            del self._index[key]
+            used -= entry["size"]
+        return used + n_bytes <= self.max_bytes
+
+    def stage(self, path):
+        """
+        Local copy of the archive file path, copied now if there is no valid
+        copy yet. Returns path itself if it can not be cached.
+        """
+        key = self._key(path)
+        if key is None:
+            return path
+        fingerprint = harmonise.file_fingerprint(path)
+        local_path = self._local_path(key)
+        with self._cond:
+            while key in self._copying:
+                self._cond.wait()
+            entry = self._index.get(key)
+            if entry is not None and \
+                    entry["size"] == fingerprint["size"] and \
+                    entry["mtime"] == fingerprint["mtime"]:
+                entry["used"] = time.time()
+                self.hits += 1
+                return local_path
+            if entry is not None:
+                del self._index[key]
+            if fingerprint["size"] > self.max_bytes or \
+                    not self._make_room(fingerprint["size"]):
+                logging.debug(f"No room to stage {path}, read from archive")
+                return path
+            self._copying.add(key)
+            # reserve the space while copying
+            self._index[key] = {"size": fingerprint["size"],
+                                "mtime": None, "used": time.time()}
+
+        try:
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            tmp_path = local_path + ".part"
+            shutil.copyfile(path, tmp_path)
+            os.replace(tmp_path, local_path)
+        except Exception:
+            with self._cond:
+                self._index.pop(key, None)
+                self._copying.discard(key)
+                self._cond.notify_all()
+            raise
+
+        with self._cond:
+            self._index[key] = {"size": fingerprint["size"],
+                                "mtime": fingerprint["mtime"],
+                                "used": time.time()}
+            self._copying.discard(key)
+            self.misses += 1
+            self._cond.notify_all()
+        return local_path
+
+    @contextmanager
+    def staged(self, paths):
+        """
+        Local copies of paths (see stage), protected from eviction while in
+        the context.
+        """
+        keys = [self._key(path) for path in paths]
+        with self._cond:
+            for key in keys:
+                self._pinned[key] = self._pinned.get(key, 0) + 1
+        try:
+            yield [self.stage(path) for path in paths]
+        finally:
+            with self._cond:
+                for key in keys:
+                    self._pinned[key] -= 1
+                    if not self._pinned[key]:
+                        del self._pinned[key]
+
+    def _stage_quietly(self, paths):
+        for path in paths:
+            try:
+                self.stage(path)
+            except OSError as e:
+                logging.warning(f"Could not stage {path}: {e}")
+
+    def prefetch(self, paths):
+        """Stage paths in a background thread (one file at a time)."""
+        paths = [path for path in paths if path not in self._prefetched]
+        if not paths:
+            return
+        self._prefetched.update(paths)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="staging")
+        self._executor.submit(self._stage_quietly, paths)
+
+    def close(self):
+        """Wait for the prefetches and save the index."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self.save()
+        logging.info(
+            f"Staging cache {self.cache_dir}: {self.hits} hits, "
+            f"{self.misses} copies, {self.size() / 1024 ** 3:.2f} GiB")
+
+
+def stage_ahead(cache, units, files_of, depth=1):
+    """
+    Iterate over the scheduled work units, prefetching the files of the next
+    depth units into cache while each unit is processed.
+
+    Parameters
+    ----------
+    cache : StagingCache | None
+        None to iterate without staging
+    units : iterable
+    files_of : callable
+        unit -> list of archive paths the unit reads
+    depth : int
+    """
+    units = list(units)
+    for i, unit in enumerate(units):
+        if cache is not None:
+            for next_unit in units[i + 1:i + 1 + depth]:
+                cache.prefetch(files_of(next_unit))
+        yield unit
@@ -8,8 +8,12 @@ Created on Wed Jun 19 15:07:07 2024
 from glob import glob
 import xarray as xr
 import os
+import sys
+import argparse
+import logging
 from datetime import datetime as dt
 import harmonise
+import iopipe
 import numpy as np
 
 __version__ = "1.17"
@@ -36,10 +40,12 @@ PRODUCT_NAME = "streamLine"
 PRODUCT_LEVEL = 2
 
 
-def streamline_flag_low_signal_removed(dat):
+def streamline_flag_low_signal_removed(dat, intensity_valid_err=None):
+    if intensity_valid_err is None:
+        intensity_valid_err = INTENSITY_VALID_ERR
 
     # mean intensity valid
-    low_signal_removed = dat.wind_mean_intensity < INTENSITY_VALID_ERR
+    low_signal_removed = dat.wind_mean_intensity < intensity_valid_err
     dat["zonal_wind"] = dat.zonal_wind.where(~low_signal_removed)
     dat["meridional_wind"] = dat.meridional_wind.where(~low_signal_removed)
     low_signal_removed.rename("flag_low_signal_removed")
@@ -48,18 +54,25 @@ def streamline_flag_low_signal_removed(dat):
     return dat
 
 
-def streamline_flag_low_signal_warn(dat):
+def streamline_flag_low_signal_warn(dat, intensity_valid_warn=None,
+                                    intensity_valid_err=None):
+    if intensity_valid_warn is None:
+        intensity_valid_warn = INTENSITY_VALID_WARN
+    if intensity_valid_err is None:
+        intensity_valid_err = INTENSITY_VALID_ERR
 
     # mean intensity valid
-    low_signal_warn = (dat.wind_mean_intensity < INTENSITY_VALID_WARN) & (
-        dat.wind_mean_intensity > INTENSITY_VALID_ERR)
+    low_signal_warn = (dat.wind_mean_intensity < intensity_valid_warn) & (
+        dat.wind_mean_intensity > intensity_valid_err)
     low_signal_warn.rename("flag_low_signal_warn")
     dat["flag_low_signal_warn"] = low_signal_warn
 
     return dat
 
 
-def streamline_flag_suspect_retrieval_warn(dat):
+def streamline_flag_suspect_retrieval_warn(dat, wind_rmse_valid_warn=None):
+    if wind_rmse_valid_warn is None:
+        wind_rmse_valid_warn = WIND_RMSE_VALID_WARN
     # despeckle data and warn
     despeckle_invalid = dat.zonal_wind.notnull().rolling(
         range=MIN_CONSECUTIVE_RANGE_GATES, center=True).sum()
@@ -74,7 +87,7 @@ def streamline_flag_suspect_retrieval_warn(dat):
         INVALID_LOW_RANGE_GATE_M +
         (gate_length * (MIN_CONSECUTIVE_RANGE_GATES / 2)))] = False
 
-    rmse_warn = dat.wind_rmse > WIND_RMSE_VALID_WARN
+    rmse_warn = dat.wind_rmse > wind_rmse_valid_warn
 
     flag_suspect_retrieval_warn = despeckle_invalid | rmse_warn
     flag_suspect_retrieval_warn.rename("flag_suspect_retrieval_warn")
@@ -83,15 +96,20 @@ def streamline_flag_suspect_retrieval_warn(dat):
     return dat
 
 
-def streamline_flag_suspect_retrieval_removed(dat):
+def streamline_flag_suspect_retrieval_removed(dat, nrays_pc_valid=None,
+                                              wind_rmse_valid_err=None):
+    if nrays_pc_valid is None:
+        nrays_pc_valid = NRAYS_PC_VALID
+    if wind_rmse_valid_err is None:
+        wind_rmse_valid_err = WIND_RMSE_VALID_ERR
     first_gates_invalid = xr.zeros_like(dat.wind_rmse, dtype=bool)
     first_gates_invalid[:, dat.range < INVALID_LOW_RANGE_GATE_M] = True
 
     # pc valid
     nrays = dat.nrays.median().values
-    nrays_invalid = (((dat.nrays_valid / nrays) * 100) < NRAYS_PC_VALID)
+    nrays_invalid = (((dat.nrays_valid / nrays) * 100) < nrays_pc_valid)
     # rmse
-    rmse_invalid = dat.wind_rmse > WIND_RMSE_VALID_ERR
+    rmse_invalid = dat.wind_rmse > wind_rmse_valid_err
 
     # add more when needed
     flag_suspect_retrieval_removed = first_gates_invalid | nrays_invalid | \
@@ -137,33 +155,79 @@ def streamLine_height_as_vertical_dimension(dat):
     return dat
 
 
+def streamline_l1_to_l2(dat, wind_rmse_valid_warn=None,
+                        wind_rmse_valid_err=None, nrays_pc_valid=None,
+                        intensity_valid_warn=None, intensity_valid_err=None):
+    """
+    QC a StreamLine L1 dataset and put it in the common L2 form. The QC
+    thresholds default to the module constants. Given as xr.DataArrays along
+    a dimension of their own (see qcsweep.py) the dataset is QCed with every
+    set of thresholds at once, along that dimension.
+    """
+    dat = streamline_flag_suspect_retrieval_removed(
+        dat, nrays_pc_valid=nrays_pc_valid,
+        wind_rmse_valid_err=wind_rmse_valid_err)
+    dat = streamline_flag_low_signal_removed(
+        dat, intensity_valid_err=intensity_valid_err)
+    dat = streamline_flag_low_signal_warn(
+        dat, intensity_valid_warn=intensity_valid_warn,
+        intensity_valid_err=intensity_valid_err)
+    dat = streamline_flag_suspect_retrieval_warn(
+        dat, wind_rmse_valid_warn=wind_rmse_valid_warn)
+    dat = streamline_harmonise_varnames(dat)
+    dat = harmonise.flag_ws_out_of_range(dat)
+    dat = streamLine_height_as_vertical_dimension(dat)
+    dat = harmonise.select_preharmonisation_data_vars(dat)
+    dat.attrs = {"production_level": PRODUCT_LEVEL,
+                 "production_version": __version__,
+                 }
+
+    return dat
+
+
+def write_l2(dat, system_serial, file_date):
+    OUTPUT_FILE = harmonise.PRODUCT_FILENAME_TEMPLATE.format(
+        product_name=PRODUCT_NAME, product_level=PRODUCT_LEVEL,
+        product_version=__version__, system_serial=system_serial)
+    out_file = dt.strftime(file_date, OUTPUT_FILE)
+    out_dir = os.path.join(harmonise.L2_BASEDIR, out_file)
+    if not os.path.exists(os.path.dirname(out_dir)):
+        os.makedirs(os.path.dirname(out_dir), exist_ok=True)
+    dat.to_netcdf(out_dir, encoding=harmonise.encode_nc_compression(dat))
+
+    return out_dir
+
+
 def main():
-    files = glob(os.path.join(harmonise.L1_BASEDIR, INPUT_FILENAME_GSUB))
-    for file in files:
+    parser = argparse.ArgumentParser(description="StreamLine L1 to L2.")
+    parser.add_argument("--read-ahead", type=int, default=1,
+                        help="Files to read ahead of the file processed, 0 "
+                        "to read in sequence")
+    parser.add_argument("--writers", type=int, default=1,
+                        help="Threads writing L2 files behind the reads, 0 "
+                        "to write in sequence")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
+        datefmt='%H:%M:%S', level=logging.INFO)
+
+    def write_file(file, dat):
         system_serial = os.path.basename(os.path.dirname(file))
-
         file_date = dt.strptime(os.path.basename(file).split("_")[2], "%Y%m%d")
-        dat = xr.load_dataset(file)
-        dat = streamline_flag_suspect_retrieval_removed(dat)
-        dat = streamline_flag_low_signal_removed(dat)
-        dat = streamline_flag_low_signal_warn(dat)
-        dat = streamline_flag_suspect_retrieval_warn(dat)
-        dat = streamline_harmonise_varnames(dat)
-        dat = harmonise.flag_ws_out_of_range(dat)
-        dat = streamLine_height_as_vertical_dimension(dat)
-        dat = harmonise.select_preharmonisation_data_vars(dat)
-        dat.attrs = {"production_level": PRODUCT_LEVEL,
-                     "production_version": __version__,
-                     }
-        OUTPUT_FILE = harmonise.PRODUCT_FILENAME_TEMPLATE.format(
-            product_name=PRODUCT_NAME, product_level=PRODUCT_LEVEL,
-            product_version=__version__, system_serial=system_serial)
-        out_file = dt.strftime(file_date, OUTPUT_FILE)
-        out_dir = os.path.join(harmonise.L2_BASEDIR, out_file)
-        if not os.path.exists(os.path.dirname(out_dir)):
-            os.makedirs(os.path.dirname(out_dir), exist_ok=True)
-        dat.to_netcdf(out_dir, encoding=harmonise.encode_nc_compression(dat))
-        print(out_dir)
+        return write_l2(dat, system_serial, file_date)
+
+    files = glob(os.path.join(harmonise.L1_BASEDIR, INPUT_FILENAME_GSUB))
+    failed = []
+    for file, out_file in iopipe.pipelined(
+            files, xr.load_dataset, write_file,
+            lambda file, dat: streamline_l1_to_l2(dat),
+            read_ahead=args.read_ahead, writers=args.writers, failed=failed):
+        if out_file is not None:
+            print(out_file)
+    if failed:
+        logging.error(f"{len(failed)} of {len(files)} files failed")
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -5,39 +5,62 @@ Created on Tue Nov 21 08:46:52 2023
 @author: willm
 """
 # python .\halo-reader-write.py --startdate 2023-06-01 --enddate 2023-06-02
+import os
+if __name__ == "__main__":
+    # read by the OpenMP runtime when numpy and haloreader load it, so it is
+    # set before those imports. Only when run as a script, not for every
+    # process importing the module (e.g. pipeline.py)
+    os.environ["OMP_NUM_THREADS"] = '7'
 import argparse
-from haloreader.exceptions import BackgroundCorrectionError
-import glob
+import sys
 from pathlib import Path
-from haloreader.read import read, read_bg, Product
-import pandas as pd
-import xarray as xr
-from haloreader.variable import Variable
 import datetime as dt
-import json
-import os
 import numpy as np
 import harmonise
+import memtrack
+import staging
+import hplcache
+import iopipe
 import logging
 from meta import filemeta
 import fnmatch
-from haloreader import __version__ as __haloreader_version__
+# haloreader, pandas, xarray, hplparse and vadwind are imported where they
+# are used, so that importing this module (e.g. from pipeline.py) is cheap
 
 __version__ = "2.17"
 
 author = "William Morrison"
 
-os.environ["OMP_NUM_THREADS"] = '7'
 
-program_summary = (
-    f"Production of L1 horizontal wind profiles from RAW .hpl StreamLine scan "
-    f"files using a modified version of "
-    f"https://github.com/actris-cloudnet/halo-reader version {__haloreader_version__} "
-    f"with code available on https://github.com/willmorrison1/paris-harmonised-dwl"
-)
+def haloreader_version():
+    import haloreader
+    return haloreader.__version__
+
+
+def program_summary():
+    return (
+        f"Production of L1 horizontal wind profiles from RAW .hpl StreamLine scan "
+        f"files using a modified version of "
+        f"https://github.com/actris-cloudnet/halo-reader version {haloreader_version()} "
+        f"with code available on https://github.com/willmorrison1/paris-harmonised-dwl"
+    )
+
+
+def wind_product(product=None):
+    """product, by default haloreader's Product.WIND."""
+    if product is None:
+        from haloreader.read import Product
+        product = Product.WIND
+    return product
 # todo
 # what is the expected scan elevation? reject scans if scan angle is not np.close
 EXPECTED_SCAN_ELEVATION = 75
+# wind retrievals: haloreader's halo.compute_wind scan by scan, or all scans
+# of the day at once with vadwind
+RETRIEVALS = ["haloreader", "vad"]
+# .hpl parsers: haloreader's read, or hpl (hplparse) for the same Halo in
+# bulk
+PARSERS = ["haloreader", "hpl"]
 
 
 def build_compression_dict(xr_ds):
@@ -86,6 +109,9 @@ def to_xarray(halo):
     halo_xr : xr.Dataset
 
     """
+    import pandas as pd
+    import xarray as xr
+    from haloreader.variable import Variable
 
     data_vars = dict()
     coords = dict()
@@ -158,6 +184,9 @@ min_valid_intensity_threshold_wind = 1.005
 # how many days of background data to read for any given day?
 bg_n_days_ago = 21
 
+ARCHIVE_DIR = harmonise.RAW_BASEDIR
+BASE_DIR = harmonise.L1_BASEDIR
+
 
 def valid_date(s):
     """Validates the date format YYYY-MM-DD."""
@@ -168,161 +197,371 @@ def valid_date(s):
         raise argparse.ArgumentTypeError(msg)
 
 
-parser = argparse.ArgumentParser(description="Process start and end dates.")
-parser.add_argument("-s", "--startdate",
-                    help="Start date in format YYYY-MM-DD",
-                    type=valid_date,
-                    default='2023-02-17')
-parser.add_argument("-e", "--enddate",
-                    help="End date in format YYYY-MM-DD",
-                    type=valid_date,
-                    default='2023-02-17')
+def select_background_files(all_files, start_date, end_date):
+    bg_file_datetime = "Background_%d%m%y-%H%M%S.txt"
+    all_bg_files = fnmatch.filter(all_files, "Background_??????-??????.txt")
+    return select_files_by_date(
+        all_bg_files, bg_file_datetime, start_date -
+        dt.timedelta(days=bg_n_days_ago),
+        end_date)
 
-args = parser.parse_args()
 
-ARCHIVE_DIR = os.path.join(
-    "D:/urbisphere/status-meteo-archive-offline/srv/meteo/archive/urbisphere/",
-    "data/RAW/by-source/smurobs/by-serialnr/France/Paris/StreamLine/",
-)
-BASE_DIR = harmonise.L1_BASEDIR
+def keeps_npulses_per_ray(retrieval):
+    """
+    Whether the scans of a day may change pulses per ray, merged by
+    hplparse.merge with the npulses of every ray. Only vadwind uses them
+    scan by scan, compute_wind takes one npulses.
+    """
+    return retrieval == "vad"
+
+
+def select_scan_files(all_files, file_type, instrument_serial, start_date,
+                      end_date, npulses_per_ray=False):
+    file_datetime = file_type["datetime_pattern"].format(
+        instrument_serial=instrument_serial)
+    files = select_files_by_date(
+        all_files, file_datetime, start_date, end_date)
+    patterns = filemeta.reject_files_glob_L0
+    if not npulses_per_ray:
+        patterns = patterns + filemeta.npulses_change_files_glob_L0
+    for pattern in patterns:
+        files = [file for file in files if not fnmatch.fnmatch(
+            file, pattern)]
+    return files
+
+
+def day_bounds(date):
+    import pandas as pd
+    start_date = pd.Timestamp(date).to_pydatetime()
+    end_date = start_date + dt.timedelta(hours=23, minutes=59, seconds=59)
+    return start_date, end_date
 
-start_date = args.startdate
-end_date = args.enddate
 
-logging.basicConfig(
-    filename=f"{log_dir}/{PROGRAM_NAME}_{start_date}-{end_date}_{dt.datetime.utcnow().strftime('%Y%m%d%H%M%S')}.log",
-    filemode='a',
-    format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
-    datefmt='%H:%M:%S',
-    level=logging.INFO)
+def raw_files(deployment, date, product=None,
+              retrieval="haloreader"):
+    """
+    Archive paths of the scan and background files raw_to_l1 reads for
+    deployment on the day starting at date, e.g. to stage them in advance.
+    """
+    product = wind_product(product)
+    start_date, end_date = day_bounds(date)
+    raw_files_dir = os.path.join(ARCHIVE_DIR, deployment.instrument_serial)
+    if not os.path.exists(raw_files_dir):
+        return []
+    all_files = os.listdir(raw_files_dir)
+    files = []
+    if deployment.do_bg_corr is not None:
+        files.extend(select_background_files(all_files, start_date, end_date))
+    file_type = return_file_type(deployment, product.value)
+    if file_type:
+        files.extend(select_scan_files(
+            all_files, file_type, deployment.instrument_serial, start_date,
+            end_date, keeps_npulses_per_ray(retrieval)))
+    return [Path(raw_files_dir, file) for file in files]
+
+
+def read_halo(files, product, local_path, parse_cache=None,
+              parser="haloreader", npulses_per_ray=False):
+    """
+    haloreader's read of the files. With a parse_cache, the hpl parser or
+    scans kept at their own pulses per ray, each file is parsed on its own
+    (or loaded from the cache) and merged the way read merges them
+    (hplparse.merge).
+    """
+    import hplparse
+    from haloreader.read import read
 
-logging.info(f'STARTEND{start_date} {end_date}')
-logging.info(f'Command line arguments {args}')
-logging.info(f"{PROGRAM_NAME} program version {__version__}")
+    if parser == "haloreader" and not npulses_per_ray and parse_cache is None:
+        return read([local_path(file) for file in files], product=product)
 
-with open("meta/deployments-DWL.json") as json_file:
-    deployments = json.load(json_file)
+    def parse(path):
+        if parser == "hpl":
+            return hplparse.read_file(local_path(path))
+        return read([local_path(path)], product=product)
 
-deployments_df = pd.json_normalize(deployments, sep="_")
+    if parse_cache is None:
+        halos = [parse(file) for file in files]
+    else:
+        halos = [parse_cache.get(file, parse, tag=product.value)
+                 for file in files]
+    return hplparse.merge(halos, npulses_per_ray=npulses_per_ray)
 
-# hard-coded as daily files for now
-dates = pd.date_range(start=start_date, end=end_date, freq="D")
 
-product = Product.WIND
+def open_parse_cache(cache_dir, parser="haloreader"):
+    """hplcache.ParseCache of scans parsed by this parser version."""
+    if parser == "hpl":
+        import hplparse
+        return hplcache.ParseCache(
+            cache_dir, f"hplparse {hplparse.__version__}")
+    return hplcache.ParseCache(cache_dir, haloreader_version())
 
-for date in dates:
-    logging.info(date)
-    start_date = date.to_pydatetime()
-    end_date = start_date + dt.timedelta(hours=23, minutes=59, seconds=59)
-    for i, deployment in deployments_df.iterrows():
-        is_deployed = (
-            start_date <= dt.datetime.fromisoformat(
-                deployment.end_datetime)) & (
-            end_date >= dt.datetime.fromisoformat(
-                deployment.start_datetime))
-
-        if not is_deployed:
-            logging.debug(
-                f" For {start_date} - {end_date}, deployment "
-                f"{deployment.station_code} ({deployment.instrument_serial}) "
-                f"{deployment.start_datetime} - {deployment.end_datetime} is "
-                f"not deployed. Skip"
-            )
-            continue
 
-        instrument_serial = deployment.instrument_serial
-        raw_files_dir = os.path.join(ARCHIVE_DIR, instrument_serial)
-        if not os.path.exists(raw_files_dir):
-            continue
-        os.chdir(raw_files_dir)
-        all_files = os.listdir(raw_files_dir)
-        do_bg_corr = not pd.isna(deployment.get("do_bg_corr"))
-        if do_bg_corr:
-            bg_file_datetime = "Background_%d%m%y-%H%M%S.txt"
-            all_bg_files = glob.glob("Background_??????-??????.txt")
-            bg_files = select_files_by_date(
-                all_bg_files, bg_file_datetime, start_date -
-                dt.timedelta(days=bg_n_days_ago),
-                end_date)
-            bg_paths = [Path(file) for file in bg_files]
-            halobg = read_bg(bg_paths)
-            if not halobg:
-                continue
+def raw_to_l1(deployment, date, product=None, staging=None,
+              parse_cache=None, retrieval="haloreader", parser="haloreader"):
+    """
+    L1 of one StreamLine deployment for the day starting at date.
 
-        for product in [Product.WIND]:
-            file_type = return_file_type(deployment, product.value)
-            if not file_type:
-                logging.error(
-                    f"sn {instrument_serial} on {date} has no {product.value} "
-                    f"product. Skip."
-                )
-                continue
-            file_datetime = file_type["datetime_pattern"].format(
-                instrument_serial=instrument_serial)
-            files = select_files_by_date(
-                all_files, file_datetime, start_date, end_date)
-            for pattern in filemeta.reject_files_glob_L0:
-                files = [file for file in files if not fnmatch.fnmatch(
-                    file, pattern)]
-            files = [Path(file) for file in files]
-            if not files:
-                continue
-            try:
-                if not halobg and do_bg_corr:
-                    logging.warn(
-                        f"Wanted to do bg corr on {str(date)} but no bg files "
-                        f"found for sn {instrument_serial}"
-                    )
-                halo = read(files, product=product)
-            except Exception as e:
-                logging.error(
-                    f"Could not read from files: {files} with error {e}")
-                continue
-            if not halo:
-                logging.error(f"Could not read from files: {files}.")
+    Parameters
+    ----------
+    deployment : harmonise.Deployment
+    date : datetime.datetime | pandas.Timestamp
+        start of the day
+    product : haloreader.read.Product, optional
+        default Product.WIND
+    staging : staging.StagingCache, optional
+        read local copies of the archive files
+    parse_cache : hplcache.ParseCache, optional
+        load the parsed scan files from (and add them to) this cache
+    retrieval : str
+        one of RETRIEVALS
+    parser : str
+        one of PARSERS
+
+    Returns
+    -------
+    xr_dat : xr.Dataset | None
+        None if there is nothing (useful) to process, the reason is logged
+    """
+    product = wind_product(product)
+    if staging is None:
+        return _raw_to_l1(deployment, date, product, lambda path: path,
+                          parse_cache, retrieval, parser)
+    # pinned, so prefetches for later days can not evict them mid-read.
+    # scans in the parse cache are not read at all
+    paths = [path for path in raw_files(deployment, date, product, retrieval)
+             if parse_cache is None or
+             not parse_cache.has(path, product.value)]
+    with staging.staged(paths):
+        return _raw_to_l1(deployment, date, product,
+                          lambda path: Path(staging.stage(path)),
+                          parse_cache, retrieval, parser)
+
+
+def _raw_to_l1(deployment, date, product, local_path, parse_cache=None,
+               retrieval="haloreader", parser="haloreader"):
+    from haloreader.exceptions import BackgroundCorrectionError
+    from haloreader.read import read_bg
+
+    start_date, end_date = day_bounds(date)
+    instrument_serial = deployment.instrument_serial
+    raw_files_dir = os.path.join(ARCHIVE_DIR, instrument_serial)
+    if not os.path.exists(raw_files_dir):
+        return None
+    all_files = os.listdir(raw_files_dir)
+    # any do_bg_corr entry, true or false, enables the correction
+    do_bg_corr = deployment.do_bg_corr is not None
+    halobg = None
+    if do_bg_corr:
+        bg_files = select_background_files(all_files, start_date, end_date)
+        halobg = read_bg([local_path(Path(raw_files_dir, file))
+                          for file in bg_files])
+        if not halobg:
+            return None
+
+    file_type = return_file_type(deployment, product.value)
+    if not file_type:
+        logging.error(
+            f"sn {instrument_serial} on {date} has no {product.value} "
+            f"product. Skip."
+        )
+        return None
+    files = select_scan_files(
+        all_files, file_type, instrument_serial, start_date, end_date,
+        keeps_npulses_per_ray(retrieval))
+    files = [Path(raw_files_dir, file) for file in files]
+    if not files:
+        return None
+    try:
+        if not halobg and do_bg_corr:
+            logging.warn(
+                f"Wanted to do bg corr on {str(date)} but no bg files "
+                f"found for sn {instrument_serial}"
+            )
+        halo = read_halo(files, product, local_path, parse_cache, parser,
+                         keeps_npulses_per_ray(retrieval))
+    except Exception as e:
+        logging.error(
+            f"Could not read from files: {files} with error {e}")
+        return None
+    if not halo:
+        logging.error(f"Could not read from files: {files}.")
+        return None
+    if do_bg_corr:
+        try:
+            halo.correct_background(halobg)
+        except BackgroundCorrectionError as e:
+            logging.error(
+                f"{e} for instrument {instrument_serial} on {date}")
+            return None
+
+    azimuth_offset = deployment.options.get("azimuth_offset")
+    if azimuth_offset is not None:
+        az_offset = azimuth_offset
+        halo.azimuth.data = add_degrees(
+            halo.azimuth.data, az_offset)
+    if product.value != "wind":
+        return None
+    if not halo.is_useful_for_product(product):
+        logging.error("Wind product not useful for wind calc")
+        return None
+    if retrieval == "vad":
+        import vadwind
+        xr_dat = vadwind.halo_wind(
+            halo, min_valid_intensity=min_valid_intensity_threshold_wind,
+            elevation_expected_value=EXPECTED_SCAN_ELEVATION)
+        if xr_dat is None:
+            logging.error(
+                f"No scans at {EXPECTED_SCAN_ELEVATION} degrees elevation "
+                f"for sn {instrument_serial} on {date}")
+            return None
+    else:
+        wind = halo.compute_wind(
+            halobg=halobg if do_bg_corr else None,
+            min_valid_intensity=min_valid_intensity_threshold_wind,
+            elevation_expected_value=EXPECTED_SCAN_ELEVATION)
+        xr_dat = to_xarray(wind)
+    xr_dat = xr_dat.sel(time=slice(start_date, end_date))
+    prod_date = dt.datetime.now(dt.timezone.utc).isoformat()
+    attrs = {
+        "production_program": PROGRAM_NAME,
+        "production_version": __version__,
+        "production_date": prod_date,
+        "production_comment": program_summary(),
+        "production_author": author,
+        "production_url": "https://github.com/actris-cloudnet/halo-reader/tree/winds, https://github.com/willmorrison1/halo-reader, https://github.com/willmorrison1/paris-harmonised-dwl/",
+    }
+    xr_dat.attrs = attrs
+
+    return xr_dat
+
+
+def write_l1(xr_dat, instrument_serial, date, product=None):
+    product = wind_product(product)
+    filename_template = "halo-reader_{product_name}_" + \
+        f"{date.strftime('%Y%m%d')}_{instrument_serial}_{__version__}"
+
+    file_name = os.path.join(
+        BASE_DIR, f"{instrument_serial}/{filename_template}.nc")
+    if not os.path.exists(os.path.dirname(file_name)):
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    file_name_out = file_name.format(product_name=product.name)
+    xr_dat.to_netcdf(file_name_out,
+                     encoding=build_compression_dict(xr_dat))
+    logging.info(f"Wrote {file_name_out} {dict(xr_dat.dims)}")
+
+    return file_name_out
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Process start and end dates.")
+    parser.add_argument("-s", "--startdate",
+                        help="Start date in format YYYY-MM-DD",
+                        type=valid_date,
+                        default='2023-02-17')
+    parser.add_argument("-e", "--enddate",
+                        help="End date in format YYYY-MM-DD",
+                        type=valid_date,
+                        default='2023-02-17')
+    parser.add_argument("--staging-dir",
+                        help="Local directory to stage the RAW files in "
+                        "before reading them")
+    parser.add_argument("--staging-size", type=memtrack.parse_size,
+                        default="50G",
+                        help="Size limit of the staging directory, e.g. 50G")
+    parser.add_argument("--prefetch", type=int, default=1,
+                        help="Days to stage ahead of the day processed")
+    parser.add_argument("--parse-cache",
+                        help="Directory of the cache of parsed scan files, "
+                        "kept between runs")
+    parser.add_argument("--read-ahead", type=int, default=1,
+                        help="Days to read ahead of the day processed, 0 to "
+                        "read in sequence")
+    parser.add_argument("--writers", type=int, default=1,
+                        help="Threads writing L1 files behind the reads, 0 "
+                        "to write in sequence")
+    parser.add_argument("--retrieval", choices=RETRIEVALS,
+                        default="haloreader",
+                        help="Wind retrieval: haloreader's compute_wind scan "
+                        "by scan, or vad (vadwind) for all scans of a day "
+                        "at once, see vadwind.py")
+    parser.add_argument("--parser", choices=PARSERS, default="haloreader",
+                        help="RAW .hpl parser: haloreader's read, or hpl "
+                        "(hplparse) to parse the files in bulk")
+
+    args = parser.parse_args()
+
+    start_date = args.startdate
+    end_date = args.enddate
+
+    logging.basicConfig(
+        filename=f"{log_dir}/{PROGRAM_NAME}_{start_date}-{end_date}_{dt.datetime.utcnow().strftime('%Y%m%d%H%M%S')}.log",
+        filemode='a',
+        format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
+        datefmt='%H:%M:%S',
+        level=logging.INFO)
+
+    logging.info(f'STARTEND{start_date} {end_date}')
+    logging.info(f'Command line arguments {args}')
+    logging.info(f"{PROGRAM_NAME} program version {__version__}")
+
+    calendar = harmonise.DeploymentCalendar.from_json()
+
+    parse_cache = None
+    if args.parse_cache:
+        parse_cache = open_parse_cache(args.parse_cache, args.parser)
+    cache = None
+    if args.staging_dir:
+        cache = staging.StagingCache(
+            args.staging_dir, args.staging_size, archive_dir=ARCHIVE_DIR)
+
+    import pandas as pd
+
+    # hard-coded as daily files for now
+    dates = pd.date_range(start=start_date, end=end_date, freq="D")
+    units = []
+    for date in dates:
+        start_date = date.to_pydatetime()
+        # one deployment per serial, concurrent deployments would otherwise
+        # overwrite each other's L1 file for the day
+        for deployment in calendar.resolve(
+                start_date, start_date + dt.timedelta(days=1),
+                key="instrument_serial"):
+            if deployment.instrument_type != "StreamLine":
                 continue
-            if do_bg_corr:
-                try:
-                    halo.correct_background(halobg)
-                except BackgroundCorrectionError as e:
-                    logging.error(
-                        f"{e} for instrument {instrument_serial} on {date}")
-                    continue
+            units.append((date, deployment))
 
-            filename_template = "halo-reader_{product_name}_" + \
-                f"{date.strftime('%Y%m%d')}_{instrument_serial}_{__version__}"
-
-            file_name = os.path.join(
-                BASE_DIR, f"{instrument_serial}/{filename_template}.nc")
-            if not os.path.exists(os.path.dirname(file_name)):
-                os.makedirs(os.path.dirname(file_name))
-            azimuth_offset = deployment.get("options_azimuth_offset")
-            if not pd.isna(azimuth_offset):
-                az_offset = azimuth_offset
-                halo.azimuth.data = add_degrees(
-                    halo.azimuth.data, az_offset)
-            if product.value == "wind":
-                if not halo.is_useful_for_product(product):
-                    logging.error("Wind product not useful for wind calc")
-                    continue
-                wind = halo.compute_wind(
-                    halobg=halobg if do_bg_corr else None,
-                    min_valid_intensity=min_valid_intensity_threshold_wind,
-                    elevation_expected_value=EXPECTED_SCAN_ELEVATION)
-                xr_dat = to_xarray(wind)
-                xr_dat = xr_dat.sel(time=slice(start_date, end_date))
-                prod_date = dt.datetime.now(dt.timezone.utc).isoformat()
-                attrs = {
-                    "production_program": PROGRAM_NAME,
-                    "production_version": __version__,
-                    "production_date": prod_date,
-                    "production_comment": program_summary,
-                    "production_author": author,
-                    "production_url": "https://github.com/actris-cloudnet/halo-reader/tree/winds, https://github.com/willmorrison1/halo-reader, https://github.com/willmorrison1/paris-harmonised-dwl/",
-                }
-                xr_dat.attrs = attrs
-
-            file_name_out = file_name.format(product_name=product.name)
-            xr_dat.to_netcdf(file_name_out,
-                             encoding=build_compression_dict(xr_dat))
-            logging.info(f"Wrote {file_name_out} {dict(xr_dat.dims)}")
+    def read_unit(unit):
+        date, deployment = unit
+        logging.info(f"{date} {deployment.instrument_serial}")
+        return raw_to_l1(deployment, date, staging=cache,
+                         parse_cache=parse_cache, retrieval=args.retrieval,
+                         parser=args.parser)
+
+    failed = []
+    try:
+        # reading (parsing) the RAW files of the next day overlaps the
+        # compressed write of this day's L1
+        for unit, l1_file in iopipe.pipelined(
+                staging.stage_ahead(
+                    cache, units, lambda unit: raw_files(
+                        unit[1], unit[0], retrieval=args.retrieval),
+                    depth=args.prefetch),
+                read_unit,
+                lambda unit, xr_dat: write_l1(
+                    xr_dat, unit[1].instrument_serial, unit[0]),
+                read_ahead=args.read_ahead, writers=args.writers,
+                describe=lambda unit: (
+                    f"{unit[0]:%Y%m%d} {unit[1].instrument_serial}"),
+                failed=failed):
+            pass
+    finally:
+        if cache is not None:
+            cache.close()
+    if failed:
+        logging.error(f"{len(failed)} of {len(units)} days failed")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+"""
+Write a synthetic campaign in the formats the production scripts read, so
+that each stage can be run and scaled without the real archive:
+
+    RAW/StreamLine/{serial}/VAD_{serial}_%Y%m%d_%H%M%S.hpl   (one per scan)
+    RAW/StreamLine/{serial}/Background_%d%m%y-%H%M%S.txt     (hourly)
+    L1/WCS000243/w400s_1a_LqualairLzamIdbs_v01_%Y%m%d_000000_1440.nc
+    L1/10/wlscerea_1a_windLz1Lb87M10mn-HR_v02_%Y%m%d_000000_1440.nc
+    meta/deployments-DWL.json, meta/stations-DWL.json
+
+All instruments sample one wind field that varies smoothly in time and
+height, so harmonised stations agree to within the instrument noise.
+Point the pipeline at the output with PARIS_DWL_DATA_DIR=<output dir>.
+
+python synthetic_campaign.py -o /tmp/campaign --serials 7 --days 730
+python synthetic_campaign.py -o /tmp/campaign --serials 1 --days 1 --no-w400s --no-wls70
+"""
+import argparse
+import datetime as dt
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+W400S_SERIAL = "WCS000243"
+WLS70_SERIAL = "10"
+W400S_FILE = "w400s_1a_LqualairLzamIdbs_v01_%Y%m%d_%H%M%S_1440.nc"
+WLS70_FILE = "wlscerea_1a_windLz1Lb87M10mn-HR_v02_%Y%m%d_%H%M%S_1440.nc"
+HPL_FILE = "VAD_{serial}_%Y%m%d_%H%M%S.hpl"
+BACKGROUND_FILE = "Background_%d%m%y-%H%M%S.txt"
+
+SCAN_ELEVATION = 75
+STREAMLINE_GATE_LENGTH = 30.
+W400S_GATE_LENGTH = 25
+WLS70_GATE_LENGTH = 50
+# seconds between rays of a StreamLine scan
+RAY_DURATION = 3.
+
+HPL_HEADER = (
+    "Filename:\t{filename}\r\n"
+    "System ID:\t{serial}\r\n"
+    "Number of gates:\t{ngates}\r\n"
+    "Range gate length (m):\t{gate_length:.1f}\r\n"
+    "Gate length (pts):\t10\r\n"
+    "Pulses/ray:\t{npulses}\r\n"
+    "No. of rays in file:\t{nrays}\r\n"
+    "Scan type:\tVAD\r\n"
+    "Focus range:\t65535\r\n"
+    "Start time:\t{start_time}\r\n"
+    "Resolution (m/s):\t0.0382\r\n"
+    "Altitude of measurement (center of gate) = (range gate + 0.5) * Gate "
+    "length\r\n"
+    "Data line 1: Decimal time (hours)  Azimuth (degrees)  Elevation "
+    "(degrees) Pitch (degrees) Roll (degrees)\r\n"
+    "f9.6,1x,f6.2,1x,f6.2\r\n"
+    "Data line 2: Range Gate  Doppler (m/s)  Intensity (SNR + 1)  Beta "
+    "(m-1 sr-1)\r\n"
+    "i3,1x,f6.4,1x,f8.6,1x,e12.6 - repeat for no. gates\r\n"
+    "****\r\n"
+)
+HPL_RAY = "%10.6f %6.2f %6.2f %5.2f %5.2f\r\n"
+HPL_GATE = "%3d %7.4f %8.6f %12.6E\r\n"
+
+
+def wind_field(day, seconds, heights, seed):
+    """
+    u, v, w (time, height) and the height of the top of the valid signal
+    (time) of the campaign wind field. Deterministic for (day, seed), and
+    identical for every instrument.
+    """
+    day_seed = [seed, dt.date.fromisoformat(str(day)[:10]).toordinal()]
+    rng = np.random.default_rng(day_seed)
+    phase = rng.uniform(0, 2 * np.pi, 3)
+    day_fraction = np.asarray(seconds)[:, None] / 86400
+    z = np.maximum(np.asarray(heights)[None, :], 10)
+
+    speed_100m = 5 + 3 * np.sin(2 * np.pi * day_fraction + phase[0])
+    ws = speed_100m * (z / 100) ** 0.2
+    # direction veers with height and turns through the day
+    wd = (rng.uniform(0, 360) + 40 * np.sin(2 * np.pi * day_fraction +
+                                            phase[1]) + 0.02 * z) % 360
+    u = -ws * np.sin(np.deg2rad(wd))
+    v = -ws * np.cos(np.deg2rad(wd))
+    w = 0.3 * np.sin(2 * np.pi * 24 * day_fraction + z / 500)
+    # the boundary layer (and the signal) is deepest in the afternoon
+    signal_top = 1500 + 1000 * np.sin(np.pi * (day_fraction[:, 0] - 0.25))
+
+    return u, v, w, signal_top
+
+
+def _hpl_scan(serial, start, ngates, nrays, seed):
+    rng = np.random.default_rng([seed, int(serial), int(start.timestamp())])
+    start_seconds = (start - start.normalize()).total_seconds()
+    seconds = start_seconds + RAY_DURATION * np.arange(nrays)
+    ranges = (np.arange(ngates) + 0.5) * STREAMLINE_GATE_LENGTH
+    elevation = np.deg2rad(SCAN_ELEVATION)
+    u, v, w, signal_top = wind_field(
+        start, seconds, ranges * np.sin(elevation), seed)
+    azimuth = np.linspace(0, 360, nrays, endpoint=False)
+
+    az = np.deg2rad(azimuth)[:, None]
+    doppler = ((u * np.sin(az) + v * np.cos(az)) * np.cos(elevation) +
+               w * np.sin(elevation))
+    snr = 0.05 * np.exp(-ranges / 600)[None, :] * (
+        ranges[None, :] * np.sin(elevation) < signal_top[:, None])
+    intensity = 1 + snr + rng.normal(0, 0.0015, doppler.shape)
+    doppler += rng.normal(0, 0.2, doppler.shape) / np.sqrt(
+        np.maximum(snr, 0.001) / 0.05)
+    # outside the signal the doppler is noise across the nyquist range
+    doppler = np.where(snr > 0, doppler, rng.uniform(-19, 19, doppler.shape))
+    beta = 1e-6 * snr / 0.05 + 1e-8
+
+    start_time = start.strftime("%Y%m%d %H:%M:%S.") + \
+        f"{start.microsecond // 10000:02d}"
+    text = [HPL_HEADER.format(
+        filename=start.strftime(HPL_FILE.format(serial=serial))[:-4],
+        serial=serial, ngates=ngates, gate_length=STREAMLINE_GATE_LENGTH,
+        npulses=10000, nrays=nrays, start_time=start_time)]
+    gate_block = HPL_GATE * ngates
+    gates = np.arange(ngates)
+    # one C level format per ray instead of one per gate
+    for i in range(nrays):
+        text.append(HPL_RAY % (
+            seconds[i] / 3600, azimuth[i], SCAN_ELEVATION, 0, 0))
+        text.append(gate_block % tuple(np.column_stack(
+            [gates, doppler[i], intensity[i], beta[i]]).ravel().tolist()))
+    return "".join(text)
+
+
+def write_streamline_day(raw_dir, serial, day, ngates, nrays, scan_cadence,
+                         seed):
+    serial_dir = os.path.join(raw_dir, serial)
+    os.makedirs(serial_dir, exist_ok=True)
+    day = pd.Timestamp(day)
+    n_files = 0
+
+    for start in pd.date_range(day, day + pd.Timedelta(days=1),
+                               freq=f"{scan_cadence}s", inclusive="left"):
+        # real scans never start on the second
+        start = start + pd.Timedelta(seconds=2.37)
+        file_name = os.path.join(
+            serial_dir, start.strftime(HPL_FILE.format(serial=serial)))
+        with open(file_name, "w", newline="") as f:
+            f.write(_hpl_scan(serial, start, ngates, nrays, seed))
+        n_files += 1
+
+    rng = np.random.default_rng([seed, int(serial), day.toordinal()])
+    for start in pd.date_range(day, periods=24, freq="1h"):
+        background = 1.5e7 + rng.normal(0, 2e4, ngates)
+        background[0] = 6e5
+        file_name = os.path.join(
+            serial_dir, (start + pd.Timedelta(seconds=13)).strftime(
+                BACKGROUND_FILE))
+        with open(file_name, "w", newline="") as f:
+            f.write("".join(f"{b:.6f}\r\n" for b in background))
+        n_files += 1
+
+    return n_files
+
+
+def write_w400s_day(l1_dir, day, ngates, cadence, seed):
+    out_dir = os.path.join(l1_dir, W400S_SERIAL)
+    os.makedirs(out_dir, exist_ok=True)
+    day = pd.Timestamp(day)
+    rng = np.random.default_rng([seed, 400, day.toordinal()])
+    time = pd.date_range(day, day + pd.Timedelta(days=1),
+                         freq=f"{cadence}s", inclusive="left")
+    seconds = (time - day).total_seconds().values
+    range_ = 100 + W400S_GATE_LENGTH * np.arange(ngates)
+    u, v, _, signal_top = wind_field(
+        day, seconds, range_ * np.sin(np.deg2rad(SCAN_ELEVATION)), seed)
+    u = u + rng.normal(0, 0.3, u.shape)
+    v = v + rng.normal(0, 0.3, v.shape)
+    valid = range_[None, :] * np.sin(np.deg2rad(SCAN_ELEVATION)) < \
+        signal_top[:, None]
+    ws = np.hypot(u, v)
+    wd = np.rad2deg(np.arctan2(-u, -v)) % 360
+    status = (valid & (rng.random(u.shape) > 0.05)).astype("int8")
+
+    dat = xr.Dataset(
+        data_vars={
+            "horizontal_wind_speed": (["time", "gate_index"], np.where(
+                valid, ws, np.nan).astype("float32")),
+            "wind_direction": (["time", "gate_index"], np.where(
+                valid, wd, np.nan).astype("float32")),
+            "wind_speed_status": (["time", "gate_index"], status),
+            "wind_speed_ci": (["time", "gate_index"], np.where(
+                valid, rng.uniform(99, 101, u.shape), 0).astype("float32")),
+            "elevation": (["time"], rng.normal(
+                SCAN_ELEVATION, 0.01, len(time)).astype("float32")),
+            "range": ((), 0, {
+                "meters_to_center_of_first_gate": 100,
+                "meters_between_gates": W400S_GATE_LENGTH,
+            }),
+        },
+        coords={"time": time, "gate_index": np.arange(ngates)},
+    )
+    dat.to_netcdf(os.path.join(out_dir, day.strftime(W400S_FILE)))
+    return 1
+
+
+def write_wls70_day(l1_dir, day, ngates, seed):
+    out_dir = os.path.join(l1_dir, WLS70_SERIAL)
+    os.makedirs(out_dir, exist_ok=True)
+    day = pd.Timestamp(day)
+    rng = np.random.default_rng([seed, 70, day.toordinal()])
+    time = pd.date_range(day, periods=144, freq="10min")
+    seconds = (time - day).total_seconds().values
+    range_ = 100. + WLS70_GATE_LENGTH * np.arange(ngates)
+    scan_angle = 90 - SCAN_ELEVATION
+    u, v, w, signal_top = wind_field(
+        day, seconds, range_ * np.sin(np.deg2rad(SCAN_ELEVATION)), seed)
+    u = u + rng.normal(0, 0.2, u.shape)
+    v = v + rng.normal(0, 0.2, v.shape)
+    valid = range_[None, :] < signal_top[:, None]
+    availability = np.where(valid, rng.uniform(30, 100, u.shape),
+                            rng.uniform(0, 10, u.shape))
+
+    dat = xr.Dataset(
+        data_vars={
+            "u": (["time", "range"], np.where(valid, u, np.nan)),
+            "v": (["time", "range"], np.where(valid, v, np.nan)),
+            "w": (["time", "range"], np.where(valid, w, np.nan)),
+            "ws": (["time", "range"], np.where(valid, np.hypot(u, v), np.nan)),
+            "data_availability": (["time", "range"], availability),
+            "scan_angle": ((), scan_angle),
+        },
+        coords={"time": time, "range": range_},
+    )
+    dat.to_netcdf(os.path.join(out_dir, day.strftime(WLS70_FILE)))
+    return 1
+
+
+def campaign_meta(serials, start, end, w400s=True, wls70=True):
+    """deployments-DWL.json and stations-DWL.json for the campaign."""
+    instruments = [(serial, "StreamLine") for serial in serials]
+    if w400s:
+        instruments.append((W400S_SERIAL, "w400s"))
+    if wls70:
+        instruments.append((WLS70_SERIAL, "WLS70"))
+
+    deployments, stations = [], []
+    for i, (serial, instrument_type) in enumerate(instruments):
+        station_code = f"SYN{i + 1:03d}"
+        altitude = 50 + 10 * i
+        stations.append({"station": {
+            "code": station_code,
+            "lat": round(48.7 + 0.05 * i, 4),
+            "lon": round(2.2 + 0.05 * i, 4),
+            "altitude": altitude,
+            "height": 10,
+        }})
+        deployment = {
+            "instrument": {"serial": serial, "type": instrument_type},
+            "start_datetime": start.isoformat(),
+            "end_datetime": end.isoformat(),
+            "above_sea_level_m": altitude,
+            "station": {"code": station_code},
+        }
+        if instrument_type == "StreamLine":
+            deployment["raw_files"] = [{
+                "datetime_pattern": HPL_FILE.replace(
+                    "{serial}", "{instrument_serial}"),
+                "type": "wind",
+            }]
+            deployment["do_bg_corr"] = True
+        deployments.append(deployment)
+
+    return deployments, stations
+
+
+def _write_unit(unit):
+    kind, args = unit
+    return {
+        "streamline": write_streamline_day,
+        "w400s": write_w400s_day,
+        "wls70": write_wls70_day,
+    }[kind](*args)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Write a synthetic DWL campaign in the RAW/L1 formats "
+        "the production scripts read.")
+    parser.add_argument("-o", "--output-dir", required=True)
+    parser.add_argument("-s", "--startdate", default="2023-01-01",
+                        help="First day, YYYY-MM-DD")
+    parser.add_argument("-d", "--days", type=int, default=1)
+    parser.add_argument("--serials", type=int, default=1,
+                        help="Number of StreamLine instruments")
+    parser.add_argument("--gates", type=int, default=100,
+                        help="Range gates of every instrument")
+    parser.add_argument("--scan-cadence", type=int, default=600,
+                        help="Seconds between StreamLine wind scans")
+    parser.add_argument("--rays", type=int, default=12,
+                        help="Rays per StreamLine scan")
+    parser.add_argument("--w400s-cadence", type=int, default=4,
+                        help="Seconds between w400s profiles")
+    parser.add_argument("--no-w400s", action="store_true")
+    parser.add_argument("--no-wls70", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+
+    start = dt.datetime.fromisoformat(args.startdate)
+    end = start + dt.timedelta(days=args.days)
+    days = pd.date_range(start, end, freq="D", inclusive="left")
+    serials = [str(901 + i) for i in range(args.serials)]
+    raw_dir = os.path.join(args.output_dir, "RAW", "StreamLine")
+    l1_dir = os.path.join(args.output_dir, "L1")
+    meta_dir = os.path.join(args.output_dir, "meta")
+    os.makedirs(meta_dir, exist_ok=True)
+
+    deployments, stations = campaign_meta(
+        serials, start, end, not args.no_w400s, not args.no_wls70)
+    with open(os.path.join(meta_dir, "deployments-DWL.json"), "w") as f:
+        json.dump(deployments, f, indent=4)
+    with open(os.path.join(meta_dir, "stations-DWL.json"), "w") as f:
+        json.dump(stations, f, indent=4)
+
+    units = []
+    for day in days:
+        units.extend(("streamline", (raw_dir, serial, day, args.gates,
+                                     args.rays, args.scan_cadence, args.seed))
+                     for serial in serials)
+        if not args.no_w400s:
+            units.append(("w400s", (l1_dir, day, args.gates,
+                                    args.w400s_cadence, args.seed)))
+        if not args.no_wls70:
+            units.append(("wls70", (l1_dir, day, args.gates, args.seed)))
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        n_files = sum(executor.map(_write_unit, units))
+
+    print(f"Wrote {n_files} files for {len(days)} days and "
+          f"{len(deployments)} deployments to {args.output_dir}")
+    print(f"Run the pipeline on it with PARIS_DWL_DATA_DIR={args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+climatology.Climatology of L3 blocks added by several workers and merged
+against the one that added them all in sequence.
+
+python -m pytest tests/test_climatology.py
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import climatology  # noqa: E402
+import harmonise  # noqa: E402
+
+TIME_AGG = 3600
+ACC_KEYS = ["n", "ws_hist", "rose"]
+
+
+def l3_block(stations, times, altitude, seed=0):
+    """Random L3 (u, v, ws, wd and a flag) with missing and flagged values."""
+    rng = np.random.default_rng(seed)
+    shape = (len(stations), len(times), len(altitude))
+    u = rng.normal(0, 5, shape)
+    v = rng.normal(0, 5, shape)
+    u[rng.random(shape) < 0.1] = np.nan
+    ws, wd = harmonise.vector_to_ws_wd(u, v)
+    dims = ["station", "time", "altitude"]
+    return xr.Dataset({
+        "u": (dims, u), "v": (dims, v), "ws": (dims, ws), "wd": (dims, wd),
+        "flag_ws": (dims, rng.choice([0, 50, 100], shape)),
+    }, coords={"station": stations, "time": times, "altitude": altitude})
+
+
+@pytest.fixture
+def l3():
+    # two months, so the blocks fill several months and hours
+    times = pd.date_range("2023-01-30", "2023-02-03", freq="1h",
+                          inclusive="left")
+    return l3_block(["PAROIS", "PAJUSS", "PASIRT"], times,
+                    np.arange(100, 1100, 100.))
+
+
+def sequential(blocks):
+    clim = climatology.Climatology(TIME_AGG, max_flag_pc=50)
+    for block in blocks:
+        clim.add_block(block)
+    return clim
+
+
+def assert_same(merged, clim):
+    assert sorted(merged.stations) == sorted(clim.stations)
+    assert merged.time_range == clim.time_range
+    for station_code, acc in clim.stations.items():
+        for key in ACC_KEYS:
+            np.testing.assert_array_equal(
+                merged.stations[station_code][key], acc[key])
+        # the sums only differ by the order of the additions
+        for var in climatology.MEAN_VARS:
+            np.testing.assert_allclose(
+                merged.stations[station_code]["sum"][var], acc["sum"][var],
+                rtol=1e-12)
+    xr.testing.assert_allclose(merged.summary(), clim.summary())
+
+
+def test_merge_time_split(l3):
+    blocks = [l3.isel(time=piece) for piece in
+              np.array_split(np.arange(l3.sizes["time"]), 4)]
+    workers = [sequential([block]) for block in blocks]
+    merged = climatology.Climatology(TIME_AGG, max_flag_pc=50)
+    for worker in workers:
+        merged.merge(worker)
+    assert_same(merged, sequential([l3]))
+    assert_same(merged, sequential(blocks))
+
+
+def test_merge_station_split(l3):
+    # a worker that saw no L3 adds nothing
+    workers = [sequential([l3.isel(station=[0, 2])]),
+               climatology.Climatology(TIME_AGG, max_flag_pc=50),
+               sequential([l3.isel(station=[1])])]
+    merged = workers[0]
+    for worker in workers[1:]:
+        merged.merge(worker)
+    assert_same(merged, sequential([l3]))
+
+
+def test_merge_refuses_same_file_and_other_altitude(l3):
+    clim = sequential([l3])
+    other = sequential([l3])
+    clim.files["a.nc"] = other.files["a.nc"] = {"mtime": 0, "size": 0}
+    with pytest.raises(ValueError, match="added to both"):
+        clim.merge(other)
+    other = sequential([l3.isel(altitude=slice(1, None))])
+    with pytest.raises(ValueError, match="altitude"):
+        clim.merge(other)
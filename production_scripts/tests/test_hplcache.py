@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+ParseCache keyed on the pathlib.Path archive paths streamLine_RAW_to_L1
+passes (raw_files), as well as str paths.
+
+python -m pytest tests/test_hplcache.py
+"""
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import hplcache  # noqa: E402
+
+
+def _scan_file(directory):
+    path = Path(directory, "VAD_901_20230101_000002.hpl")
+    path.write_bytes(b"Filename:\tVAD_901_20230101_000002\r\n****\r\n")
+    return path
+
+
+def test_get_with_path(tmp_path):
+    path = _scan_file(tmp_path)
+    cache = hplcache.ParseCache(tmp_path / "cache", "1.0")
+    parsed = []
+
+    def parse(file):
+        parsed.append(file)
+        return {"size": os.path.getsize(file)}
+
+    assert cache.get(path, parse, tag="wind") == {"size": path.stat().st_size}
+    assert cache.get(path, parse, tag="wind") == {"size": path.stat().st_size}
+    assert cache.has(path, "wind")
+    assert (cache.misses, cache.hits) == (1, 1)
+    assert parsed == [path]
+    # str and Path paths share the entry
+    assert cache.get(str(path), parse, tag="wind") is not None
+    assert cache.hits == 2
+
+
+def test_changed_file_is_parsed_again(tmp_path):
+    path = _scan_file(tmp_path)
+    cache = hplcache.ParseCache(tmp_path / "cache", "1.0")
+    cache.get(path, lambda file: 1)
+    path.write_bytes(path.read_bytes() + b"  0.5 0.0 75.0\r\n")
+    assert cache.get(path, lambda file: 2) == 2
+    assert cache.misses == 2
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Importing a production module does no I/O, as every spawned worker process
+pays the import. Each module is imported in a fresh interpreter with an
+audit hook (sys.addaudithook) that records the file opens, directory
+listings and changes, file system writes, subprocesses and sockets made by
+the module code of the production scripts (the import machinery and third
+party imports are not counted). A module that fails to import on a third
+party package that is missing or of another version here (e.g. haloreader
+without Product) is skipped.
+
+The modules imported by the workers of L2_to_L3.py and by pipeline.py also
+leave their heavy dependencies to the functions that use them.
+
+python -m pytest tests/test_imports.py
+"""
+import glob
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# run in the child interpreter, before and around the import
+CHILD = r"""
+import sys, os, json, time
+events = []
+WATCHED = {"open", "os.listdir", "os.scandir", "os.chdir", "os.mkdir",
+           "os.remove", "os.rename", "os.rmdir", "shutil.copyfile",
+           "shutil.rmtree", "subprocess.Popen", "os.system",
+           "socket.connect", "socket.bind", "glob.glob", "os.putenv",
+           "os.unsetenv"}
+IMPORTING = [False]
+
+def caused_by_scripts():
+    # walk out from the call that raised the event. module code of the
+    # production scripts (directly or through a library call) comes before
+    # any import machinery, the imports of third party packages do not
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith("<frozen importlib"):
+            return False
+        if not filename.startswith("<") and os.path.dirname(os.path.abspath(filename)) == SCRIPTS_DIR:
+            return True
+        frame = frame.f_back
+    return False
+
+def hook(event, args):
+    if not IMPORTING[0] or event not in WATCHED:
+        return
+    if caused_by_scripts():
+        events.append([event] + [str(a) for a in args[:2]])
+
+module, SCRIPTS_DIR = json.loads(sys.argv[1])
+sys.path.insert(0, SCRIPTS_DIR)
+os.chdir(SCRIPTS_DIR)
+cwd = os.getcwd()
+sys.addaudithook(hook)
+IMPORTING[0] = True
+t0 = time.perf_counter()
+error = None
+missing = None
+try:
+    __import__(module)
+except ImportError as e:
+    error = repr(e)
+    missing = e.name
+except Exception as e:
+    error = repr(e)
+seconds = time.perf_counter() - t0
+IMPORTING[0] = False
+if os.getcwd() != cwd:
+    events.append(["cwd changed", os.getcwd()])
+print(json.dumps({"seconds": seconds, "events": events, "error": error,
+                  "missing": missing,
+                  "imported": sorted({name.split(".")[0]
+                                      for name in sys.modules})}))
+"""
+
+# packages that are slow to import, left to the functions that use them
+HEAVY = ["dask", "haloreader", "pandas", "quicklook", "xarray"]
+LIGHT_MODULES = ["L2_to_L3", "streamLine_RAW_to_L1"]
+
+
+def production_modules():
+    return sorted(
+        os.path.splitext(os.path.basename(f))[0]
+        for f in glob.glob(os.path.join(SCRIPTS_DIR, "*.py")))
+
+
+def check_import(module):
+    result = subprocess.run(
+        [sys.executable, "-c", CHILD,
+         json.dumps([module, SCRIPTS_DIR])],
+        capture_output=True, text=True, cwd=SCRIPTS_DIR)
+    if result.returncode:
+        return {"seconds": None, "events": [],
+                "error": result.stderr.strip().splitlines()[-1],
+                "missing": None, "imported": []}
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def is_dependency(name):
+    """Whether the module name is not one of the production scripts."""
+    if name is None:
+        return False
+    top = name.split(".")[0]
+    return not (os.path.exists(os.path.join(SCRIPTS_DIR, f"{top}.py")) or
+                os.path.isdir(os.path.join(SCRIPTS_DIR, top)))
+
+
+@pytest.mark.parametrize("module", production_modules())
+def test_no_io_at_import(module):
+    result = check_import(module)
+    if result["error"] is not None and is_dependency(result["missing"]):
+        pytest.skip(f"dependency not available here: {result['error']}")
+    assert result["error"] is None
+    assert result["events"] == []
+
+
+@pytest.mark.parametrize("module", LIGHT_MODULES)
+def test_heavy_imports_deferred(module):
+    result = check_import(module)
+    assert result["error"] is None
+    assert [name for name in HEAVY if name in result["imported"]] == []
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+Units that fail in any stage of iopipe.pipelined are logged, skipped and
+reported in failed (for the exit status of the L1 to L2 scripts).
+
+python -m pytest tests/test_iopipe.py
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import iopipe  # noqa: E402
+
+
+def read(unit):
+    if unit == 1:
+        raise OSError("unreadable")
+    return unit
+
+
+def compute(unit, data):
+    if unit == 2:
+        raise ValueError("bad data")
+    # a skipped unit, not a failure
+    if unit == 4:
+        return None
+    return data * 10
+
+
+def write(unit, result):
+    if unit == 3:
+        raise OSError("disk full")
+    return f"{result}.nc"
+
+
+@pytest.mark.parametrize("read_ahead, writers", [(0, 0), (1, 1), (2, 2)])
+def test_failed_units(read_ahead, writers):
+    failed = []
+    written = list(iopipe.pipelined(
+        range(6), read, write, compute, read_ahead=read_ahead,
+        writers=writers, failed=failed))
+    assert written == [(0, "0.nc"), (1, None), (2, None), (3, None),
+                       (4, None), (5, "50.nc")]
+    assert sorted(failed) == [1, 2, 3]
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+L3 of one station computed only up to its valid top and put back on the
+full altitude grid (L2_to_L3.harmonise_station_time).
+
+python -m pytest tests/test_l2_to_l3.py
+"""
+import os
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import harmonise  # noqa: E402
+import L2_to_L3  # noqa: E402
+
+FLAGS = ["flag_suspect_retrieval_warn", "flag_suspect_retrieval_removed"]
+
+
+def station_l2(top=None):
+    """Altitude harmonised L2 of one station, data up to top (or none)."""
+    time = pd.date_range("2023-01-01", periods=12, freq="300s")
+    altitude = harmonise.z_levels(
+        harmonise.MIN_ALTITUDE, harmonise.MAX_ALTITUDE,
+        harmonise.RES_ALTITUDE)
+    has_data = np.zeros(altitude.shape, bool) if top is None else \
+        altitude <= top
+    wind = np.where(has_data, 5., np.nan) * np.ones((time.size, 1))
+    dat = xr.Dataset(
+        {"u": (("time", "altitude"), wind),
+         "v": (("time", "altitude"), -wind)},
+        coords={"time": time, "altitude": altitude})
+    for flag in FLAGS:
+        dat[flag] = (("time", "altitude"),
+                     np.where(np.isnan(wind), np.nan, 0.))
+    if top is not None:
+        dat[FLAGS[0]][0, 1] = 1
+
+    return dat
+
+
+def harmonise_station_time(dat):
+    d = SimpleNamespace(instrument_serial="30", station_code="TEST")
+    return L2_to_L3.harmonise_station_time(dat, d, 600)
+
+
+def test_flags_zero_above_top():
+    dat = harmonise_station_time(station_l2(top=500))
+    above = dat.altitude > 500
+    assert dat.sizes["altitude"] == above.size
+    assert dat.u.sel(altitude=above).isnull().all()
+    assert dat.u.sel(altitude=~above).notnull().all()
+    for flag in FLAGS:
+        assert dat[flag].dtype == np.float64
+        assert (dat[flag].sel(altitude=above) == 0).all()
+    assert dat[FLAGS[0]].isel(station=0, time=0, altitude=1).item() == 50
+
+
+def test_station_without_data():
+    dat = harmonise_station_time(station_l2())
+    assert dat.sizes["altitude"] == harmonise.z_levels(
+        harmonise.MIN_ALTITUDE, harmonise.MAX_ALTITUDE,
+        harmonise.RES_ALTITUDE).size
+    assert dat.u.isnull().all() and dat.ws.isnull().all()
+    for flag in FLAGS:
+        assert dat[flag].dtype == np.float64
+        assert (dat[flag] == 0).all()
+
+
+def test_dependencies_of_l2_data(tmp_path, monkeypatch):
+    # the L2 of l2_data (e.g. made in memory by pipeline.py) is recorded by
+    # its own dependencies, not by the L2 files on disk
+    monkeypatch.setattr(L2_to_L3, "input_dir", str(tmp_path))
+    start, end = "2022-12-07 00:00:00", "2022-12-08 00:00:00"
+    deployments = [
+        L2_to_L3.get_station_deployment(station_code, start, end)
+        for station_code in L2_to_L3.deployment_calendar().station_codes]
+    stale, missing = [d for d in deployments if d is not None][:2]
+    l2_dir = tmp_path / stale.instrument_serial
+    l2_dir.mkdir()
+    (l2_dir / (f"L2_{L2_to_L3.l2_versions[stale.instrument_type]}_20221207_"
+               f"{stale.instrument_serial}.nc")).write_bytes(b"stale")
+
+    dependencies = L2_to_L3.l3_dependencies(start, end, 600)
+    assert len(dependencies["inputs"][stale.station_code]["files"]) == 1
+    assert missing.station_code not in dependencies["inputs"]
+
+    l2_data_dependencies = {
+        d.instrument_serial: {"raw_files": [{"path": d.instrument_serial}]}
+        for d in [stale, missing]}
+    dependencies = L2_to_L3.l3_dependencies(
+        start, end, 600, l2_data_dependencies=l2_data_dependencies)
+    for d in [stale, missing]:
+        inputs = dependencies["inputs"][d.station_code]
+        assert "files" not in inputs
+        assert inputs["l2_data"] == l2_data_dependencies[d.instrument_serial]
+        assert inputs["instrument_serial"] == d.instrument_serial
+
+
+def write_l2_day(l2_dir, day, serial):
+    # 10 minute profiles labelled at their end, the last one at midnight
+    time = pd.date_range(pd.Timestamp(day) + pd.Timedelta("600s"),
+                         periods=144, freq="600s")
+    dat = xr.Dataset(
+        {"u": (("time", "height"), np.ones((time.size, 3)))},
+        coords={"time": time, "height": [100., 200., 300.]},
+        attrs={"production_version": L2_to_L3.l2_versions["StreamLine"]})
+    dat.to_netcdf(l2_dir / (f"L2_{L2_to_L3.l2_versions['StreamLine']}_"
+                            f"{pd.Timestamp(day):%Y%m%d}_{serial}.nc"))
+
+
+def test_l2_slices_reused_across_days(tmp_path, monkeypatch):
+    d = SimpleNamespace(instrument_serial="30", station_code="TEST",
+                        instrument_type="StreamLine")
+    l2_dir = tmp_path / d.instrument_serial
+    l2_dir.mkdir()
+    for day in ["2023-01-01", "2023-01-02"]:
+        write_l2_day(l2_dir, day, d.instrument_serial)
+    monkeypatch.setattr(L2_to_L3, "input_dir", str(tmp_path))
+    monkeypatch.setattr(L2_to_L3, "l2_slice_cache", L2_to_L3.L2SliceCache())
+    reads = []
+    read_l2_block = L2_to_L3._read_l2_block
+    monkeypatch.setattr(L2_to_L3, "_read_l2_block", lambda *args: (
+        reads.append(args[1:]), read_l2_block(*args))[1])
+
+    days = ["2023-01-01 00:00:00", "2023-01-02 00:00:00",
+            "2023-01-03 00:00:00"]
+    for start, end in zip(days[:-1], days[1:]):
+        for time_agg in L2_to_L3.time_aggs:
+            dat = L2_to_L3.read_l2(d, start, end, time_agg)
+            assert dat.indexes["time"].is_monotonic_increasing
+            assert dat.time.values[-1] == np.datetime64(end)
+    assert dat.time.values[0] == np.datetime64(start)
+    assert dat.sizes["time"] == 145
+    # each file is read once: the midnight profile of the first file that
+    # the second day needs is served from the slice of the first day
+    assert reads == [(0, 144), (0, 144)]
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+l3query.ChunkCache serves repeated reads of a chunk from memory, evicts the
+least recently used chunks beyond max_bytes, and read_subset assembles a
+region from the cached chunks.
+
+python -m pytest tests/test_l3query.py
+"""
+import os
+import sys
+
+import numpy as np
+import xarray as xr
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import l3query  # noqa: E402
+
+
+def loader(value, n_bytes=80):
+    calls = []
+
+    def load():
+        calls.append(value)
+        return np.full(n_bytes // 8, value, dtype=np.float64)
+    return load, calls
+
+
+def test_hits():
+    cache = l3query.ChunkCache(max_bytes=1000)
+    load, calls = loader(1)
+    first = cache.get("a", load)
+    assert cache.get("a", load) is first
+    assert len(calls) == 1
+    assert (cache.hits, cache.misses, cache.n_bytes) == (1, 1, 80)
+
+
+def test_byte_limit():
+    cache = l3query.ChunkCache(max_bytes=200)
+    loads = {key: loader(i) for i, key in enumerate("abc")}
+    cache.get("a", loads["a"][0])
+    cache.get("b", loads["b"][0])
+    # a is used again, so b is evicted for c
+    cache.get("a", loads["a"][0])
+    cache.get("c", loads["c"][0])
+    assert cache.n_bytes == 160
+    cache.get("a", loads["a"][0])
+    cache.get("b", loads["b"][0])
+    assert [len(loads[key][1]) for key in "abc"] == [1, 2, 1]
+    assert cache.n_bytes <= cache.max_bytes
+
+
+def test_larger_than_limit_not_cached():
+    cache = l3query.ChunkCache(max_bytes=100)
+    load, calls = loader(1, n_bytes=160)
+    assert cache.get("a", load).nbytes == 160
+    cache.get("a", load)
+    assert len(calls) == 2 and cache.n_bytes == 0
+
+
+def test_read_subset_from_chunks():
+    values = np.arange(7 * 10, dtype=np.float64).reshape(7, 10)
+    dat = xr.Dataset({"u": (("time", "altitude"), values)})
+    var_entry = {"shape": [7, 10], "chunks": [3, 4]}
+    region = [slice(2, 6), slice(3, 9)]
+    cache = l3query.ChunkCache()
+    out = l3query.read_subset(dat, "u", var_entry, region, cache, "f")
+    np.testing.assert_array_equal(out, values[2:6, 3:9])
+    # chunk rows 0-1 and columns 0-2
+    assert (cache.hits, cache.misses) == (0, 6)
+    # an overlapping region only reads the chunks not yet cached
+    out = l3query.read_subset(dat, "u", var_entry, [slice(5, 7), slice(0, 4)],
+                              cache, "f")
+    np.testing.assert_array_equal(out, values[5:7, 0:4])
+    assert (cache.hits, cache.misses) == (1, 7)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+L3 rows of l3stream.OnlineL3, fed a day of L2 in pieces and across runs
+(through the state file), against the rows L2_to_L3.py computes from the
+whole day.
+
+python -m pytest tests/test_l3stream.py
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+import xarray as xr
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+sys.path.insert(0, os.path.join(os.path.dirname(TESTS_DIR), "benchmarks"))
+
+import L2_to_L3  # noqa: E402
+import l3stream  # noqa: E402
+import reference_data  # noqa: E402
+import streamLine_L1_to_L2  # noqa: E402
+
+START, END = "2022-12-07 00:00:00", "2022-12-08 00:00:00"
+TIME_AGG = 600
+DIMS = ["station", "time", "altitude"]
+
+
+@pytest.fixture(scope="module")
+def deployment():
+    return L2_to_L3.get_station_deployment("PAROIS", START, END)
+
+
+@pytest.fixture(scope="module")
+def l2():
+    return streamLine_L1_to_L2.streamline_l1_to_l2(
+        reference_data.streamline_l1("small"))
+
+
+def batch_rows(dat, d):
+    return L2_to_L3.assemble_l3(
+        [L2_to_L3.harmonise_station(dat, d, TIME_AGG)], TIME_AGG)
+
+
+def stream_rows(dat, d, state_file, pieces=7):
+    """Rows of dat added in pieces, a new OnlineL3 (run) for every piece."""
+    rows = []
+    for piece in np.array_split(np.arange(dat.sizes["time"]), pieces):
+        engine = l3stream.OnlineL3(TIME_AGG, state_file=state_file)
+        engine.add(d, dat.isel(time=piece))
+        closed = engine.close()
+        if closed is not None:
+            rows.append(closed)
+        engine.save()
+    rows.append(engine.close(until=END))
+    return xr.concat(rows, dim="time", data_vars="minimal")
+
+
+def test_rows_across_runs(l2, deployment, tmp_path):
+    stream = stream_rows(l2, deployment, str(tmp_path / "state.pkl"))
+    batch = batch_rows(l2, deployment)
+    assert set(stream.variables) == set(batch.variables)
+    xr.testing.assert_allclose(stream.transpose(*DIMS), batch,
+                               rtol=0, atol=0)
+
+
+def test_rows_float32_l2(l2, deployment, tmp_path):
+    # the L2 files store u and v as float32, OnlineL3 sums them as float64
+    l2 = l2.assign(u=l2.u.astype(np.float32), v=l2.v.astype(np.float32))
+    stream = stream_rows(l2, deployment, str(tmp_path / "state.pkl"))
+    batch = batch_rows(l2, deployment)
+    assert float(abs(stream.u - batch.u).max()) > 0
+    # float32 has about 7 significant digits
+    xr.testing.assert_allclose(stream.transpose(*DIMS), batch,
+                               rtol=1e-6, atol=1e-6)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+staging.StagingCache evicts the least recently used unpinned copies to stay
+within max_bytes, and copies a file again once its size or mtime in the
+archive changed.
+
+python -m pytest tests/test_staging.py
+"""
+import itertools
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import staging  # noqa: E402
+
+
+@pytest.fixture
+def archive(tmp_path, monkeypatch):
+    # a clock that always moves on, so the LRU order is the order of use
+    clock = itertools.count()
+    monkeypatch.setattr(staging.time, "time", lambda: float(next(clock)))
+    archive_dir = tmp_path / "archive"
+    archive_dir.mkdir()
+    for name in "abc":
+        (archive_dir / f"{name}.hpl").write_bytes(name.encode() * 100)
+    return archive_dir
+
+
+def open_cache(archive, tmp_path, max_bytes=250):
+    return staging.StagingCache(str(tmp_path / "cache"), max_bytes,
+                                archive_dir=str(archive))
+
+
+def test_lru_eviction(archive, tmp_path):
+    cache = open_cache(archive, tmp_path)
+    a, b, c = [str(archive / f"{name}.hpl") for name in "abc"]
+    local_a = cache.stage(a)
+    local_b = cache.stage(b)
+    # a is used again, so b is the least recently used
+    assert cache.stage(a) == local_a
+    local_c = cache.stage(c)
+    assert os.path.exists(local_a) and os.path.exists(local_c)
+    assert not os.path.exists(local_b)
+    assert cache.size() == 200
+    assert (cache.hits, cache.misses) == (1, 3)
+
+
+def test_pinned_not_evicted(archive, tmp_path):
+    cache = open_cache(archive, tmp_path)
+    a, b, c = [str(archive / f"{name}.hpl") for name in "abc"]
+    with cache.staged([a]) as (local_a,):
+        cache.stage(b)
+        cache.stage(c)
+        assert os.path.exists(local_a)
+    assert cache.size() == 200
+
+
+def test_changed_files_copied_again(archive, tmp_path):
+    cache = open_cache(archive, tmp_path)
+    a = archive / "a.hpl"
+    local_a = cache.stage(str(a))
+    # same size, newer mtime
+    a.write_bytes(b"A" * 100)
+    stat = os.stat(a)
+    os.utime(a, (stat.st_atime, stat.st_mtime + 10))
+    assert cache.stage(str(a)) == local_a
+    with open(local_a, "rb") as f:
+        assert f.read() == b"A" * 100
+    # other size, same mtime
+    a.write_bytes(b"A" * 50)
+    os.utime(a, (stat.st_atime, stat.st_mtime + 10))
+    cache.stage(str(a))
+    assert os.path.getsize(local_a) == 50
+    assert (cache.hits, cache.misses) == (0, 3)
+    assert cache.stage(str(a)) == local_a
+    assert cache.hits == 1
+
+
+def test_index_kept_between_runs(archive, tmp_path):
+    cache = open_cache(archive, tmp_path)
+    local_a = cache.stage(str(archive / "a.hpl"))
+    cache.close()
+    cache = open_cache(archive, tmp_path)
+    assert cache.stage(str(archive / "a.hpl")) == local_a
+    assert (cache.hits, cache.misses) == (1, 0)
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+vadwind.halo_wind of synthetic .hpl scans against the stored reference
+tests/data/vad_reference.nc (benchmarks/check_vadwind.py --write-reference,
+the reference_source attribute says what it was computed with).
+
+python -m pytest tests/test_vadwind.py
+"""
+import os
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import xarray as xr
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+sys.path.insert(0, os.path.join(os.path.dirname(TESTS_DIR), "benchmarks"))
+
+import check_vadwind  # noqa: E402
+import vadwind  # noqa: E402
+
+REFERENCE_FILE = os.path.join(TESTS_DIR, "data", "vad_reference.nc")
+
+
+@pytest.fixture(scope="module")
+def reference():
+    with xr.open_dataset(REFERENCE_FILE) as dat:
+        return dat.load()
+
+
+@pytest.fixture(scope="module")
+def wind(reference, tmp_path_factory):
+    args = SimpleNamespace(**{name: int(reference.attrs[name]) for name in
+                              ["scans", "gates", "rays", "cadence"]})
+    halo = check_vadwind.read_scans(
+        args.scans, args.gates, args.rays, args.cadence,
+        str(tmp_path_factory.mktemp("hpl")))
+    return vadwind.halo_wind(halo, check_vadwind.MIN_VALID_INTENSITY,
+                             check_vadwind.EXPECTED_SCAN_ELEVATION)
+
+
+def test_scan_times(wind, reference):
+    np.testing.assert_array_equal(wind.time.values, reference.time.values)
+    np.testing.assert_array_equal(wind.range.values, reference.range.values)
+
+
+@pytest.mark.parametrize("name", check_vadwind.FIELDS)
+def test_fields(wind, reference, name):
+    np.testing.assert_allclose(wind[name].values, reference[name].values,
+                               rtol=0, atol=1e-8)
+
+
+def test_mean_intensity_of_valid_gates(wind):
+    # the fit only uses ray-gates above min_valid_intensity
+    fitted = wind.nrays_valid > 0
+    assert (wind.wind_mean_intensity.where(fitted) >
+            check_vadwind.MIN_VALID_INTENSITY).sum() == fitted.sum()
+    assert wind.wind_mean_intensity.where(~fitted).isnull().all()
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+With a --memory-budget, w400s_L1a_to_L2.process_file works in time blocks; the
+L2 must be identical to the whole-day L2, including days that end early.
+
+python -m pytest tests/test_w400s_blocks.py
+"""
+import os
+import sys
+
+import pandas as pd
+import pytest
+import xarray as xr
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import synthetic_campaign  # noqa: E402
+import w400s_L1a_to_L2  # noqa: E402
+
+DAY = pd.Timestamp("2023-01-01")
+
+
+@pytest.fixture(scope="module")
+def l1a_file(tmp_path_factory):
+    l1_dir = tmp_path_factory.mktemp("L1")
+    synthetic_campaign.write_w400s_day(str(l1_dir), DAY, ngates=20,
+                                       cadence=4, seed=0)
+    return os.path.join(l1_dir, synthetic_campaign.W400S_SERIAL,
+                        DAY.strftime(synthetic_campaign.W400S_FILE))
+
+
+@pytest.fixture(scope="module")
+def short_l1a_file(l1a_file, tmp_path_factory):
+    # the instrument stopped at 17:00, well before the last block
+    file = str(tmp_path_factory.mktemp("L1short") / "short.nc")
+    with xr.open_dataset(l1a_file) as src:
+        src.sel(time=slice(None, DAY + pd.Timedelta("17h"))).to_netcdf(file)
+    return file
+
+
+@pytest.mark.parametrize("memory_budget", [300_000, 2_000_000])
+def test_blocks_match_whole_day(l1a_file, memory_budget):
+    whole = w400s_L1a_to_L2.process_file(l1a_file)
+    blocks = w400s_L1a_to_L2.process_file(l1a_file,
+                                          memory_budget=memory_budget)
+    xr.testing.assert_identical(blocks, whole)
+
+
+def test_blocks_match_short_day(short_l1a_file):
+    whole = w400s_L1a_to_L2.process_file(short_l1a_file)
+    blocks = w400s_L1a_to_L2.process_file(short_l1a_file,
+                                          memory_budget=300_000)
+    xr.testing.assert_identical(blocks, whole)
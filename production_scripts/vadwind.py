@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+VAD/DBS wind retrieval of StreamLine scans, in place of haloreader's
+halo.compute_wind (run scan by scan). For every scan and range gate the
+radial velocities of the rays are fit by least squares to
+
+    v_r = u sin(az) cos(el) + v cos(az) cos(el) + w sin(el)
+
+All scans and gates of a day are solved at once: the 3x3 normal equations
+are summed per scan with np.add.reduceat over the rays (in time order) and
+solved as one stack. A ray-gate is used if its intensity is above
+min_valid_intensity and the ray elevation is within ELEVATION_TOLERANCE of
+elevation_expected_value.
+
+halo_wind returns the variables of to_xarray(halo.compute_wind(...)), so
+streamLine_RAW_to_L1.py --retrieval vad writes the same L1 layout, with the
+conventions of compute_wind: time is the time of the first ray of each scan
+and wind_mean_intensity the mean intensity of the valid ray-gates of the fit
+(the intensity streamLine_L1_to_L2 thresholds). It adds a height coordinate
+(range times the sine of the expected elevation). tests/test_vadwind.py
+checks halo_wind against the stored reference tests/data/vad_reference.nc,
+written by benchmarks/check_vadwind.py --write-reference (from compute_wind
+where the haloreader fork that has it is installed, else from the scan by
+scan fit). haloreader stays the default retrieval.
+"""
+
+import logging
+import numpy as np
+import pandas as pd
+import xarray as xr
+import harmonise
+
+# rays more than ELEVATION_TOLERANCE (degrees) off the expected scan
+# elevation are not used
+ELEVATION_TOLERANCE = 1
+# fewest valid rays for a fit of u, v, w
+MIN_VALID_RAYS = 3
+# seconds a ray may be timed before the start of its scan (.hpl ray times are
+# decimal hours rounded to 3.6 ms)
+SCAN_START_TOLERANCE = 1
+# normal matrices with det / nrays_valid ** 3 below this are singular (e.g.
+# all valid rays at about the same azimuth)
+MIN_RELATIVE_DET = 1e-8
+
+
+def scan_index(time, scan_start_time=None):
+    """
+    Scan number of each ray: the last scan start at or before the ray (within
+    SCAN_START_TOLERANCE), or without scan start times a new scan after a gap
+    of more than 3 times the median time between rays. -1 for rays before the
+    first scan.
+    """
+    time = np.asarray(time, dtype=np.float64)
+    if scan_start_time is not None and np.size(scan_start_time) > 0:
+        scan_start_time = np.sort(np.atleast_1d(scan_start_time))
+        return np.searchsorted(scan_start_time - SCAN_START_TOLERANCE, time,
+                               side="right") - 1
+    gaps = np.diff(time)
+    if len(gaps) == 0:
+        return np.zeros(len(time), dtype=int)
+    return np.concatenate(
+        [[0], np.cumsum(gaps > 3 * np.median(gaps))])
+
+
+def retrieve_wind(scan, azimuth, elevation, doppler_velocity, intensity,
+                  min_valid_intensity, elevation_expected_value,
+                  elevation_tolerance=ELEVATION_TOLERANCE):
+    """
+    Least squares u, v, w of every scan and range gate.
+
+    Parameters
+    ----------
+    scan : np.ndarray
+        (ray,) scan number of each ray (scan_index), rays of a scan adjacent.
+        Rays with a negative scan number are not used
+    azimuth, elevation : np.ndarray
+        (ray,) degrees
+    doppler_velocity, intensity : np.ndarray
+        (ray, range), NaN or masked values are not used
+
+    Returns
+    -------
+    dict of (scan, range) arrays zonal_wind, meridional_wind, vertical_wind,
+    wind_rmse, nrays_valid and wind_mean_intensity, and (scan,) arrays
+    scan (the scan numbers), start (the index of the first ray), nrays and
+    elevation. Gates without a fit are NaN, and wind_mean_intensity of gates
+    without a valid ray-gate
+    """
+    scan = np.asarray(scan)
+    azimuth = np.deg2rad(np.asarray(azimuth, dtype=np.float64))
+    elevation_deg = np.asarray(elevation, dtype=np.float64)
+    elevation = np.deg2rad(elevation_deg)
+    doppler_velocity = np.ma.filled(np.ma.asarray(
+        doppler_velocity, dtype=np.float64), np.nan)
+    intensity = np.ma.filled(np.ma.asarray(
+        intensity, dtype=np.float64), np.nan)
+
+    if np.any(np.diff(scan) < 0):
+        raise ValueError("The rays of a scan must be adjacent and in order")
+    # rays before the first scan (-1) are all at the start
+    in_scan = scan >= 0
+    scan_numbers, starts = np.unique(scan, return_index=True)
+    if len(scan_numbers) and scan_numbers[0] < 0:
+        scan_numbers, starts = scan_numbers[1:], starts[1:]
+    ray_ok = in_scan & (np.abs(elevation_deg - elevation_expected_value)
+                        <= elevation_tolerance)
+    n_off = int(np.sum(in_scan & ~ray_ok))
+    if n_off:
+        logging.warning(
+            f"{n_off} rays more than {elevation_tolerance} degrees off "
+            f"the {elevation_expected_value} degree scan elevation not used")
+
+    # rays outside the scans only add zeros to the sums
+    valid = ray_ok[:, None] & (intensity > min_valid_intensity) & \
+        np.isfinite(doppler_velocity)
+    weight = valid.astype(np.float64)
+    vr = np.where(valid, doppler_velocity, 0)
+    a = np.stack([np.sin(azimuth) * np.cos(elevation),
+                  np.cos(azimuth) * np.cos(elevation),
+                  np.sin(elevation)])
+
+    def scan_sum(values):
+        return np.add.reduceat(values, starts, axis=0) if len(starts) else \
+            np.zeros((0,) + values.shape[1:])
+
+    # normal equations (scan, range, 3, 3) and (scan, range, 3)
+    nrays_valid = scan_sum(weight)
+    normal = np.empty(nrays_valid.shape + (3, 3))
+    rhs = np.empty(nrays_valid.shape + (3,))
+    for i in range(3):
+        rhs[..., i] = scan_sum(a[i][:, None] * vr)
+        for j in range(i, 3):
+            normal[..., i, j] = normal[..., j, i] = scan_sum(
+                (a[i] * a[j])[:, None] * weight)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        solvable = (nrays_valid >= MIN_VALID_RAYS) & (
+            np.linalg.det(normal) / nrays_valid ** 3 > MIN_RELATIVE_DET)
+    wind = np.full(nrays_valid.shape + (3,), np.nan)
+    wind[solvable] = np.linalg.solve(
+        normal[solvable], rhs[solvable][..., None])[..., 0]
+
+    # residuals of every valid ray-gate against the fit of its scan
+    ray_scan = np.searchsorted(scan_numbers, scan)
+    ray_scan[~in_scan] = 0
+    ray_wind = wind[ray_scan]
+    fitted = np.einsum("ir,rgi->rg", a, np.nan_to_num(ray_wind))
+    squared = np.where(valid, (vr - fitted) ** 2, 0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        wind_rmse = np.where(
+            solvable, np.sqrt(scan_sum(squared) / nrays_valid), np.nan)
+
+    # the mean intensity of the valid ray-gates of the fit
+    with np.errstate(invalid="ignore", divide="ignore"):
+        wind_mean_intensity = scan_sum(np.where(
+            valid, intensity, 0)) / nrays_valid
+        scan_elevation = scan_sum(np.where(ray_ok, elevation_deg, 0)) / \
+            scan_sum(ray_ok.astype(np.float64))
+
+    return {
+        "scan": scan_numbers,
+        "start": starts,
+        "zonal_wind": wind[..., 0],
+        "meridional_wind": wind[..., 1],
+        "vertical_wind": wind[..., 2],
+        "wind_rmse": wind_rmse,
+        "nrays_valid": nrays_valid,
+        "wind_mean_intensity": wind_mean_intensity,
+        "nrays": scan_sum(in_scan.astype(np.int64)),
+        "elevation": scan_elevation,
+    }
+
+
+def _metadata_value(metadata, field):
+    var = getattr(metadata, field, None)
+    if var is None or getattr(var, "data", None) is None:
+        return None
+    data = np.ravel(var.data)
+    return data[0] if len(data) else None
+
+
+def halo_wind(halo, min_valid_intensity, elevation_expected_value,
+              elevation_tolerance=ELEVATION_TOLERANCE):
+    """
+    Wind profiles of every scan of a haloreader Halo (background corrected
+    intensity if corrected), as to_xarray(halo.compute_wind(...)) plus a
+    height coordinate.
+
+    Returns
+    -------
+    xr.Dataset (time, range), time the time of the first ray of each scan.
+    None if there are no scans at the expected elevation
+    """
+    time = np.asarray(halo.time.data, dtype=np.float64)
+    start_time = getattr(halo.metadata, "start_time", None)
+    scan = scan_index(time, None if start_time is None else
+                      np.asarray(start_time.data, dtype=np.float64))
+    intensity = halo.intensity if halo.intensity is not None else \
+        halo.intensity_raw
+    wind = retrieve_wind(
+        scan, halo.azimuth.data, halo.elevation.data,
+        halo.doppler_velocity.data, intensity.data,
+        min_valid_intensity=min_valid_intensity,
+        elevation_expected_value=elevation_expected_value,
+        elevation_tolerance=elevation_tolerance)
+    # scans without a single ray at the expected elevation
+    keep = np.isfinite(wind["elevation"])
+    if not keep.any():
+        return None
+
+    scan_time = time[wind["start"]]
+    n_scans = int(keep.sum())
+    range_ = np.asarray(halo.range.data, dtype=np.float64)
+    ws, wd = harmonise.vector_to_ws_wd(
+        wind["zonal_wind"][keep], wind["meridional_wind"][keep])
+    data_vars = {
+        name: (["time", "range"], wind[name][keep])
+        for name in ["zonal_wind", "meridional_wind"]}
+    data_vars["horizontal_wind_speed"] = (["time", "range"], ws)
+    data_vars["wind_direction"] = (["time", "range"], wd)
+    for name in ["wind_rmse", "nrays_valid", "wind_mean_intensity"]:
+        data_vars[name] = (["time", "range"], wind[name][keep])
+    for field in ["gate_length", "gate_range", "npulses", "resolution",
+                  "wavelength"]:
+        var = getattr(halo.metadata, field, None)
+        if getattr(var, "dimensions", None) == ("time",):
+            # per ray (hplparse.merge of files of different npulses), the
+            # value of the first ray of each scan
+            data_vars[field] = (["time"], np.asarray(
+                var.data)[wind["start"]][keep])
+            continue
+        value = _metadata_value(halo.metadata, field)
+        if value is not None:
+            data_vars[field] = (["time"], np.repeat(value, n_scans))
+    data_vars["nrays"] = (["time"], wind["nrays"][keep])
+    data_vars["wind_elevation"] = (
+        ["time"], np.repeat(float(elevation_expected_value), n_scans))
+    data_vars["elevation"] = (["time"], wind["elevation"][keep])
+
+    dat = xr.Dataset(
+        data_vars=data_vars,
+        coords={
+            "time": pd.to_datetime(scan_time[keep], unit="s"),
+            "range": range_,
+            "height": (["range"], range_ * np.sin(
+                np.deg2rad(elevation_expected_value))),
+        })
+
+    return dat
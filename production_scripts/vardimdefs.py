@@ -155,6 +155,240 @@ vardimdefs = [
             'from eastward_wind and northward_wind.'
         ),
     },
+    # derived diagnostics of the L3 profiles (l3diag.py)
+    {
+        "level": 3,
+        "type": "variable",
+        "name": "shear",
+        "long_name": "vertical_wind_shear",
+        "units": "s^-1",
+        "comment": (
+            'Magnitude of the vertical gradient of the horizontal wind vector, '
+            'sqrt((du/dz)^2 + (dv/dz)^2), from centred differences of u and '
+            'v between the neighbouring altitudes.'
+        ),
+    },
+    {
+        "level": 3,
+        "type": "variable",
+        "name": "speed_shear",
+        "long_name": "vertical_gradient_of_wind_speed",
+        "units": "s^-1",
+        "comment": (
+            'Vertical gradient of the horizontal wind speed d(ws)/dz, from '
+            'centred differences between the neighbouring altitudes.'
+        ),
+    },
+    {
+        "level": 3,
+        "type": "variable",
+        "name": "veer",
+        "long_name": "vertical_gradient_of_wind_direction",
+        "units": "degrees.m^-1",
+        "comment": (
+            'Vertical gradient of the horizontal wind direction d(wd)/dz, '
+            'positive when the wind turns clockwise (veers) with altitude. '
+            'From centred differences between the neighbouring altitudes.'
+        ),
+    },
+    {
+        "level": 3,
+        "type": "variable",
+        "name": "llj",
+        "long_name": "low_level_jet_detected",
+        "units": defs.UNITLESS_UNITS,
+        "comment": (
+            '1 if the profile has a low-level jet, 0 if not. Missing values '
+            'indicate too few valid altitudes to decide.'
+        ),
+    },
+    {
+        "level": 3,
+        "type": "variable",
+        "name": "llj_altitude",
+        "long_name": "low_level_jet_nose_altitude",
+        "units": "m",
+        "reference_geoid": "EGM96",
+        "comment": 'Altitude of the low-level jet wind speed maximum.',
+    },
+    {
+        "level": 3,
+        "type": "variable",
+        "name": "llj_speed",
+        "long_name": "low_level_jet_nose_wind_speed",
+        "units": defs.WS_UNITS,
+        "comment": 'Horizontal wind speed at the low-level jet nose.',
+    },
+    {
+        "level": 3,
+        "type": "variable",
+        "name": "llj_falloff",
+        "long_name": "low_level_jet_falloff",
+        "units": defs.WS_UNITS,
+        "comment": (
+            'Decrease of the horizontal wind speed from the low-level jet nose '
+            'to the minimum above it.'
+        ),
+    },
+    # campaign climatology of the L3 (climatology.py)
+    {
+        "level": 3,
+        "type": "dimension",
+        "name": "month",
+        "long_name": "month_of_year",
+        "units": defs.UNITLESS_UNITS,
+        "comment": 'Month of the year (1 to 12) of the L3 time steps (UTC).',
+    },
+    {
+        "level": 3,
+        "type": "dimension",
+        "name": "hour",
+        "long_name": "hour_of_day",
+        "units": defs.UNITLESS_UNITS,
+        "comment": (
+            'Hour of the day (0 to 23, UTC) of the start of the L3 time steps.'
+        ),
+    },
+    {
+        "level": 3,
+        "type": "dimension",
+        "name": "quantile",
+        "long_name": "quantile",
+        "units": defs.UNITLESS_UNITS,
+        "comment": 'Probability of the wind speed quantiles.',
+    },
+    {
+        "level": 3,
+        "type": "dimension",
+        "name": "wd_sector",
+        "long_name": "wind_direction_sector",
+        "units": "degrees",
+        "comment": (
+            'Centre of the wind direction sector of the wind rose, clockwise '
+            'from true north.'
+        ),
+    },
+    {
+        "level": 3,
+        "type": "dimension",
+        "name": "ws_class",
+        "long_name": "wind_speed_class",
+        "units": defs.WS_UNITS,
+        "comment": (
+            'Lower bound of the wind speed class of the wind rose, the upper '
+            'bound is the next class.'
+        ),
+    },
+    {
+        "level": 3,
+        "type": "variable",
+        "name": "n_diurnal",
+        "long_name": "number_of_samples",
+        "units": defs.UNITLESS_UNITS,
+        "dtype": "int32",
+        "comment": 'Number of L3 wind values in the means.',
+    },
+    {
+        "level": 3,
+        "type": "variable",
+        "name": "u_diurnal",
+        "long_name": "mean_eastward_wind",
+        "units": defs.WS_UNITS,
+        "comment": 'Mean of the L3 eastward_wind by month and hour of day.',
+    },
+    {
+        "level": 3,
+        "type": "variable",
+        "name": "v_diurnal",
+        "long_name": "mean_northward_wind",
+        "units": defs.WS_UNITS,
+        "comment": 'Mean of the L3 northward_wind by month and hour of day.',
+    },
+    {
+        "level": 3,
+        "type": "variable",
+        "name": "ws_diurnal",
+        "long_name": "mean_wind_speed",
+        "units": defs.WS_UNITS,
+        "comment": 'Mean of the L3 wind speed by month and hour of day.',
+    },
+    {
+        "level": 3,
+        "type": "variable",
+        "name": "wd_diurnal",
+        "long_name": "direction_of_mean_wind",
+        "units": "degrees",
+        "comment": (
+            'Wind direction of the mean wind vector (u_diurnal, v_diurnal), '
+            'clockwise from true north.'
+        ),
+    },
+    {
+        "level": 3,
+        "type": "variable",
+        "name": "n_monthly",
+        "long_name": "number_of_samples",
+        "units": defs.UNITLESS_UNITS,
+        "dtype": "int32",
+        "comment": 'Number of L3 wind values in the means.',
+    },
+    {
+        "level": 3,
+        "type": "variable",
+        "name": "u_monthly",
+        "long_name": "mean_eastward_wind",
+        "units": defs.WS_UNITS,
+        "comment": 'Mean of the L3 eastward_wind by month.',
+    },
+    {
+        "level": 3,
+        "type": "variable",
+        "name": "v_monthly",
+        "long_name": "mean_northward_wind",
+        "units": defs.WS_UNITS,
+        "comment": 'Mean of the L3 northward_wind by month.',
+    },
+    {
+        "level": 3,
+        "type": "variable",
+        "name": "ws_monthly",
+        "long_name": "mean_wind_speed",
+        "units": defs.WS_UNITS,
+        "comment": 'Mean of the L3 wind speed by month.',
+    },
+    {
+        "level": 3,
+        "type": "variable",
+        "name": "wd_monthly",
+        "long_name": "direction_of_mean_wind",
+        "units": "degrees",
+        "comment": (
+            'Wind direction of the mean wind vector (u_monthly, v_monthly), '
+            'clockwise from true north.'
+        ),
+    },
+    {
+        "level": 3,
+        "type": "variable",
+        "name": "ws_quantile",
+        "long_name": "wind_speed_quantile",
+        "units": defs.WS_UNITS,
+        "comment": (
+            'Quantiles of the L3 wind speed by month, from a histogram of '
+            'the wind speeds (linear within a bin).'
+        ),
+    },
+    {
+        "level": 3,
+        "type": "variable",
+        "name": "wind_rose",
+        "long_name": "wind_rose_frequency",
+        "units": "%",
+        "comment": (
+            'Percentage of the L3 winds of the month and altitude in each wind '
+            'direction sector and wind speed class.'
+        ),
+    },
     {
         "level": 3,
         "type": "dimension",
@@ -188,6 +422,7 @@ vardimdefs = [
         "type": "variable",
         "name": "system_id",
         "long_name": "system_unique_id",
+        "compression": None,
         "units": defs.UNITLESS_UNITS,
         "comment":  (
             'The specific system (instrument) currently deployed at the measurement station'
@@ -232,4 +467,17 @@ vardimdefs = [
             'The measurement station height above sea level.'
         )
     },
+    {
+        "level": 3,
+        "type": "variable",
+        "name": "altitude_valid_top",
+        "long_name": "altitude_of_highest_level_with_data",
+        "units": "m",
+        "reference_geoid": "EGM96",
+        "comment": (
+            'The highest altitude with a valid wind or a raised flag at the '
+            'station in the file. All variables are missing above it (there '
+            'are no samples) and those levels are not stored.'
+        ),
+    },
 ]
@@ -8,9 +8,15 @@ Created on Tue Jun 18 14:26:02 2024
 from glob import glob
 import xarray as xr
 import os
+import sys
+import argparse
+import logging
 from datetime import datetime as dt
 import harmonise
+import memtrack
+import iopipe
 import numpy as np
+import pandas as pd
 
 INPUT_FILENAME_GSUB = "w400s_1a_LqualairLzamIdbs_v01_*"
 INPUT_FILE_DT = "w400s_1a_LqualairLzamIdbs_v01_%Y%m%d_%H%M%S_1440.nc"
@@ -18,6 +24,10 @@ SYSTEM_SERIAL = "WCS000243"
 PRODUCT_NAME = "w400s_L1a"
 OUTPUT_FILE = f"{PRODUCT_NAME}_%Y%m%d_%H%M%S_{SYSTEM_SERIAL}.nc"
 ELEVATION_ANGLE = 75  # the elevation angle of the DBS scan
+STAT_WINDOW = "240s"
+AGG_RES = "1min"
+# peak memory of w400s_l1a_to_l2 relative to the size of the loaded L1a data
+WORKING_SET_FACTOR = 4
 PRODUCT_LEVEL = 2
 __version__ = "1.32"
 
@@ -73,7 +83,9 @@ def w400s_apply_pre_aggregation_qc(dat, stat_window="240s",
 
     ci_threshold = dat.wind_speed_ci < 100
     suspect_retrieval_removed = wind_speed_status_invalid | ci_threshold
-    suspect_retrieval_removed[ws_threshold] = True
+    # (rather than setting the flagged times to True) so that thresholds
+    # along a dimension of their own broadcast
+    suspect_retrieval_removed = suspect_retrieval_removed | ws_threshold
     dat["u"] = dat["u"].where(~suspect_retrieval_removed)
     dat["v"] = dat["v"].where(~suspect_retrieval_removed)
     dat["flag_wind_speed_status_invalid"] = wind_speed_status_invalid.rename(
@@ -141,37 +153,155 @@ def w400s_aggregate_time(dat, agg_res):
     return xr.merge(agg_vars)
 
 
+def w400s_l1a_to_l2(dat, block_start=None, block_end=None,
+                    fraction_above_ws_threshold=0.25, ws_max_abs_diff=15):
+    """
+    L1a to (unattributed) L2 for L1a data with the range already assigned.
+    The thresholds of w400s_apply_pre_aggregation_qc can be xr.DataArrays
+    along a dimension of their own (see qcsweep.py).
+
+    For a time block [block_start, block_end) of a day, dat must hold one
+    STAT_WINDOW of data either side of the block so that the suspect retrieval
+    windows at the block edges see the same data as when the day is processed
+    whole. Block edges must be on STAT_WINDOW boundaries of the day.
+    """
+    u, v = harmonise.ws_wd_to_vector(dat["horizontal_wind_speed"].values,
+                                     dat["wind_direction"].values)
+    dat["u"], dat["v"] = [(["time", "range"], i) for i in [u, v]]
+    dat = w400s_apply_pre_aggregation_qc(
+        dat, stat_window=STAT_WINDOW,
+        fraction_above_ws_threshold=fraction_above_ws_threshold,
+        ws_max_abs_diff=ws_max_abs_diff)
+    if block_start is not None:
+        times = dat.indexes["time"]
+        dat = dat.isel(time=slice(times.searchsorted(block_start),
+                                  times.searchsorted(block_end)))
+    dat = w400s_aggregate_time(dat, agg_res=AGG_RES)
+    dat = harmonise.range_to_height_adjust(dat, ELEVATION_ANGLE)
+    dat = w400s_flag_suspect_retrieval_removed(dat)
+    dat = w400s_flag_suspect_retrieval_warn(dat)
+    dat = w400s_flag_ws_out_of_range(dat)
+    dat = harmonise.select_preharmonisation_data_vars(dat)
+
+    return dat
+
+
+def time_blocks(times, block_steps, stat_window=STAT_WINDOW):
+    """
+    [start, end) time blocks of about block_steps time stamps, on stat_window
+    boundaries from the start of the day, up to the block of times[-1].
+    """
+    window = pd.Timedelta(stat_window)
+    day_start = times[0].floor("D")
+    n_windows = int(np.ceil((times[-1] - day_start) / window)) + 1
+    steps_per_window = len(times) / n_windows
+    windows_per_block = max(1, int(block_steps // max(steps_per_window, 1)))
+    edges = [day_start + window * i
+             for i in range(0, n_windows + windows_per_block,
+                            windows_per_block)]
+    return [(start, end) for start, end in zip(edges[:-1], edges[1:])
+            if start <= times[-1]]
+
+
+def process_file(file, memory_budget=None, tracker=None):
+    """
+    L2 of one L1a file. With a memory_budget the day is read and processed in
+    time blocks sized to the budget; the result is identical.
+    """
+    if tracker is None:
+        tracker = memtrack.MemoryTracker(enabled=False)
+    with xr.open_dataset(file) as src:
+        src = gate_index_to_range(src)
+        n_time = src.sizes["time"]
+        bytes_per_step = sum(
+            src[var].dtype.itemsize * src[var].size / n_time
+            for var in src.data_vars if "time" in src[var].dims)
+        block_steps = memtrack.block_length(
+            memory_budget, bytes_per_step, n_time,
+            working_set_factor=WORKING_SET_FACTOR)
+        if block_steps >= n_time:
+            with tracker.track("w400s_l1a_to_l2", os.path.basename(file)):
+                return w400s_l1a_to_l2(src.load())
+
+        times = src.indexes["time"]
+        window = pd.Timedelta(STAT_WINDOW)
+        blocks = []
+        for block_start, block_end in time_blocks(times, block_steps):
+            # no time stamps of its own, only the stat_window either side
+            if times.searchsorted(block_start) == \
+                    times.searchsorted(block_end):
+                continue
+            unit = f"{os.path.basename(file)} {block_start:%H%M%S}"
+            with tracker.track("w400s_l1a_to_l2", unit):
+                block = src.isel(time=slice(
+                    times.searchsorted(block_start - window),
+                    times.searchsorted(block_end + window))).load()
+                blocks.append(w400s_l1a_to_l2(block, block_start, block_end))
+
+    return xr.concat(blocks, dim="time")
+
+
+def write_l2(dat, file_date):
+    dat.attrs = {"production_level": PRODUCT_LEVEL,
+                 "production_version": __version__,
+                 }
+    OUTPUT_FILE = harmonise.PRODUCT_FILENAME_TEMPLATE.format(
+        product_name=PRODUCT_NAME, product_level=PRODUCT_LEVEL,
+        product_version=__version__, system_serial=SYSTEM_SERIAL)
+    out_file = dt.strftime(file_date, OUTPUT_FILE)
+    out_dir = os.path.join(harmonise.L2_BASEDIR, out_file)
+    if not os.path.exists(os.path.dirname(out_dir)):
+        os.makedirs(os.path.dirname(out_dir), exist_ok=True)
+    dat.to_netcdf(
+        out_dir, encoding=harmonise.encode_nc_compression(dat))
+
+    return out_dir
+
+
 def main():
+    parser = argparse.ArgumentParser(description="w400s L1a to L2.")
+    parser.add_argument("--memory-budget", type=memtrack.parse_size,
+                        help="Process each day in time blocks that fit this "
+                        "much memory, e.g. 2G")
+    parser.add_argument("--track-memory", action="store_true",
+                        help="Log the peak memory of every file or block")
+    parser.add_argument("--trace-allocations", action="store_true",
+                        help="Also log the largest allocations (slow)")
+    parser.add_argument("--memory-log",
+                        help="Append the memory records to this JSON lines "
+                        "file")
+    parser.add_argument("--read-ahead", type=int, default=1,
+                        help="Files to read and process ahead of the file "
+                        "written, 0 to run in sequence")
+    parser.add_argument("--writers", type=int, default=1,
+                        help="Threads writing L2 files behind the "
+                        "processing, 0 to write in sequence")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
+        datefmt='%H:%M:%S', level=logging.INFO)
+    tracker = memtrack.MemoryTracker(
+        enabled=args.track_memory or args.trace_allocations,
+        trace_allocations=args.trace_allocations, log_file=args.memory_log)
 
     files = glob(os.path.join(harmonise.L1_BASEDIR,
                               SYSTEM_SERIAL, INPUT_FILENAME_GSUB))
-    for file in files:
-        file_date = dt.strptime(os.path.basename(file), INPUT_FILE_DT)
-        dat = xr.load_dataset(file)
-        dat = gate_index_to_range(dat)
-        u, v = harmonise.ws_wd_to_vector(dat["horizontal_wind_speed"].values,
-                                         dat["wind_direction"].values)
-        dat["u"], dat["v"] = [(["time", "range"], i) for i in [u, v]]
-        dat = w400s_apply_pre_aggregation_qc(dat)
-        dat = w400s_aggregate_time(dat, agg_res="1min")
-        dat = harmonise.range_to_height_adjust(dat, ELEVATION_ANGLE)
-        dat = w400s_flag_suspect_retrieval_removed(dat)
-        dat = w400s_flag_suspect_retrieval_warn(dat)
-        dat = w400s_flag_ws_out_of_range(dat)
-        dat = harmonise.select_preharmonisation_data_vars(dat)
-        dat.attrs = {"production_level": PRODUCT_LEVEL,
-                     "production_version": __version__,
-                     }
-        OUTPUT_FILE = harmonise.PRODUCT_FILENAME_TEMPLATE.format(
-            product_name=PRODUCT_NAME, product_level=PRODUCT_LEVEL,
-            product_version=__version__, system_serial=SYSTEM_SERIAL)
-        out_file = dt.strftime(file_date, OUTPUT_FILE)
-        out_dir = os.path.join(harmonise.L2_BASEDIR, out_file)
-        if not os.path.exists(os.path.dirname(out_dir)):
-            os.makedirs(os.path.dirname(out_dir), exist_ok=True)
-        print(out_dir)
-        dat.to_netcdf(
-            out_dir, encoding=harmonise.encode_nc_compression(dat))
+    # process_file reads in (memory budgeted) blocks, so the reading and
+    # processing of the next file overlap the write of this one
+    failed = []
+    for file, out_dir in iopipe.pipelined(
+            files,
+            lambda file: process_file(file, memory_budget=args.memory_budget,
+                                      tracker=tracker),
+            lambda file, dat: write_l2(dat, dt.strptime(
+                os.path.basename(file), INPUT_FILE_DT)),
+            read_ahead=args.read_ahead, writers=args.writers, failed=failed):
+        if out_dir is not None:
+            print(out_dir)
+    if failed:
+        logging.error(f"{len(failed)} of {len(files)} files failed")
+        sys.exit(1)
 
 
 if __name__ == "__main__":
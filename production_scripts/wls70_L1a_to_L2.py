@@ -8,8 +8,12 @@ Created on Tue Jun 18 14:26:02 2024
 from glob import glob
 import xarray as xr
 import os
+import sys
+import argparse
+import logging
 from datetime import datetime as dt
 import harmonise
+import iopipe
 
 KNOWN_GATE_LENGTH = 50
 AGGREGATION_INTERVAL = "10min"
@@ -72,10 +76,7 @@ def wls70_get_scan_elevation(dat):
     return 90 - dat.scan_angle
 
 
-def prepare_harmonisation(file):
-    file_date = dt.strptime(os.path.basename(file), INPUT_FILE_DT)
-    dat = xr.load_dataset(file)
-
+def wls70_l1a_to_l2(dat):
     dat = wls70_flag_suspect_retrieval_warn_and_removed(dat)
     dat = harmonise.flag_ws_out_of_range(dat, ws_var_name="ws")
     elevation = wls70_get_scan_elevation(dat)
@@ -84,6 +85,11 @@ def prepare_harmonisation(file):
     dat.attrs = {"production_level": PRODUCT_LEVEL,
                  "production_version": __version__,
                  }
+
+    return dat
+
+
+def write_l2(dat, file_date):
     OUTPUT_FILE = harmonise.PRODUCT_FILENAME_TEMPLATE.format(
         product_name=PRODUCT_NAME, product_level=PRODUCT_LEVEL,
         product_version=__version__, system_serial=SYSTEM_SERIAL)
@@ -91,17 +97,44 @@ def prepare_harmonisation(file):
     out_dir = os.path.join(harmonise.L2_BASEDIR, out_file)
     if not os.path.exists(os.path.dirname(out_dir)):
         os.makedirs(os.path.dirname(out_dir), exist_ok=True)
-    print(out_dir)
-
     dat.to_netcdf(out_dir, encoding=harmonise.encode_nc_compression(dat))
 
+    return out_dir
+
+
+def prepare_harmonisation(file):
+    file_date = dt.strptime(os.path.basename(file), INPUT_FILE_DT)
+    print(write_l2(wls70_l1a_to_l2(xr.load_dataset(file)), file_date))
+
 
 def main():
+    parser = argparse.ArgumentParser(description="wls70 L1a to L2.")
+    parser.add_argument("--read-ahead", type=int, default=1,
+                        help="Files to read ahead of the file processed, 0 "
+                        "to read in sequence")
+    parser.add_argument("--writers", type=int, default=1,
+                        help="Threads writing L2 files behind the reads, 0 "
+                        "to write in sequence")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
+        datefmt='%H:%M:%S', level=logging.INFO)
 
     files = glob(os.path.join(harmonise.L1_BASEDIR,
                               SYSTEM_SERIAL, INPUT_FILENAME_GSUB))
-    for file in files:
-        prepare_harmonisation(file)
+    failed = []
+    for file, out_dir in iopipe.pipelined(
+            files, xr.load_dataset,
+            lambda file, dat: write_l2(dat, dt.strptime(
+                os.path.basename(file), INPUT_FILE_DT)),
+            lambda file, dat: wls70_l1a_to_l2(dat),
+            read_ahead=args.read_ahead, writers=args.writers, failed=failed):
+        if out_dir is not None:
+            print(out_dir)
+    if failed:
+        logging.error(f"{len(failed)} of {len(files)} files failed")
+        sys.exit(1)
 
 
 if __name__ == "__main__":